@@ -45,9 +45,30 @@ CREATE EXTENSION pg_trgm;
 -- 	store_cookies BOOLEAN,
 -- 	store_security_details BOOLEAN,
 -- 	timeseries_enabled BOOLEAN,
--- 	timeseries_interval BIGINT
+-- 	timeseries_interval BIGINT,
+-- 	client_network_idle_wait REAL,
+-- 	adaptive_waits_enabled BOOLEAN,
+-- 	adaptive_no_event_wait_min BIGINT,
+-- 	adaptive_no_event_wait_max BIGINT,
+-- 	adaptive_max_wait_min BIGINT,
+-- 	adaptive_max_wait_max BIGINT,
+-- 	task_lease_batch_size BIGINT,
+-- 	task_lease_seconds BIGINT,
+-- 	max_domain_leases BIGINT,
+-- 	client_body_window BIGINT,
+-- 	client_body_max_bytes BIGINT,
+-- 	client_body_mime_types TEXT,
+-- 	client_body_3p_only BOOLEAN,
+-- 	client_body_spool_dir TEXT,
+-- 	client_max_links BIGINT,
+-- 	client_scroll_strategy TEXT,
+-- 	client_scroll_max_depth BIGINT,
+-- 	client_scroll_max_seconds REAL,
+-- 	client_crawl_tabs BIGINT,
+-- 	client_lean_mode BOOLEAN,
+-- 	client_lean_resource_types TEXT
 -- );
-CREATE TABLE config(client_browser_type TEXT,client_prewait BIGINT,client_no_event_wait BIGINT,client_max_wait BIGINT,client_get_bodies BOOLEAN,client_get_bodies_b64 BOOLEAN,client_get_screen_shot BOOLEAN,client_get_text BOOLEAN,client_crawl_depth BIGINT,client_crawl_retries BIGINT,client_page_load_strategy TEXT,client_reject_redirects BOOLEAN,client_min_internal_links BIGINT,client_injections TEXT,client_incognito BOOLEAN,client_headless BOOLEAN,max_attempts BIGINT,modified TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,store_1p BOOLEAN,store_base64 BOOLEAN,store_files BOOLEAN,store_screen_shot BOOLEAN,store_source BOOLEAN,store_page_text BOOLEAN,store_links BOOLEAN,store_misc_storage BOOLEAN,store_responses BOOLEAN,store_request_xtra_headers BOOLEAN,store_response_xtra_headers BOOLEAN,store_requests BOOLEAN,store_websockets BOOLEAN,store_websocket_events BOOLEAN,store_event_source_msgs BOOLEAN,store_cookies BOOLEAN,store_security_details BOOLEAN,timeseries_enabled BOOLEAN,timeseries_interval BIGINT);
+CREATE TABLE config(client_browser_type TEXT,client_prewait BIGINT,client_no_event_wait BIGINT,client_max_wait BIGINT,client_get_bodies BOOLEAN,client_get_bodies_b64 BOOLEAN,client_get_screen_shot BOOLEAN,client_get_text BOOLEAN,client_crawl_depth BIGINT,client_crawl_retries BIGINT,client_page_load_strategy TEXT,client_reject_redirects BOOLEAN,client_min_internal_links BIGINT,client_injections TEXT,client_incognito BOOLEAN,client_headless BOOLEAN,max_attempts BIGINT,modified TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,store_1p BOOLEAN,store_base64 BOOLEAN,store_files BOOLEAN,store_screen_shot BOOLEAN,store_source BOOLEAN,store_page_text BOOLEAN,store_links BOOLEAN,store_misc_storage BOOLEAN,store_responses BOOLEAN,store_request_xtra_headers BOOLEAN,store_response_xtra_headers BOOLEAN,store_requests BOOLEAN,store_websockets BOOLEAN,store_websocket_events BOOLEAN,store_event_source_msgs BOOLEAN,store_cookies BOOLEAN,store_security_details BOOLEAN,timeseries_enabled BOOLEAN,timeseries_interval BIGINT,client_network_idle_wait REAL,adaptive_waits_enabled BOOLEAN,adaptive_no_event_wait_min BIGINT,adaptive_no_event_wait_max BIGINT,adaptive_max_wait_min BIGINT,adaptive_max_wait_max BIGINT,task_lease_batch_size BIGINT,task_lease_seconds BIGINT,max_domain_leases BIGINT,client_body_window BIGINT,client_body_max_bytes BIGINT,client_body_mime_types TEXT,client_body_3p_only BOOLEAN,client_body_spool_dir TEXT,client_max_links BIGINT,client_scroll_strategy TEXT,client_scroll_max_depth BIGINT,client_scroll_max_seconds REAL,client_crawl_tabs BIGINT,client_lean_mode BOOLEAN,client_lean_resource_types TEXT);
 ------------------
 --- TASK_QUEUE ---
 ------------------
@@ -56,15 +77,22 @@ CREATE TABLE config(client_browser_type TEXT,client_prewait BIGINT,client_no_eve
 -- 	target TEXT,
 -- 	target_md5 TEXT,
 -- 	task TEXT,
+-- 	domain TEXT,
+-- 	domain_rank BIGINT DEFAULT 0,
 -- 	client_id TEXT,
 -- 	attempts BIGINT DEFAULT 0,
 -- 	locked BOOLEAN DEFAULT FALSE,
 -- 	failed BOOLEAN DEFAULT FALSE,
 -- 	added TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
 -- 	modified TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+-- 	lease_expires TIMESTAMPTZ,
+-- 	lease_token TEXT,
+-- 	not_before TIMESTAMPTZ,
 -- 	UNIQUE (target_md5, task)
 -- );
-CREATE TABLE task_queue(id BIGSERIAL PRIMARY KEY,target TEXT,target_md5 TEXT,task TEXT,client_id TEXT,attempts BIGINT DEFAULT 0,locked BOOLEAN DEFAULT FALSE,failed BOOLEAN DEFAULT FALSE,added TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,modified TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,UNIQUE (target_md5, task));
+CREATE TABLE task_queue(id BIGSERIAL PRIMARY KEY,target TEXT,target_md5 TEXT,task TEXT,domain TEXT,domain_rank BIGINT DEFAULT 0,client_id TEXT,attempts BIGINT DEFAULT 0,locked BOOLEAN DEFAULT FALSE,failed BOOLEAN DEFAULT FALSE,added TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,modified TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,lease_expires TIMESTAMPTZ,lease_token TEXT,not_before TIMESTAMPTZ,UNIQUE (target_md5, task));
+CREATE INDEX index_task_queue_claim ON task_queue (attempts, domain_rank, not_before) WHERE locked IS NOT TRUE AND failed IS NOT TRUE;
+CREATE INDEX index_task_queue_leased ON task_queue (domain) WHERE locked IS TRUE;
 ---------------------
 --- DOMAIN OWNER  ---
 ---------------------
@@ -103,7 +131,7 @@ CREATE TABLE domain_owner(id TEXT PRIMARY KEY UNIQUE,parent_id TEXT,name TEXT,al
 CREATE TABLE domain(id BIGSERIAL PRIMARY KEY,fqdn_md5 TEXT UNIQUE,fqdn TEXT,domain_md5 TEXT,domain TEXT,pubsuffix_md5 TEXT,pubsuffix TEXT,tld_md5 TEXT,tld TEXT,is_tracker_domain BOOLEAN DEFAULT FALSE,domain_owner_id TEXT REFERENCES domain_owner(id));
 -- CREATE INDEX index_domain_owner_id 		ON domain (domain_owner_id);
 -- CREATE INDEX index_domain_fqdn_md5		ON domain (fqdn_md5);
--- CREATE INDEX index_domain_domain_md5	ON domain (domain_md5);
+CREATE INDEX index_domain_domain_md5	ON domain (domain_md5);
 -- CREATE INDEX index_domain_domain 	ON domain USING GIN(domain gin_trgm_ops);
 -- CREATE INDEX index_domain_fqdn 		ON domain USING GIN(domain gin_trgm_ops);
 ----------------------
@@ -178,7 +206,7 @@ CREATE INDEX index_page_crawl_id 				ON page(crawl_id);
 CREATE INDEX index_page_title 					ON page USING GIN(title gin_trgm_ops);
 CREATE INDEX index_page_meta_desc 				ON page USING GIN(meta_desc gin_trgm_ops);
 -- CREATE INDEX index_page_start_url_md5 			ON page(start_url_md5);
--- CREATE INDEX index_page_start_url_domain_id 	ON page(start_url_domain_id);
+CREATE INDEX index_page_start_url_domain_id 	ON page(start_url_domain_id);
 -- CREATE INDEX index_page_final_url_md5 			ON page(final_url_md5);
 -- CREATE INDEX index_page_final_url_domain_id 	ON page(final_url_domain_id);
 -- CREATE INDEX index_page_page_text_id 			ON page(page_text_id);
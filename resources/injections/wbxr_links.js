@@ -1,16 +1,43 @@
-// extract all links on page
-var wbxr_links = (function () {
+// extract links on page, we only return unique http(s) links and
+//	clean them up here so python has less to do.  the href has
+//	any trailing '#' and then '/' removed, and whitespace in the
+//	text is collapsed.  if max_links is set we stop collecting
+//	once we have that many.  host_link_counts counts every http(s)
+//	link on the page by host, duplicates and links past max_links
+//	included, so the number of internal links is the same as it
+//	was before we deduplicated.
+function wbxr_get_links(max_links) {
 	var wbxr_processed_links = [];
-	var wbxr_links 			 = 
-document.links;
+	var wbxr_host_link_counts = {};
+	var wbxr_seen_links		 = new Set();
+	var wbxr_links 			 = document.links;
 	for (var wbxr_i = 0; wbxr_i < wbxr_links.length; wbxr_i++) {
+		var wbxr_link = wbxr_links[wbxr_i];
+		if (!wbxr_link.href || wbxr_link.protocol.slice(0,4) != 'http') continue;
+
+		var wbxr_href = wbxr_link.href.trim();
+		if (wbxr_href.slice(-1) == '#') wbxr_href = wbxr_href.slice(0,-1);
+		if (wbxr_href.slice(-1) == '/') wbxr_href = wbxr_href.slice(0,-1);
+		if (wbxr_href.length == 0) continue;
+
+		wbxr_host_link_counts[wbxr_link.hostname] = (wbxr_host_link_counts[wbxr_link.hostname] || 0) + 1;
+		if (max_links && wbxr_processed_links.length >= max_links) continue;
+
+		var wbxr_text = String(wbxr_link.innerText || '').replace(/\s+/g,' ').trim();
+
+		// same href and text is the same link
+		var wbxr_key = wbxr_href + '\n' + wbxr_text;
+		if (wbxr_seen_links.has(wbxr_key)) continue;
+		wbxr_seen_links.add(wbxr_key);
+
 		wbxr_processed_links.push({
-			'text'		  : wbxr_links[wbxr_i]['innerText'],
-			'href'		  : wbxr_links[wbxr_i]['href'],
-			'protocol'	: wbxr_links[wbxr_i]['protocol']
+			'text'	: wbxr_text,
+			'href'	: wbxr_href,
+			'host'	: wbxr_link.hostname
 		});
 	}
-	return (wbxr_processed_links);
-}());
-
-wbxr_links;
+	return ({
+		'links'				: wbxr_processed_links,
+		'host_link_counts'	: wbxr_host_link_counts
+	});
+}
@@ -0,0 +1,27 @@
+// scrolls the page down in small random steps, the way a person
+//	reading it would, so lazy-loaded content gets requested.  this
+//	runs in the page so we don't have to send a devtools command for
+//	every step.  we stop once we have scrolled max_depth pixels or
+//	max_seconds have passed, whichever comes first, a null limit
+//	means we don't stop for that one.
+function wbxr_start_scroll(max_depth, max_seconds) {
+	// only scroll the page itself, not its frames
+	if (window.top !== window) return;
+
+	var wbxr_start_time 	= Date.now();
+	var wbxr_scrolled 		= 0;
+	var wbxr_scroll_timer 	= setInterval(function () {
+		if ((max_depth !== null && wbxr_scrolled >= max_depth) ||
+			(max_seconds !== null && Date.now() - wbxr_start_time >= max_seconds * 1000)) {
+			clearInterval(wbxr_scroll_timer);
+			return;
+		}
+
+		// nothing to scroll until the document has a body
+		if (!document.body) return;
+
+		var wbxr_delta = 10 + Math.floor(Math.random() * 90);
+		window.scrollBy(0, wbxr_delta);
+		wbxr_scrolled += wbxr_delta;
+	}, 50);
+}
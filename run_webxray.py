@@ -44,10 +44,11 @@ if config['database_engine'] == 'sqlite':
 	from webxray.SQLiteDriver import SQLiteDriver
 	sql_driver = SQLiteDriver()
 
-	# pool_size sets how many parellel processes are run
-	#	when using sqlite we set to 1 to avoid issues with
-	#	multiple processes trying to use sqlite.
-	pool_size = 1
+	# pool_size sets how many parellel processes are run,
+	#	sqlite tasks are claimed atomically so we can run
+	#	one process per processor core, set to 1 if you
+	#	have trouble with your sqlite db
+	pool_size = None
 elif config['database_engine'] == 'postgresql':
 	from webxray.PostgreSQLDriver import PostgreSQLDriver
 	sql_driver = PostgreSQLDriver()
@@ -60,6 +61,13 @@ else:
 	print('INVALID DB ENGINE FOR "%s", QUITTING!' % config['database_engine'])
 	quit()
 
+# targets_per_browser sets how many pages each process scans
+#	at once, each page gets its own target in the process's
+#	browser.  raising this gets more throughput for the same
+#	RAM than raising pool_size, but if pages interfere with
+#	each other's timings set it back to 1.
+targets_per_browser = 1
+
 # import our custom utilities
 from webxray.Utilities import Utilities
 utilities = Utilities(db_engine=config['database_engine'])
@@ -360,7 +368,7 @@ def collect(db_name, pages_file_name=None, crawl_file_name=None, task='get_scan'
 	elif task=='get_crawl':
 		build_task_queue(db_name, 'get_crawl', crawl_file_name=crawl_file_name)
 
-	collector.run(task='process_tasks_from_queue', pool_size=pool_size)
+	collector.run(task='process_tasks_from_queue', pool_size=pool_size, targets_per_browser=targets_per_browser)
 
 	# fyi
 	utilities.print_runtime('Data collection', start_time)
@@ -438,7 +446,7 @@ def worker_collect(db_name):
 
 	# the main event
 	collector = Collector(db_name,config['database_engine'],client_id)
-	collector.run(task='process_tasks_from_queue', pool_size=pool_size)
+	collector.run(task='process_tasks_from_queue', pool_size=pool_size, targets_per_browser=targets_per_browser)
 
 	# fyi
 	utilities.print_runtime('Data collection', start_time)
@@ -603,7 +611,7 @@ def run_client():
 
 	"""
 	from webxray.Client import Client
-	client = Client('YOUR_SERVER_URL')
+	client = Client('YOUR_SERVER_URL', targets_per_browser=targets_per_browser)
 	client.run_client()
 # run_client
 
@@ -0,0 +1,352 @@
+import atexit
+import os
+import platform
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+
+# custom webxray libraries
+from webxray.DevToolsClient import DevToolsClient
+
+class ChromeBrowser:
+	"""
+	Launches and owns a single Chrome process which can be shared by
+		many ChromeDriver instances.
+
+	Launching Chrome is expensive (process spawn, boot time, DevTools
+		discovery), so rather than launching a new browser for every
+		task we keep one running and give each ChromeDriver its own
+		target inside a fresh browser context.  Browser contexts do not
+		share cookies, storage, or cache, so each task still starts
+		with a clean profile.
+	"""
+
+	def __init__(self, config, chrome_path=None):
+		# what horrible things have you done so your karma is so low
+		#	you must debug this?
+		self.debug = False
+
+		# unpack config
+		self.incognito	= config['client_incognito']
+		self.headless 	= config['client_headless']
+
+		# we restart the browser after this many browser contexts
+		#	have been created as long-running chrome processes
+		#	tend to slowly leak memory
+		self.max_contexts		= 100
+		self.contexts_created 	= 0
+
+		# number of drivers currently using this browser, it is reserved
+		#	by ChromeBrowserPool before the browser is handed out so it
+		#	is safe to recycle a shared browser once this is back to 0
+		self.active_targets = 0
+
+		# several ChromeDrivers may share this browser from different
+		#	threads so we guard our counters
+		self.lock = threading.Lock()
+
+		# gets set once we have a working connection
+		self.launched = False
+
+		# chrome gets this long to shut down on its own before we
+		#	kill it, and close() only does its work once
+		self.kill_deadline 	= 5
+		self.chrome_process = None
+		self.closed 		= False
+
+		chrome_commands = []
+
+		# we can override the path here
+		if chrome_path:
+			chrome_commands.append(chrome_path)
+		else:
+			# if path is not specified we use the common
+			#	paths for each os
+			if platform.system() == 'Darwin':
+				chrome_commands.append('/Applications/Google Chrome.app/Contents/MacOS/Google Chrome')
+			elif platform.system() == 'Linux':
+				chrome_commands.append('/usr/bin/google-chrome')
+				# make sure chrome doesnt' access for keychain password
+				chrome_commands.append('--password-store=basic')
+			elif platform.system() == 'Windows':
+				chrome_commands.append('start chrome ')
+			else:
+				print('Unable to determine Operating System and therefore cannot guess correct Chrome path, see ChromeBrowser.py for details.')
+				exit()
+
+		# no idea what this actually does in a practical sense, but
+		#	if something breaks we can try it, just leaving inert
+		#	for now
+		#chrome_commands.append('--enable-automation')
+
+		# make sure we can open ws connections
+		chrome_commands.append('--remote-allow-origins=*')
+
+		# chrome picks a free port itself, so concurrent browsers never
+		#	collide, and writes it to DevToolsActivePort in the user data
+		#	dir, which we give each browser its own copy of
+		self.port 			= None
+		self.user_data_dir 	= tempfile.mkdtemp(prefix='wbxr_chrome_')
+		chrome_commands.append('--remote-debugging-port=0')
+		chrome_commands.append(f'--user-data-dir={self.user_data_dir}')
+
+		# sets up blank profile
+		chrome_commands.append('--guest')
+
+		# not sure this really does anything, but appears in various
+		#	examples online and it doesn't hurt anything
+		chrome_commands.append('--disable-gpu')
+
+		# in case you want to do these specific tests
+		if self.incognito: chrome_commands.append('--incognito')
+
+		# set up headless
+		if self.headless: chrome_commands.append('--headless')
+
+		# we don't read anything chrome prints, we only need the
+		#	DevToolsActivePort file.  chrome gets its own process group
+		#	so on close we can kill the renderers and other helper
+		#	processes along with it.
+		try:
+			self.chrome_process = subprocess.Popen(
+				chrome_commands,
+				stderr=subprocess.DEVNULL,
+				stdout=subprocess.DEVNULL,
+				start_new_session=(platform.system() != 'Windows')
+			)
+		except:
+			print('Unable to launch Chrome instance, check that Chrome is installed in the expected location, see ChromeBrowser.py for details.')
+			self.close()
+			return
+
+		# if our process exits without closing us we still don't
+		#	want to leave chrome behind
+		atexit.register(self.close)
+
+		# connect as soon as chrome has the endpoint up rather than
+		#	sleeping for a fixed amount of time
+		browser_ws_addr = self.get_browser_ws_addr()
+		if not browser_ws_addr:
+			print('Failed to find browser devtools ws address.')
+			self.close()
+			return
+
+		if self.debug: print(f'browser devtools connection is {browser_ws_addr}')
+
+		# open the browser-level connection, this is only used
+		#	to create and dispose of targets, page-level traffic
+		#	goes over a connection owned by each ChromeDriver
+		try:
+			self.devtools_client = DevToolsClient(browser_ws_addr)
+		except:
+			print(f'Failed to open {browser_ws_addr}.')
+			self.close()
+			return
+
+		# done
+		self.launched = True
+		return
+	# __init__
+
+	def get_browser_ws_addr(self, timeout=30):
+		"""
+		Chrome writes the port it is listening on, and the path of
+			the browser endpoint, to DevToolsActivePort once DevTools
+			is ready.  We poll for the file and return the browser ws
+			address, or None if chrome exits or never writes it.
+		"""
+		port_file_path = os.path.join(self.user_data_dir, 'DevToolsActivePort')
+		give_up_time = time.time() + timeout
+		while time.time() < give_up_time:
+			# chrome failed to start
+			if self.chrome_process.poll() != None: return None
+
+			try:
+				with open(port_file_path, 'r') as port_file:
+					lines = port_file.read().split()
+			except:
+				lines = []
+
+			# the file may exist before both lines are written
+			if len(lines) >= 2:
+				self.port = int(lines[0])
+				return f'ws://localhost:{self.port}{lines[1]}'
+
+			time.sleep(0.01)
+		return None
+	# get_browser_ws_addr
+
+	def get_single_ws_response(self,method,params=''):
+		"""
+		Send a command over the browser-level connection and return the
+			matching response, handles crashes gracefully.
+		"""
+		try:
+			response = self.devtools_client.get_response(method,params,timeout=3)
+		except:
+			response = None
+
+		if response == None:
+			return ({
+				'success'	: False,
+				'result'	: 'Crashed on get_single_ws_response.'
+			})
+
+		if 'result' not in response:
+			return ({
+				'success'	: False,
+				'result'	: f'No result for {method}: {response}'
+			})
+
+		return ({
+			'success'	: True,
+			'result'	: response['result']
+		})
+	# get_single_ws_response
+
+	def create_target(self, browser_context_id=None):
+		"""
+		Creates a new page target.  Unless we are given a browser_context_id
+			the target is placed in a new browser context, which gives it a
+			clean profile.  Returns the ids we need to connect to and later
+			dispose of the target.
+		"""
+
+		if not self.launched:
+			return ({
+				'success'	: False,
+				'result'	: 'Browser is not running.'
+			})
+
+		# new context means new cookies/storage/cache
+		owns_context = False
+		if not browser_context_id:
+			response = self.get_single_ws_response('Target.createBrowserContext')
+			if response['success'] == False: return response
+			browser_context_id = response['result']['browserContextId']
+			owns_context = True
+			with self.lock: self.contexts_created += 1
+
+		response = self.get_single_ws_response('Target.createTarget','"url":"about:blank","browserContextId":"%s"' % browser_context_id)
+		if response['success'] == False:
+			# nobody else knows about a context we just made
+			if owns_context:
+				self.get_single_ws_response('Target.disposeBrowserContext','"browserContextId":"%s"' % browser_context_id)
+			return response
+		target_id = response['result']['targetId']
+
+		if self.debug: print(f'created target {target_id} in context {browser_context_id}')
+
+		return ({
+			'success'	: True,
+			'result'	: {
+				'target_id'				: target_id,
+				'browser_context_id'	: browser_context_id,
+				'ws_addr'				: f'ws://localhost:{self.port}/devtools/page/{target_id}'
+			}
+		})
+	# create_target
+
+	def close_target(self, target_id, browser_context_id=None):
+		"""
+		Closes the target, and if given the browser_context_id, disposes
+			of the context as well so the profile data is thrown away.
+		"""
+		if not self.launched: return
+
+		self.get_single_ws_response('Target.closeTarget','"targetId":"%s"' % target_id)
+		if browser_context_id:
+			self.get_single_ws_response('Target.disposeBrowserContext','"browserContextId":"%s"' % browser_context_id)
+	# close_target
+
+	def reserve_target(self):
+		"""
+		Counts a driver which is about to use this browser, so it isn't
+			closed from under it, see ChromeBrowserPool.
+		"""
+		with self.lock: self.active_targets += 1
+	# reserve_target
+
+	def release_target(self):
+		"""
+		The driver which reserved a target is done with this browser.
+		"""
+		with self.lock: self.active_targets -= 1
+	# release_target
+
+	def is_usable(self):
+		"""
+		Determines if we can keep giving out targets from this browser, if
+			not the caller should close it and launch a new one.
+		"""
+		if not self.launched: return False
+
+		# chrome has died
+		if self.chrome_process.poll() != None: return False
+
+		# time to recycle
+		if self.contexts_created >= self.max_contexts: return False
+
+		# make sure the browser is still responding
+		if self.get_single_ws_response('Browser.getVersion')['success'] == False: return False
+
+		return True
+	# is_usable
+
+	def close(self):
+		"""
+		Tidy things up before exiting, including the profile
+			directory chrome was using.
+		"""
+		if self.closed: return
+		self.closed = True
+
+		if self.launched:
+			try:
+				self.devtools_client.send_command('Browser.close')
+			except:
+				pass
+			self.devtools_client.close()
+			self.launched = False
+
+		if self.chrome_process:
+			# give chrome a chance to exit cleanly, if it is hung or
+			#	the socket is dead ask again with SIGTERM and then
+			#	stop asking
+			try:
+				self.chrome_process.wait(timeout=self.kill_deadline)
+			except subprocess.TimeoutExpired:
+				self.kill_process_group(signal.SIGTERM)
+				try:
+					self.chrome_process.wait(timeout=self.kill_deadline)
+				except subprocess.TimeoutExpired:
+					self.kill_process_group(signal.SIGKILL)
+					self.chrome_process.wait()
+
+			# renderers may outlive the browser process
+			self.kill_process_group(signal.SIGKILL)
+			atexit.unregister(self.close)
+
+		# chrome is gone so nothing is writing to the profile
+		shutil.rmtree(self.user_data_dir, ignore_errors=True)
+	# close
+
+	def kill_process_group(self, sig):
+		"""
+		Sends sig to chrome and all the processes it started, on
+			Windows we can only kill chrome itself.
+		"""
+		try:
+			if hasattr(os, 'killpg'):
+				os.killpg(self.chrome_process.pid, sig)
+			else:
+				self.chrome_process.kill()
+		except OSError:
+			# everything has exited already
+			pass
+	# kill_process_group
+
+# ChromeBrowser
@@ -0,0 +1,105 @@
+import threading
+import time
+
+# custom webxray libraries
+from webxray.ChromeBrowser import ChromeBrowser
+
+class ChromeBrowserPool:
+	"""
+	Each worker process keeps a pool with a long-lived Chrome process which
+		is handed out to every ChromeDriver the worker creates.  When a worker
+		runs several scan threads they all share the same browser, each with
+		their own target, so we get more parallel scans for the same RAM.
+
+	When the browser dies or needs to be recycled we launch a replacement
+		right away, every browser gets its own port so they can run side by
+		side.  The old browser is retired and closed once the scans still
+		using it have finished, or after retire_timeout seconds in case a
+		scan died without giving its target back.
+
+	Every get_browser reserves a target on the browser it returns, and the
+		caller gives it back with release once its driver has exited, so
+		a browser is never closed between being handed out and used.
+	"""
+
+	def __init__(self, config=None):
+		self.config			= config
+		self.browser		= None
+
+		# replaced browsers which still have targets open, along
+		#	with when they were retired
+		self.retired_browsers 	= []
+		self.retire_timeout 	= 1800
+
+		# only one thread may launch/replace the browser at a time
+		self.lock = threading.Lock()
+	# __init__
+
+	def get_browser(self, config=None):
+		"""
+		Returns a usable browser, launching or replacing it if needed.
+			Clients only get their config along with a task, so they
+			may pass it in here, it is used the next time we launch.
+			The caller must release the browser when done with it.
+		"""
+		with self.lock:
+			if config: self.config = config
+
+			if self.browser == None or not self.browser.is_usable():
+				if self.browser: self.retired_browsers.append((self.browser, time.time()))
+				self.browser = ChromeBrowser(self.config)
+
+			self.browser.reserve_target()
+			browser 		= self.browser
+			unused_browsers = self.pop_unused_browsers()
+
+		# closing can take a while, so we don't hold up other threads
+		for unused_browser in unused_browsers: unused_browser.close()
+		return browser
+	# get_browser
+
+	def release(self, browser):
+		"""
+		Gives back the target reserved by get_browser, if the browser
+			has been retired and nobody else is using it we close it.
+		"""
+		with self.lock:
+			browser.release_target()
+			unused_browsers = self.pop_unused_browsers()
+
+		for unused_browser in unused_browsers: unused_browser.close()
+	# release
+
+	def pop_unused_browsers(self):
+		"""
+		Takes retired browsers nobody is using any more off our list
+			and returns them, the caller must hold the lock and close
+			them once it has let go of it.
+		"""
+		unused_browsers = []
+		for browser, retired_time in list(self.retired_browsers):
+			if (
+				browser.active_targets <= 0 
+				or not browser.launched
+				or browser.chrome_process.poll() != None
+				or time.time() - retired_time > self.retire_timeout
+			):
+				unused_browsers.append(browser)
+				self.retired_browsers.remove((browser, retired_time))
+		return unused_browsers
+	# pop_unused_browsers
+
+	def close(self):
+		"""
+		Tidy things up before exiting.
+		"""
+		with self.lock:
+			browsers = [browser for browser, retired_time in self.retired_browsers]
+			if self.browser: browsers.append(self.browser)
+			self.retired_browsers 	= []
+			self.browser 			= None
+
+		for browser in browsers: browser.close()
+	# close
+
+# ChromeBrowserPool
@@ -1,47 +1,61 @@
 import datetime
+import hashlib
 import json
 import os
-import platform
+import queue
 import random
 import re
-import subprocess
-import tempfile
+import threading
 import time
-import urllib.request
-
-# websocket-client library is needed to talk to chrome devtools
-# 	the github repo for library is here:
-#		https://github.com/websocket-client/websocket-client
-# pip3 install websocket-client
-from websocket import create_connection
 
 # standard python packages
+from concurrent.futures import wait, FIRST_COMPLETED
 from urllib.parse import urlsplit
 from urllib.parse import urlunsplit
 
 # custom webxray libraries
+from webxray.ChromeBrowser import ChromeBrowser
+from webxray.DevToolsClient import DevToolsClient
 from webxray.ParseURL  import ParseURL
 
 class ChromeDriver:
-	def __init__(self, config, port_offset=0, chrome_path=None):
+	# path -> contents of the js files we inject, shared by every
+	#	ChromeDriver in the process so we only read each file once
+	script_cache = {}
+
+	def __init__(self, config, chrome_path=None, browser=None, browser_context_id=None):
 		# what horrible things have you done so your karma is so low
 		#	you must debug this?
 		self.debug = False
 		
-		# unpack config
+		# unpack config, we keep the whole thing to set up tabs
+		self.config 				= config
 		if self.debug: print(config)
 		self.prewait				= config['client_prewait']
 		self.no_event_wait 			= config['client_no_event_wait']
 		self.max_wait 				= config['client_max_wait']
+		self.network_idle_wait		= config['client_network_idle_wait']
 		self.return_page_text 		= config['client_get_text']
 		self.return_bodies 			= config['client_get_bodies']
 		self.return_bodies_base64 	= config['client_get_bodies_b64']
+		self.body_window			= config['client_body_window']
+		self.body_max_bytes			= config['client_body_max_bytes']
+		self.body_mime_types		= config['client_body_mime_types']
+		self.body_3p_only			= config['client_body_3p_only']
+		self.body_spool_dir			= config['client_body_spool_dir']
 		self.return_screen_shot 	= config['client_get_screen_shot']
 		self.reject_redirects		= config['client_reject_redirects']
 		self.crawl_depth 			= config['client_crawl_depth']
 		self.crawl_retries 			= config['client_crawl_retries']
+		self.crawl_tabs				= config['client_crawl_tabs']
 		self.page_load_strategy		= config['client_page_load_strategy']
 		self.min_internal_links		= config['client_min_internal_links']
+		self.max_links				= config['client_max_links']
+		self.scroll_strategy		= config['client_scroll_strategy']
+		self.scroll_max_depth		= self.get_scroll_limit(config, 'client_scroll_max_depth')
+		self.scroll_max_seconds		= self.get_scroll_limit(config, 'client_scroll_max_seconds')
+		self.lean_mode				= config['client_lean_mode']
+		self.lean_resource_types	= config['client_lean_resource_types']
 		self.incognito				= config['client_incognito']
 		self.headless 				= config['client_headless']
 
@@ -52,6 +66,18 @@ class ChromeDriver:
 		#	when we are doing a crawl
 		self.is_crawl = False
 
+		# set once set_up_session has enabled the domains we need on
+		#	our target
+		self.session_ready = False
+
+		# identifier of our scroll script while it is registered on
+		#	the target, None otherwise
+		self.scroll_script_id = None
+
+		# network request ids of responses whose body we replaced in
+		#	lean mode, there is no point getting these bodies
+		self.stubbed_request_ids = set()
+
 		# gets overwritten once, so we don't have to keep
 		#	figuring it out when doing crawls
 		self.browser_type		= None
@@ -61,151 +87,49 @@ class ChromeDriver:
 		# list of files in ./injections we want to execute
 		self.injections			= config['client_injections']
 
-		chrome_commands = []
+		# how long we wait on a response to a single command
+		self.ws_timeout			= 3
 
-		# we can override the path here
-		if chrome_path:
-			chrome_cmd = chrome_cmd
+		# we either use a browser we have been given, which is how
+		#	workers keep a warm browser between tasks, or launch our
+		#	own which we close when we exit
+		if browser:
+			self.browser 		= browser
+			self.owns_browser	= False
 		else:
-			# if path is not specified we use the common
-			#	paths for each os
-			if platform.system() == 'Darwin':
-				chrome_commands.append('/Applications/Google Chrome.app/Contents/MacOS/Google Chrome')
-			elif platform.system() == 'Linux':
-				chrome_commands.append('/usr/bin/google-chrome')
-				# make sure chrome doesnt' access for keychain password
-				chrome_commands.append('--password-store=basic')
-			elif platform.system() == 'Windows':
-				chrome_cmd = 'start chrome '
-			else:
-				print('Unable to determine Operating System and therefore cannot guess correct Chrome path, see ChromeDriver.py for details.')
-				exit()
-		
-		# no idea what this actually does in a practical sense, but
-		#	if something breaks we can try it, just leaving inert
-		#	for now
-		#chrome_commands.append('--enable-automation')
-
-		# make sure we can open ws connections
-		chrome_commands.append('--remote-allow-origins=*')
-
-		# use port offset to avoid collissions between processes
-		#	note that if two single scan processes are running they may
-		#	end up using the same connection and bad things will
-		#	happen
-		port = 9222+port_offset
-		chrome_commands.append(f'--remote-debugging-port={port}')
-
-		# sets up blank profile
-		chrome_commands.append('--guest')
-
-		# not sure this really does anything, but appears in various
-		#	examples online and it doesn't hurt anything
-		chrome_commands.append('--disable-gpu')
-
-		# in case you want to do these specific tests
-		if self.incognito: chrome_commands.append('--incognito')
-
-		# set up headless
-		if self.headless: chrome_commands.append('--headless')
-
-		# now things get a bit weird, sometime around 110.0.5481.77
-		#	the normal means of getting the devtools websocket address
-		#	from http://localhost:port/json stopped working in headless.
-		#
-		# this turned out ot be a real pain in the ass, but I figured
-		#	out an even lower-level work around which works as follows:
-		#		1) pull the raw connection address from stderr
-		#		2) connect to that
-		#		3) from there create a new 'target' in chrome
-		#		4) close the 'raw' websocket
-		#		5) open a new websocket with the fresh target_id
-		#
-		# if the above is confusing don't worry about it, just know
-		#	it works and there are ways to go deeper into the guts
-		#	than the typical /json means
-
-		# open subprocess with stderr directed to a tempfile, this is
-		#	where we pull out the address.  note this is a hack so
-		#	we can continue execution after we launch the browser,
-		#	using the typical PIPE approach gets us stuck.
-
-		with tempfile.NamedTemporaryFile(mode="w", delete=False) as outfile:
-			subprocess.Popen(
-				chrome_commands, 
-				stderr=outfile, 
-				stdout=None
-			)
-			self.launched = True
-
-		# before we run additional commands we give the browser some time 
-		#	to boot
-		time.sleep(2)
-
-		# if all things are working as they should, we can read the chrome debugger
-		#	address from the following url, if we can't that means chrome
-		#	never created a target, so we have to do that manually, which is a major
-		#	chore.  I hope this is a temporary bug and we can remove this at some point
-		try:
-			debugger_ws_addr = json.loads(urllib.request.urlopen(f'http://localhost:{port}/json').read().decode())[0]['webSocketDebuggerUrl']
-		except:
-			# there is a line in stderr which has the devtools address, we have to find it
-			#	or we fail
-			raw_devtools_ws = None
-			with open(outfile.name, "r") as outfile:
-				# find the line we're looking for
-				for line in outfile.readlines():
-					if 'DevTools' in line:
-						raw_devtools_ws = line.replace('DevTools listening on ','')
-						break
-
-			if not raw_devtools_ws:
-				print('Failed to find raw devtools ws address.')
-				self.exit()
-				return
-
-			if self.debug: print(f'raw devtools connection is {raw_devtools_ws}')
+			self.browser 		= ChromeBrowser(config, chrome_path=chrome_path)
+			self.owns_browser	= True
 
-			if self.debug: print('attempting to create target in chrome')
+		# gets set once we have a connection to our own target
+		self.launched = False
 
-			# open a devtools_connect to the raw_devtools_ws
-			try:
-				self.current_ws_command_id = 0
-				self.devtools_connection = create_connection(raw_devtools_ws)
-				self.devtools_connection.settimeout(3)
-			except:
-				print(f'Failed to open {raw_devtools_ws}, potentially stale copies of Chrome open.  Kill them.')
-				self.exit()
-				return
-
-			# now we create the target which we really want to connect to
-			response = self.get_single_ws_response('Target.createTarget','"url":""')
-			if response['success'] == False:
-				self.exit()
-				print('Target.createTarget failed.')
-				return
-			else:
-				response = response['result']
-			if self.debug: print(f'{response}')
-
-			# pull out the new target_id and create a new connection
-			try:
-				debugger_ws_addr = json.loads(urllib.request.urlopen(f'http://localhost:{port}/json').read().decode())[0]['webSocketDebuggerUrl']
-			except:
-				print('Failed get to debugger address.')
-				return
+		if not self.browser.launched:
+			print('Failed to launch Chrome.')
+			return
 
-			# close the low-level connection
-			self.devtools_connection.close()
+		# each driver gets its own target in a fresh browser context, this
+		#	gives us a clean profile without launching a new browser.  crawl
+		#	tabs are given the context of the driver which made them and
+		#	leave it to that driver to dispose of.
+		self.owns_context = (browser_context_id == None)
+		response = self.browser.create_target(browser_context_id=browser_context_id)
+		if response['success'] == False:
+			print(f"Failed to create target: {response['result']}")
+			if self.owns_browser: self.browser.close()
+			return
+		else:
+			self.target_id 			= response['result']['target_id']
+			self.browser_context_id = response['result']['browser_context_id']
+			debugger_ws_addr 		= response['result']['ws_addr']
 
 		# try to open our intended ws connection
 		try:
-			self.current_ws_command_id = 0
-			self.devtools_connection = create_connection(debugger_ws_addr)
-			self.devtools_connection.settimeout(3)
+			self.devtools_client = DevToolsClient(debugger_ws_addr)
+			self.launched = True
 		except:
 			print(f'Failed to open {debugger_ws_addr}, potentially stale copies of Chrome open.  Kill them.')
-			self.exit()
+			self.browser.close_target(self.target_id, self.browser_context_id if self.owns_context else None)
+			if self.owns_browser: self.browser.close()
 			return
 
 		# prevent downloading files, the /dev/null is redundant
@@ -224,34 +148,35 @@ class ChromeDriver:
 
 	def get_single_ws_response(self,method,params=''):
 		"""
-		Attempt to send ws_command and return response, note this only works
-			if you don't have the queue being flooded with network events,
+		Attempt to send ws_command and return the matching response,
 			handles crashes gracefully.
 		"""
-		self.current_ws_command_id += 1
 		try:
-			self.devtools_connection.send('{"id":%s,"method":"%s","params":{%s}}' % (self.current_ws_command_id,method,params))
-			return ({
-				'success'	: True,
-				'result'	: json.loads(self.devtools_connection.recv())
-			})
+			response = self.devtools_client.get_response(method,params,timeout=self.ws_timeout)
 		except:
+			response = None
+
+		if response == None:
 			return ({
 				'success'	: False,
 				'result'	: 'Crashed on get_single_ws_response.'
 			})
+
+		return ({
+			'success'	: True,
+			'result'	: response
+		})
 	# get_single_ws_response
 
-	def send_ws_command(self,method,params='',override_id=None):
+	def send_ws_command(self,method,params=''):
 		"""
-		Attempt to send ws_command, handle crashes gracefully.
+		Attempt to send ws_command, handle crashes gracefully.  The
+			result is a Future which will hold the response.
 		"""
-		self.current_ws_command_id += 1
 		try:
-			self.devtools_connection.send('{"id":%s,"method":"%s","params":{%s}}' % (self.current_ws_command_id,method,params))
 			return ({
 				'success'	: True,
-				'result'	: self.current_ws_command_id
+				'result'	: self.devtools_client.send_command(method,params)
 			})
 		except:
 			return ({
@@ -260,15 +185,12 @@ class ChromeDriver:
 			})
 	# send_ws_command
 
-	def get_next_ws_response(self):
+	def get_next_ws_response(self,timeout=None):
 		"""
-		Either get the next ws response or send None on 
+		Either get the next ws event or send None on 
 			timeout or crash.
 		"""
-		try:
-			return json.loads(self.devtools_connection.recv())
-		except:
-			return None
+		return self.devtools_client.get_next_event(timeout=timeout)
 	# get_next_ws_response
 
 	def exit(self):
@@ -277,15 +199,25 @@ class ChromeDriver:
 
 		"""
 		if self.launched:
-			self.send_ws_command('Browser.close')
-			self.devtools_connection.close()
+			self.devtools_client.close()
+
+			# throw away the target and its browser context, if we
+			#	launched the browser ourselves we close it as well
+			self.browser.close_target(self.target_id, self.browser_context_id if self.owns_context else None)
+			if self.owns_browser: self.browser.close()
+
+			# makes repeated calls to exit harmless
+			self.launched = False
 	# exit
 
-	def get_crawl(self, url_list):
+	def get_crawl(self, url_list, progress_callback=None):
 		"""
 		Performs multiple page loads using the same profile,
 			which allows cookies to be transferred across loads
 			and potentially allow for more tracking.
+
+		If given, progress_callback is called after each page load,
+			the caller uses this to renew its lease on the task.
 		"""
 
 		if self.debug: print('Running get_crawl task.')
@@ -301,6 +233,7 @@ class ChromeDriver:
 		# do each url
 		for url in url_list:
 			result = self.get_scan(url)
+			if progress_callback: progress_callback()
 			if result['success']:
 				results.append(result['result'])
 			else:
@@ -321,7 +254,7 @@ class ChromeDriver:
 		})
 	# get_crawl
 
-	def get_random_crawl(self, seed_url):
+	def get_random_crawl(self, seed_url, progress_callback=None):
 		"""
 		Based on an intial seed page conducts a first scan to
 			get traffic and links, then loads additional pages
@@ -331,6 +264,14 @@ class ChromeDriver:
 			not allow any domain-level redirects on page loads as this
 			would skew our ability to categorize cookies as first
 			or third-party.
+
+		If given, progress_callback is called after each page load,
+			the caller uses this to renew its lease on the task.
+
+		Once the seed page is scanned, if client_crawl_tabs is more than
+			one we load that many pages at once, each in its own tab in
+			our browser context.  Results are ordered by when their load
+			started.
 		"""
 
 		if self.debug: print('Running get_random_crawl task.')
@@ -348,6 +289,7 @@ class ChromeDriver:
 
 		if self.debug: print(f'going to scan seed_url {seed_url}')
 		result = self.get_scan(seed_url)
+		if progress_callback: progress_callback()
 
 		if not result['success']:
 			self.exit()
@@ -402,36 +344,109 @@ class ChromeDriver:
 		#	we must give up
 		failed_urls = []
 
-		# keep scanning pages until we've done enough
-		for url in unique_urls:
-
-			# if we have enough results break
-			if len(scanned_urls) == self.crawl_depth: break
-
-			# give up!
-			if len(failed_urls) > self.crawl_retries:
-				self.exit()
-				return ({
-					'success'	: False,
-					'result'	: 'reached fail limit'
-				})
+		# pages load in crawl_tabs tabs at once, each in our browser context
+		#	so they share cookies with the seed page.  we keep our own target
+		#	out of it, if a scan fails get_scan exits the driver, which for
+		#	us would throw away the context the tabs are using.
+		tab_drivers = []
+		if self.crawl_tabs and self.crawl_tabs > 1:
+			for i in range(0,self.crawl_tabs):
+				tab_driver = ChromeDriver(self.config, browser=self.browser, browser_context_id=self.browser_context_id)
+				if tab_driver.launched:
+					tab_driver.is_crawl = True
+					tab_drivers.append(tab_driver)
+		if len(tab_drivers) == 0: tab_drivers = [self]
+
+		# tabs take urls from here, results are kept with the order in
+		#	which their page load started so crawl_sequence is the same
+		#	however the loads finish
+		crawl_lock 			= threading.Lock()
+		url_iter 			= iter(unique_urls)
+		pages_needed 		= self.crawl_depth - len(scanned_urls)
+		pages_started 		= 0
+		pages_in_flight 	= 0
+		sequenced_results 	= []
+
+		# tabs tell us here when a page is done, we call progress_callback
+		#	from this thread as the caller's db connection belongs to it
+		page_done_queue = queue.Queue()
+
+		def crawl_in_tab(tab_driver):
+			nonlocal pages_started, pages_in_flight
+
+			# we always have to say we're done, or we wait forever
+			try:
+				while tab_driver.launched:
+					with crawl_lock:
+						# we have enough results, or will once in-flight loads finish
+						if len(sequenced_results) + pages_in_flight >= pages_needed: break
+
+						# give up!
+						if len(failed_urls) > self.crawl_retries: break
+
+						url = next(url_iter, None)
+						if url == None: break
+
+						sequence 		= pages_started
+						pages_started 	+= 1
+						pages_in_flight += 1
+
+					# do the scan
+					result = tab_driver.get_scan(url)
+
+					with crawl_lock:
+						pages_in_flight -= 1
+
+						# either keep result or keep track of failures
+						if result['success']:
+							# reject redirects based on origin_url
+							is_redirect = self.is_url_internal(origin_url,result['result']['final_url'])
+							if is_redirect == None or is_redirect == False:
+								if self.debug: print(f"caught redirect from {url} to {result['result']['final_url']}")
+								failed_urls.append(url)
+							else:
+								sequenced_results.append((sequence, result['result']))
+								scanned_urls.append(url)
+						else:
+							if self.debug: print(f"fail on {result['result']}")
+							failed_urls.append(url)
+
+					page_done_queue.put(True)
+			finally:
+				page_done_queue.put(None)
+		# crawl_in_tab
+
+		tab_threads = []
+		for tab_driver in tab_drivers:
+			tab_thread = threading.Thread(target=crawl_in_tab, args=(tab_driver,))
+			tab_thread.start()
+			tab_threads.append(tab_thread)
+
+		# each tab sends None once it is done
+		tabs_running = len(tab_threads)
+		while tabs_running > 0:
+			if page_done_queue.get() == None:
+				tabs_running -= 1
+			elif progress_callback:
+				progress_callback()
+
+		for tab_thread in tab_threads:
+			tab_thread.join()
+
+		# only the extra tabs are closed here, we are closed below
+		for tab_driver in tab_drivers:
+			if tab_driver != self: tab_driver.exit()
+
+		# give up!
+		if len(failed_urls) > self.crawl_retries:
+			self.exit()
+			return ({
+				'success'	: False,
+				'result'	: 'reached fail limit'
+			})
 
-			# do the scan
-			result = self.get_scan(url)
-
-			# either keep result or keep track of failures
-			if result['success']:
-				# reject redirects based on origin_url
-				is_redirect = self.is_url_internal(origin_url,result['result']['final_url'])
-				if is_redirect == None or is_redirect == False:
-					if self.debug: print(f"caught redirect from {url} to {result['result']['final_url']}")
-					failed_urls.append(url)
-				else:
-					results.append(result['result'])
-					scanned_urls.append(url)
-			else:
-				if self.debug: print(f"fail on {result['result']}")
-				failed_urls.append(url)
+		for sequence, result in sorted(sequenced_results, key=lambda sequenced_result: sequenced_result[0]):
+			results.append(result)
 
 		if self.debug: 
 			print('crawled urls:')
@@ -455,6 +470,113 @@ class ChromeDriver:
 			})
 	# get_random_crawl
 
+	def set_up_session(self):
+		"""
+		Enables the devtools domains get_scan needs on our target and
+			registers the scroll script.  This only has to happen once
+			per target, so crawls don't pay for it on every page.
+		"""
+		# get browser version and user agent, the browser is shared
+		#	so we only need to do this once
+		if not self.browser_type:
+			if self.debug: print('going to get browser version')
+			response = self.get_single_ws_response('Browser.getVersion')
+			if response['success'] == False:
+				return response
+			elif 'result' not in response['result']:
+				return ({
+					'success': False,
+					'result': 'No result for ws command'
+				})
+			else:
+				response = response['result']
+			if self.debug: print(f'ws response: {response}')
+
+			self.browser_type		= re.match('^(.+)?/(.+)$',response['result']['product'])[1]
+			self.browser_version 	= re.match('^(.+)?/(.+)$',response['result']['product'])[2]
+			self.user_agent			= response['result']['userAgent']
+
+		# remove 'Headless' from the user_agent
+		if self.headless:
+			response = self.get_single_ws_response('Network.setUserAgentOverride','"userAgent":"%s"' % self.user_agent.replace('Headless',''))
+			if response['success'] == False:
+				return response
+			elif 'result' not in response['result']:
+				return ({
+					'success': False,
+					'result': 'No result for ws command'
+				})
+			else:
+				response = response['result']
+			if self.debug: print(f'ws response: {response}')
+
+		# enable network and domstorage when doing a network_log
+		if self.debug: print('going to enable network logging')
+		response = self.get_single_ws_response('Network.enable')
+
+		if response['success'] == False:
+			return response
+		elif 'result' not in response['result']:
+			return ({
+				'success': False,
+				'result': 'No result for ws command'
+			})
+		else:
+			response = response['result']
+		if self.debug: print(f'ws response: {response}')
+
+		if self.debug: print('going to enable domstorage logging')
+		response = self.get_single_ws_response('DOMStorage.enable')
+		if response['success'] == False:
+			return response
+		else:
+			response = response['result']
+		if self.debug: print(f'ws response: {response}')
+
+		if self.debug: print('going to enable IndexedDB logging')
+		response = self.get_single_ws_response('IndexedDB.enable')
+		if response['success'] == False:
+			return response
+		else:
+			response = response['result']
+		if self.debug: print(f'ws response: {response}')
+
+		if self.debug: print('going to disable cache')
+		response = self.get_single_ws_response('Network.setCacheDisabled','"cacheDisabled":true')
+		if response['success'] == False:
+			return response
+		else:
+			response = response['result']
+		if self.debug: print(f'ws response: {response}')
+
+		# lifecycle events tell us when chrome considers the page
+		#	to be network idle, used to end the scan early
+		if self.network_idle_wait:
+			if self.debug: print('going to enable lifecycle events')
+			response = self.get_single_ws_response('Page.enable')
+			if response['success'] == False:
+				return response
+
+			response = self.get_single_ws_response('Page.setLifecycleEventsEnabled','"enabled":true')
+			if response['success'] == False:
+				return response
+			else:
+				response = response['result']
+			if self.debug: print(f'ws response: {response}')
+
+		# in lean mode we answer requests for heavy resources ourselves once
+		#	we have the real response headers
+		if self.lean_mode:
+			response = self.enable_lean_mode()
+			if response['success'] == False: return response
+
+		self.session_ready = True
+		return ({
+			'success'	: True,
+			'result'	: None
+		})
+	# set_up_session
+
 	def get_scan(self, url, get_text_only=False):
 		"""
 		The primary function for this class, performs a number of tasks based on the config
@@ -496,14 +618,19 @@ class ChromeDriver:
 		# Response bodies are keyed to the request_id when they are
 		#	returned to calling function, and we get the response bodies
 		#	by issuing websocket commands so we we first keep track
-		#	of which command is linked to which ws_id.  Note this data is
+		#	of which command is linked to which future.  Note this data is
 		#	for internal processes and not returned
-		ws_id_to_req_id = {}
+		future_to_req_id = {}
 
 		# When we get the websocket response we stored the body keyed
-		#	to the request id, this is returned
+		#	to the request id, this is returned.  If we have a spool dir
+		#	the body is written there and we only return where to find it.
 		response_bodies = {}
 
+		# request ids of bodies we still need to ask for, we only keep
+		#	body_window requests for bodies in flight at once
+		body_request_ids = []
+
 		# We keep dom_storage here, the dict key is a tuple of the securityOrigin
 		# 	isLocalStorage, and the domstorage key. This way we can keep only final 
 		#	values in cases they are overwritten.  Note this data is
@@ -529,102 +656,42 @@ class ChromeDriver:
 		#	in seconds since an arbitrary point in the past."  What this means is they are
 		#	essentially offsets (deltas) and not real timestamps.  However, the Network.requestWillBeSent
 		#	also has a "wallTime" which is a UNIX timestamp.  So what we do below is set the
-		#	origin_walltime which to be the earliest wallTime we've seen as this allow us to later
+		#	origin_walltime to be the wallTime of the first request as this allow us to
 		#	use the "timestamps" to determine the real-world time when an event happened.
+		#	Events are fixed as they come in, anything we get before the first request
+		#	waits in unfixed_events.
 		origin_walltime  = None
 		first_timestamp	 = None
+		unfixed_events	 = []
 
-		# keeps track of what ws_id belongs to which type of command, we 
+		# keeps track of what future belongs to which type of command, we 
 		#	remove entries when we get a response
-		pending_ws_id_to_cmd = {}
+		pending_future_to_cmd = {}
 
-		# get browser version and user agent
-		if self.debug: print('going to get browser version')
-		response = self.get_single_ws_response('Browser.getVersion')
-		if response['success'] == False:
-			self.exit()
-			return response
-		elif 'result' not in response['result']:
-			self.exit()
-			return ({
-				'success': False,
-				'result': 'No result for ws command'
-			})
-		else:
-			response = response['result']
-		if self.debug: print(f'ws response: {response}')
-
-		if not self.browser_type:
-			self.browser_type		= re.match('^(.+)?/(.+)$',response['result']['product'])[1]
-			self.browser_version 	= re.match('^(.+)?/(.+)$',response['result']['product'])[2]
-			self.user_agent			= response['result']['userAgent']
-
-		# remove 'Headless' from the user_agent
-		if self.headless:
-			response = self.get_single_ws_response('Network.setUserAgentOverride','"userAgent":"%s"' % self.user_agent.replace('Headless',''))
+		# domains are enabled once per target, when crawling later
+		#	pages skip straight to loading
+		if not self.session_ready:
+			response = self.set_up_session()
 			if response['success'] == False:
 				self.exit()
 				return response
-			elif 'result' not in response['result']:
-				self.exit()
-				return ({
-					'success': False,
-					'result': 'No result for ws command'
-				})
-			else:
-				response = response['result']
-			if self.debug: print(f'ws response: {response}')
 
-		# enable network and domstorage when doing a network_log
-		if self.debug: print('going to enable network logging')
-		response = self.get_single_ws_response('Network.enable')
-
-		if response['success'] == False:
-			self.exit()
-			return response
-		elif 'result' not in response['result']:
-			self.exit()
-			return ({
-				'success': False,
-				'result': 'No result for ws command'
-			})
-		else:
-			response = response['result']
-		if self.debug: print(f'ws response: {response}')
-
-		if self.debug: print('going to enable domstorage logging')
-		response = self.get_single_ws_response('DOMStorage.enable')
-		if response['success'] == False:
-			self.exit()
-			return response
-		else:
-			response = response['result']
-		if self.debug: print(f'ws response: {response}')
-
-		if self.debug: print('going to enable IndexedDB logging')
-		response = self.get_single_ws_response('IndexedDB.enable')
-		if response['success'] == False:
-			self.exit()
-			return response
-		else:
-			response = response['result']
-		if self.debug: print(f'ws response: {response}')
-
-		if self.debug: print('going to disable cache')
-		response = self.get_single_ws_response('Network.setCacheDisabled','"cacheDisabled":true')
-		if response['success'] == False:
-			self.exit()
-			return response
-		else:
-			response = response['result']
-		if self.debug: print(f'ws response: {response}')
+		# the 'script' scroll strategy runs our scroller in every document
+		#	the target loads while this page is loading, including after
+		#	redirects, it is removed again once the page is done
+		if self.scroll_strategy == 'script' and self.scroll_script_id == None:
+			response = self.add_scroll_script()
+			if response['success'] == False:
+				self.exit()
+				return response
+			self.scroll_script_id = response['result']
 
-		# keep track of any/all websocket ids for
-		#	injected scripts
-		injection_ws_ids 	= []
+		# anything still queued belongs to the last page we loaded
+		self.devtools_client.clear_events()
 
-		# this is how we link the result back to the calling script
-		ws_id_to_script 	= {}
+		# this is how we link the result of an injected
+		#	script back to the calling script
+		injection_future_to_script = {}
 
 		# keep results here to return, holds dicts
 		injection_results 	=  []
@@ -645,8 +712,10 @@ class ChromeDriver:
 		# Keep track of how long we've been reading ws data
 		response_loop_start = datetime.datetime.now()
 
-		# Keetp track of when we last saw a Network event
-		time_since_last_response = datetime.datetime.now()
+		# Keep track of when we started waiting for Network events, the
+		#	time of the last one comes from the devtools client as it
+		#	sees events which are filtered out before they reach us
+		network_wait_start = time.time()
 
 		# Length of time since we last saw a Network event
 		elapsed_no_event = 0
@@ -656,9 +725,191 @@ class ChromeDriver:
 		# 	changes (eg 1.99 -> 2.10 = 1 -> 2)
 		last_second = 0
 
+		# how far we have scrolled with the 'dispatch' scroll strategy
+		scroll_depth = 0
+
 		# make sure we don't do this more than once
 		sent_intial_request = False
 
+		# the navigation response tells us the loaderId, which
+		#	we need to match up lifecycle events
+		navigate_future = None
+
+		# requests which have been sent but have not yet finished
+		#	or failed, when this is empty and we haven't seen a
+		#	Network event for network_idle_wait the page is quiet
+		in_flight_requests = set()
+
+		# set when chrome fires the networkIdle lifecycle event
+		#	for our navigation, cleared if new requests go out
+		page_network_idle = False
+
+		######################
+		# NETWORK LOG EVENTS #
+		######################
+
+		# each event we record has a handler below which is given the
+		#	event params, they are dispatched by method from event_handlers
+
+		def handle_request(params):
+			nonlocal origin_walltime, first_timestamp, unfixed_events, page_network_idle
+
+			cleaned_request = self.clean_request(params)
+			cleaned_request['event_order'] = len(requests)
+
+			# redirects re-use the requestId, so this is a no-op for them
+			in_flight_requests.add(params['requestId'])
+			page_network_idle = False
+
+			# set global start time to measure page load time and calculate offsets,
+			#	then fix anything which was waiting on it
+			if first_timestamp == None:
+				origin_walltime = cleaned_request['wall_time']
+				first_timestamp = cleaned_request['timestamp']
+				for event in unfixed_events:
+					self.fix_event_timestamp(event, origin_walltime, first_timestamp, unfixed_events)
+				unfixed_events = []
+
+			# DOCUMENT ME
+			if 'redirectResponse' in params:
+				redirect_response = {}
+				redirect_response['response'] 		= params['redirectResponse']
+				redirect_response['requestId'] 		= params['requestId']
+				redirect_response['loaderId'] 		= params['loaderId']
+				redirect_response['timestamp']		= params['timestamp']
+				redirect_response['type'] 		 	= params['type']
+				redirect_response['event_order'] 	= len(responses)
+				responses.append(self.clean_response(redirect_response))
+				self.fix_event_timestamp(responses[-1], origin_walltime, first_timestamp, unfixed_events)
+
+				cleaned_request['redirect_response_url'] = params['redirectResponse']['url']
+			else:
+				cleaned_request['redirect_response_url'] = None
+
+			requests.append(cleaned_request)
+			self.fix_event_timestamp(cleaned_request, origin_walltime, first_timestamp, unfixed_events)
+		# handle_request
+
+		def handle_request_extra_info(params):
+			request_extra_headers.append({
+				'request_id'		: params['requestId'],
+				'headers'			: params['headers'],
+				'associated_cookies': params['associatedCookies']
+			})
+			self.fix_event_timestamp(request_extra_headers[-1], origin_walltime, first_timestamp, unfixed_events)
+		# handle_request_extra_info
+
+		def handle_response(params):
+			responses.append(self.clean_response(params))
+			self.fix_event_timestamp(responses[-1], origin_walltime, first_timestamp, unfixed_events)
+		# handle_response
+
+		def handle_response_extra_info(params):
+			response_extra_headers.append({
+				'request_id'		: params['requestId'],
+				'headers'			: params['headers'],
+				'blocked_cookies'	: params['blockedCookies'],
+			})
+			self.fix_event_timestamp(response_extra_headers[-1], origin_walltime, first_timestamp, unfixed_events)
+		# handle_response_extra_info
+
+		def handle_loading_finished(params):
+			in_flight_requests.discard(params['requestId'])
+
+			load_finish_events.append({
+				'encoded_data_length': 	params['encodedDataLength'],
+				'request_id': 			params['requestId'],
+				'timestamp': 			params['timestamp'],
+			})
+			self.fix_event_timestamp(load_finish_events[-1], origin_walltime, first_timestamp, unfixed_events)
+		# handle_loading_finished
+
+		def handle_loading_failed(params):
+			in_flight_requests.discard(params['requestId'])
+		# handle_loading_failed
+
+		def handle_lifecycle_event(params):
+			nonlocal page_network_idle
+
+			# only care about network idle for our navigation
+			if params['name'] != 'networkIdle': return
+			if navigate_future and navigate_future.done() and navigate_future.result():
+				if params['loaderId'] == navigate_future.result().get('result',{}).get('loaderId'):
+					page_network_idle = True
+		# handle_lifecycle_event
+
+		def handle_websocket_created(params):
+			websockets.append({
+				'request_id'	: params['requestId'],
+				'url'			: params['url'],
+				'initiator'		: params.get('initiator'),
+				'event_order'	: len(websockets)
+			})
+			self.fix_event_timestamp(websockets[-1], origin_walltime, first_timestamp, unfixed_events)
+		# handle_websocket_created
+
+		def handle_websocket_event(method, params):
+			if 'errorMessage' in params:
+				payload = params['errorMessage']
+			elif 'request' in params:
+				payload = params['request']
+			elif 'response' in params:
+				payload = params['response']
+			else:
+				payload = None
+
+			websocket_events.append({
+				'request_id'	: params['requestId'],
+				'timestamp'		: params['timestamp'],
+				'event_type'	: method.replace('Network.',''),
+				'payload'		: payload,
+				'event_order'	: len(websocket_events)
+			})
+			self.fix_event_timestamp(websocket_events[-1], origin_walltime, first_timestamp, unfixed_events)
+		# handle_websocket_event
+
+		def handle_event_source_message(params):
+			event_source_msgs.append({
+				'internal_request_id'	: params['requestId'],
+				'timestamp'			: params['timestamp'],
+				'event_name'		: params['eventName'],
+				'event_id'			: params['eventId'],
+				'data'				: params['data']
+			})
+			self.fix_event_timestamp(event_source_msgs[-1], origin_walltime, first_timestamp, unfixed_events)
+		# handle_event_source_message
+
+		def handle_dom_storage_item(params):
+			dom_storage_id = params['storageId']
+			ds_key = (
+					dom_storage_id['securityOrigin'],
+					dom_storage_id['isLocalStorage'],
+					params['key']
+			)
+			dom_storage_holder[ds_key] = params['newValue']
+		# handle_dom_storage_item
+
+		event_handlers = {
+			'Network.requestWillBeSent'				: handle_request,
+			'Network.requestWillBeSentExtraInfo'	: handle_request_extra_info,
+			'Network.responseReceived'				: handle_response,
+			'Network.responseReceivedExtraInfo'		: handle_response_extra_info,
+			'Network.loadingFinished'				: handle_loading_finished,
+			'Network.loadingFailed'					: handle_loading_failed,
+			'Page.lifecycleEvent'					: handle_lifecycle_event,
+			'Network.webSocketCreated'				: handle_websocket_created,
+			'Network.eventSourceMessageReceived'	: handle_event_source_message,
+			'DOMStorage.domStorageItemAdded'		: handle_dom_storage_item,
+			'DOMStorage.domStorageItemUpdated'		: handle_dom_storage_item
+		}
+		for websocket_event_type in websocket_event_types:
+			event_handlers[websocket_event_type] = lambda params, method=websocket_event_type: handle_websocket_event(method, params)
+
+		# everything else chrome sends, eg Network.dataReceived for each
+		#	chunk of every response, is dropped by the devtools client
+		#	without being decoded
+		self.devtools_client.set_event_filter(event_handlers.keys())
+
 		# We keep collecting devtools_responses in this loop until either we haven't seen 
 		#	network activity for the no_event_wait value or we exceed the max_wait
 		#	time.
@@ -666,26 +917,43 @@ class ChromeDriver:
 
 			# start page load
 			if not sent_intial_request: 
-				self.send_ws_command('Page.navigate','"url":"%s"' % url)
+				response = self.send_ws_command('Page.navigate','"url":"%s"' % url)
+				if response['success']: navigate_future = response['result']
 				sent_intial_request = True
 
 			# update how long we've been going
 			loop_elapsed = (datetime.datetime.now()-response_loop_start).total_seconds()
 
-			# perform two scrolls once a second
-			if int(loop_elapsed) > last_second:
+			# with the 'dispatch' scroll strategy we send twenty scrolls
+			#	once a second until we reach the budget
+			if self.scroll_strategy == 'dispatch' and int(loop_elapsed) > last_second:
 				last_second = int(loop_elapsed)
-				for i in range(0,10):
-					if self.debug: print(f'{last_second} : performing scroll #{i}')
-					self.do_scroll()
-					self.do_scroll()
+				if loop_elapsed < self.scroll_max_seconds:
+					for i in range(0,20):
+						if scroll_depth >= self.scroll_max_depth: break
+						if self.debug: print(f'{last_second} : performing scroll #{i}')
+						scroll_depth += self.do_scroll()
 
 			# see if time to stop
-			elapsed_no_event = (datetime.datetime.now()-time_since_last_response).total_seconds()
+			elapsed_no_event = time.time() - max(network_wait_start, self.devtools_client.get_last_event_time('Network') or 0)
 			
 			if loop_elapsed < self.prewait:
 				if self.debug: print(f'{loop_elapsed}: In prewait period')
 
+			# the page is idle once nothing is in flight and it has been quiet
+			#	for network_idle_wait, or chrome tells us it is.  we never stop
+			#	before the page has made a request or before injected scripts
+			#	have returned.
+			page_is_idle = False
+			if self.network_idle_wait and len(requests) > 0:
+				if not (self.injections and not sent_injections) and all(future.done() for future in injection_future_to_script):
+					if page_network_idle or (len(in_flight_requests) == 0 and elapsed_no_event > self.network_idle_wait):
+						page_is_idle = True
+
+			if loop_elapsed > self.prewait and page_is_idle:
+				if self.debug: print(f'{loop_elapsed} Network idle for {elapsed_no_event}, breaking Network log loop.')
+				break
+
 			if loop_elapsed > self.prewait and (elapsed_no_event > self.no_event_wait or loop_elapsed > self.max_wait):
 				if self.debug: print(f'{loop_elapsed} No event for {elapsed_no_event}, max_wait is {self.max_wait}, breaking Network log loop.')
 				break
@@ -697,8 +965,7 @@ class ChromeDriver:
 				for injection in self.injections:
 					if self.debug: print(f'injecting {injection}.js')
 					try:
-						with open(f'./resources/injections/{injection}', 'r', encoding='utf-8') as json_file:
-							js = json.dumps(json_file.read())
+						js = json.dumps(self.load_script(f'./resources/injections/{injection}'))
 					except:
 						self.exit()
 						return ({
@@ -716,169 +983,76 @@ class ChromeDriver:
 						self.exit()
 						return response
 					else: 
-						# store the ws_id if we need a response, otherwise
+						# store the future if we need a response, otherwise
 						#	it executes and we don't bother w/response
 						if injection[:5] != 'load_':
-							ws_id = response['result']
-							injection_ws_ids.append(ws_id)
-							ws_id_to_script[ws_id] = injection
+							injection_future_to_script[response['result']] = injection
 
 				# don't do this again
 				sent_injections = True
 
-			# try to get ws response, returns None if no response
-			devtools_response = self.get_next_ws_response()
-
-			# determine how long since we last got a response with
-			#	a Network event, if we didn't get a response we wait
-			#	for a second
-			if devtools_response:
-				
-				# check if we have a response for our injected js
-				if 'id' in devtools_response:
-					ws_id = devtools_response['id']
-
-					if ws_id in injection_ws_ids:
-						# if result is a string this will make it pretty, otherwise just dump the 
-						#	raw ouutput
-						try:
-							injection_results.append({
-								'script_name'	: ws_id_to_script[ws_id],
-								'result'		: json.dumps(devtools_response['result']['result']['value'])
-								})
-						except:
-							injection_results.append({
-								'script_name'	: ws_id_to_script[ws_id],
-								'result'		: json.dumps(devtools_response['result']['result'])
-								})
+			# figure out how long until we next have something to do: scroll,
+			#	inject, or check if we are done.  we then block on the event
+			#	queue for no longer than that, so an idle page costs us nothing
+			#	and events are handled the moment they arrive
+			time_to_next_action = min(
+				self.no_event_wait - elapsed_no_event,
+				self.max_wait - loop_elapsed
+			)
+			if self.scroll_strategy == 'dispatch' and loop_elapsed < self.scroll_max_seconds and scroll_depth < self.scroll_max_depth:
+				time_to_next_action = min(time_to_next_action, (last_second+1) - loop_elapsed)
+			if loop_elapsed < self.prewait:
+				time_to_next_action = min(time_to_next_action, self.prewait - loop_elapsed)
+			if self.injections and not sent_injections:
+				time_to_next_action = min(time_to_next_action, 3 - loop_elapsed)
+			if self.network_idle_wait and len(in_flight_requests) == 0:
+				time_to_next_action = min(time_to_next_action, self.network_idle_wait - elapsed_no_event)
 
-				if 'method' in devtools_response:
-					if 'Network' in devtools_response['method']:
-						time_since_last_response = datetime.datetime.now()
-					else:
-						if self.debug: print(f'No events for {elapsed_no_event} seconds; main loop running for {loop_elapsed}')
-			else:
+			# try to get ws event, returns None if nothing arrives in time
+			devtools_response = self.get_next_ws_response(timeout=max(time_to_next_action,0.01))
+
+			if not devtools_response:
+				# the connection has died, nothing more is coming
+				if not self.devtools_client.connected: break
 				if self.debug: print(f'No events for {elapsed_no_event} seconds; main loop running for {loop_elapsed}')
-				time.sleep(1)
 				continue
 
 			# if we make it this far devtools_response was not None
 			if self.debug: print(loop_elapsed,json.dumps(devtools_response)[:100])
 
-			# PRESENCE OF 'METHOD' MEANS WE PROCESS LOG DATA
-			if 'method' in devtools_response:
-				# REQUEST
-				if devtools_response['method'] == 'Network.requestWillBeSent':
-					cleaned_request = self.clean_request(devtools_response['params'])
-					cleaned_request['event_order'] = len(requests)
-
-					# update global start time to measure page load time and calculate offsets
-					if origin_walltime == None or cleaned_request['wall_time'] < origin_walltime:
-						origin_walltime = cleaned_request['wall_time']
-
-					if first_timestamp == None or cleaned_request['timestamp'] < first_timestamp:
-						first_timestamp = cleaned_request['timestamp']
-
-					# DOCUMENT ME
-					if 'redirectResponse' in devtools_response['params']:
-						redirect_response = {}
-						redirect_response['response'] 		= devtools_response['params']['redirectResponse']
-						redirect_response['requestId'] 		= devtools_response['params']['requestId']
-						redirect_response['loaderId'] 		= devtools_response['params']['loaderId']
-						redirect_response['timestamp']		= devtools_response['params']['timestamp']
-						redirect_response['type'] 		 	= devtools_response['params']['type']
-						redirect_response['event_order'] 	= len(responses)
-						responses.append(self.clean_response(redirect_response))
-
-						cleaned_request['redirect_response_url'] = devtools_response['params']['redirectResponse']['url']
-					else:
-						cleaned_request['redirect_response_url'] = None
-
-					requests.append(cleaned_request)
-
-				# REQUEST EXTRA INFO
-				if devtools_response['method'] == 'Network.requestWillBeSentExtraInfo':
-					request_extra_headers.append({
-						'request_id'		: devtools_response['params']['requestId'],
-						'headers'			: devtools_response['params']['headers'],
-						'associated_cookies': devtools_response['params']['associatedCookies']
-					})
-
-				# RESPONSE
-				if devtools_response['method'] == 'Network.responseReceived':
-					responses.append(self.clean_response(devtools_response['params']))
+			# pass the event to its handler, the event filter means we only
+			#	get events which have one
+			handler = event_handlers.get(devtools_response.get('method'))
+			if handler: handler(devtools_response['params'])
 
-				# RESPONSE EXTRA INFO
-				if devtools_response['method'] == 'Network.responseReceivedExtraInfo':
-					response_extra_headers.append({
-						'request_id'		: devtools_response['params']['requestId'],
-						'headers'			: devtools_response['params']['headers'],
-						'blocked_cookies'	: devtools_response['params']['blockedCookies'],
-					})
+		# we are done with events for this page, the domains stay enabled
+		#	for the next page so we drop anything more without decoding it
+		self.devtools_client.set_event_filter([])
 
-				# LOAD FINISHED
-				if devtools_response['method'] == 'Network.loadingFinished':
-					request_id = devtools_response['params']['requestId']
+		# stop scrolling documents loaded after this page, we don't
+		#	need the response so don't wait on it
+		if self.scroll_script_id != None:
+			self.send_ws_command('Page.removeScriptToEvaluateOnNewDocument',f'"identifier":{json.dumps(self.scroll_script_id)}')
+			self.scroll_script_id = None
 
-					load_finish_events.append({
-						'encoded_data_length': 	devtools_response['params']['encodedDataLength'],
-						'request_id': 			request_id,
-						'timestamp': 			devtools_response['params']['timestamp'],
-					})
+		# collect results for any injected scripts which have returned
+		for future, script_name in injection_future_to_script.items():
+			if not future.done() or not future.result(): continue
+			devtools_response = future.result()
 
-				# WEBSOCKETS
-				if devtools_response['method'] == 'Network.webSocketCreated':
-					if 'initiator' in devtools_response['params']:
-						this_initiator = devtools_response['params']['initiator']
-					else:
-						this_initiator = None
-
-					websockets.append({
-						'request_id'	: devtools_response['params']['requestId'],
-						'url'			: devtools_response['params']['url'],
-						'initiator'		: this_initiator,
-						'event_order'	: len(websockets)
-					})
-
-				if devtools_response['method'] in websocket_event_types:
-					if 'errorMessage' in devtools_response['params']:
-						payload = devtools_response['params']['errorMessage']
-					elif 'request' in devtools_response['params']:
-						payload = devtools_response['params']['request']
-					elif 'response' in devtools_response['params']:
-						payload = devtools_response['params']['response']
-					else:
-						payload = None
-
-					websocket_events.append({
-						'request_id'	: devtools_response['params']['requestId'],
-						'timestamp'		: devtools_response['params']['timestamp'],
-						'event_type'	: devtools_response['method'].replace('Network.',''),
-						'payload'		: payload,
-						'event_order'	: len(websocket_events)
+			# if result is a string this will make it pretty, otherwise just dump the 
+			#	raw ouutput
+			try:
+				injection_results.append({
+					'script_name'	: script_name,
+					'result'		: json.dumps(devtools_response['result']['result']['value'])
 					})
-
-				# EVENT SOURCE
-				if devtools_response['method'] == 'Network.eventSourceMessageReceived':
-					event_source_msgs.append({
-						'internal_request_id'	: devtools_response['params']['requestId'],
-						'timestamp'			: devtools_response['params']['timestamp'],
-						'event_name'		: devtools_response['params']['eventName'],
-						'event_id'			: devtools_response['params']['eventId'],
-						'data'				: devtools_response['params']['data']
+			except:
+				injection_results.append({
+					'script_name'	: script_name,
+					'result'		: json.dumps(devtools_response['result']['result'])
 					})
 
-				# DOMSTORAGE
-				if devtools_response['method'] == 'DOMStorage.domStorageItemAdded' or devtools_response['method'] == 'DOMStorage.domStorageItemUpdated':
-					dom_storage_id = devtools_response['params']['storageId']
-					ds_key = (
-							dom_storage_id['securityOrigin'],
-							dom_storage_id['isLocalStorage'],
-							devtools_response['params']['key']
-					)
-
-					dom_storage_holder[ds_key] = devtools_response['params']['newValue']
-
 		# no need to continue processing if we got nothing back
 		if len(responses) == 0:
 			self.exit()
@@ -894,13 +1068,7 @@ class ChromeDriver:
 				'result': 'No load_finish_events for page'
 			})
 
-		# Stop getting additional DOMStorage events
-		response = self.send_ws_command('DOMStorage.disable')
-		if response['success'] == False:
-			self.exit()
-			return response
 
-		
 		#####################
 		# DEVTOOLS COMMANDS #
 		#####################
@@ -911,26 +1079,25 @@ class ChromeDriver:
 			if self.debug: print(' Going to send response body commands ')
 			if self.debug: print('######################################')
 
-			# send commands to get response bodies
-			for event in load_finish_events:
-				request_id = event['request_id']
+			body_request_ids = self.get_body_request_ids(url, responses, load_finish_events)
+
+			# send the first window of commands to get response bodies, the
+			#	rest are sent as responses come back.  a null window means
+			#	we send them all at once, we always send at least one
+			body_window = max(1, int(self.body_window or len(body_request_ids)))
+			for request_id in body_request_ids[:body_window]:
 				response = self.send_ws_command('Network.getResponseBody',f'"requestId":"{request_id}"')
 				if response['success'] == False:
 					self.exit()
 					return response
 				else: 
-					ws_id = response['result']
-				ws_id_to_req_id[ws_id] = request_id
-				pending_ws_id_to_cmd[ws_id] = 'response_body'
+					future = response['result']
+				future_to_req_id[future] = request_id
+				pending_future_to_cmd[future] = 'response_body'
+			body_request_ids = body_request_ids[body_window:]
 
 			if self.debug: print('\tdone')
 
-		# No longer need Network domain enabled
-		self.send_ws_command('Network.disable')
-		if response['success'] == False:
-			self.exit()
-			return response
-
 		# to get IndexedDB entries we need to call them based on
 		#	the securityOrigin of the frame, so we need to get
 		#	the frame tree first
@@ -939,9 +1106,9 @@ class ChromeDriver:
 			self.exit()
 			return response
 		else: 
-			ws_id = response['result']
+			future = response['result']
 		
-		pending_ws_id_to_cmd[ws_id] = 'frame_tree'
+		pending_future_to_cmd[future] = 'frame_tree'
 
 		if self.debug: print('############################################')
 		if self.debug: print(' Going to send devtools javascript commands ')
@@ -953,37 +1120,36 @@ class ChromeDriver:
 			self.exit()
 			return response
 		else: 
-			ws_id = response['result']
+			future = response['result']
 
-		pending_ws_id_to_cmd[ws_id] = 'page_nav'
+		pending_future_to_cmd[future] = 'page_nav'
 
 		response = self.send_ws_command('Runtime.evaluate',params='"expression":"document.documentElement.outerHTML","timeout":1000')
 		if response['success'] == False:
 			self.exit()
 			return response
 		else: 
-			ws_id = response['result']
-		pending_ws_id_to_cmd[ws_id] = 'page_src'
+			future = response['result']
+		pending_future_to_cmd[future] = 'page_src'
 
 		response = self.send_ws_command('Runtime.evaluate',params='"expression":"document.documentElement.lang","timeout":1000')
 		if response['success'] == False:
 			self.exit()
 			return response
 		else: 
-			ws_id = response['result']
-		pending_ws_id_to_cmd[ws_id] = 'html_lang'
+			future = response['result']
+		pending_future_to_cmd[future] = 'html_lang'
 
 		# LINKS
-		with open(f'./resources/injections/wbxr_links.js', 'r', encoding='utf-8') as json_file:
-			js = json.dumps(json_file.read())
+		js = json.dumps(self.load_script('./resources/injections/wbxr_links.js') + f'\nwbxr_get_links({json.dumps(self.max_links)});')
 		
 		response = self.send_ws_command('Runtime.evaluate',params=f'"expression":{js},"timeout":1000,"returnByValue":true')
 		if response['success'] == False:
 			self.exit()
 			return response
 		else: 
-			ws_id = response['result']
-		pending_ws_id_to_cmd[ws_id] = 'links'
+			future = response['result']
+		pending_future_to_cmd[future] = 'links'
 
 		# META_DESC
 		js = json.dumps("""
@@ -995,8 +1161,8 @@ class ChromeDriver:
 			self.exit()
 			return response
 		else: 
-			ws_id = response['result']
-		pending_ws_id_to_cmd[ws_id] = 'meta_desc'
+			future = response['result']
+		pending_future_to_cmd[future] = 'meta_desc'
 
 		# PAGE_TEXT / READABILITY_HTML
 		#
@@ -1006,8 +1172,7 @@ class ChromeDriver:
 		if self.return_page_text or get_text_only:
 			# if we can't load readability it likely isn't installed, raise error
 			try:
-				with open('./resources/policyxray/Readability.js', 'r', encoding='utf-8') as json_file:
-					readability_js = json_file.read()
+				readability_js = self.load_script('./resources/policyxray/Readability.js')
 
 				js = json.dumps(f"""
 					var wbxr_readability = (function() {{
@@ -1023,8 +1188,8 @@ class ChromeDriver:
 					self.exit()
 					return response
 				else: 
-					ws_id = response['result']
-				pending_ws_id_to_cmd[ws_id] = 'page_text'
+					future = response['result']
+				pending_future_to_cmd[future] = 'page_text'
 			except:
 				print('\t****************************************************')
 				print('\t The Readability.js library is needed for webXray to')
@@ -1054,8 +1219,8 @@ class ChromeDriver:
 				self.exit()
 				return response
 			else: 
-				ws_id = response['result']
-			pending_ws_id_to_cmd[ws_id] = 'screen_shot'
+				future = response['result']
+			pending_future_to_cmd[future] = 'screen_shot'
 		else:
 			screen_shot = None
 
@@ -1065,24 +1230,14 @@ class ChromeDriver:
 			self.exit()
 			return response
 		else: 
-			ws_id = response['result']
-		pending_ws_id_to_cmd[ws_id] = 'cookies'
+			future = response['result']
+		pending_future_to_cmd[future] = 'cookies'
 
 		# just to let us know how much work to do
-		if self.debug: print('Pending ws requests: %s %s' % (url, len(pending_ws_id_to_cmd)))
+		if self.debug: print('Pending ws requests: %s %s' % (url, len(pending_future_to_cmd)))
 
 		# Keep going until we get all the pending responses or 3min timeout
-		while True:
-
-			# if result is None we are either out of responses (prematurely) or
-			#	we failed
-			devtools_response = self.get_next_ws_response()
-			if not devtools_response:
-				self.exit()
-				return ({
-					'success': False,
-					'result': 'Unable to get devtools response.'
-				})
+		while len(pending_future_to_cmd) > 0:
 
 			# update how long we've been going
 			loop_elapsed = (datetime.datetime.now()-response_loop_start).total_seconds()
@@ -1094,21 +1249,26 @@ class ChromeDriver:
 					'success': False,
 					'result': 'Timeout when processing devtools responses.'
 				})
-			
-			if self.debug: print(loop_elapsed,json.dumps(devtools_response)[:250])
-
-			# if response has an 'id' see which of our commands it goes to
-			if 'id' in devtools_response:
-				ws_id = devtools_response['id']
 
-				# we don't care about this
-				if ws_id not in pending_ws_id_to_cmd: continue
+			# block until at least one of our commands has a response
+			done_futures, _ = wait(list(pending_future_to_cmd), timeout=180-loop_elapsed, return_when=FIRST_COMPLETED)
 
+			for future in done_futures:
 				# remove the current one from pending
-				# if self.debug: print('Going to remove ws_id %s from pending' % ws_id)
-				cmd = pending_ws_id_to_cmd[ws_id]
-				del pending_ws_id_to_cmd[ws_id]
-				if self.debug: print(f'Removing {ws_id}:{cmd}, pending ws_id count is %s' % len(pending_ws_id_to_cmd))
+				cmd = pending_future_to_cmd.pop(future)
+				if self.debug: print(f'Removing {future.ws_id}:{cmd}, pending count is %s' % len(pending_future_to_cmd))
+
+				# if result is None the connection died before
+				#	we got our response
+				devtools_response = future.result()
+				if not devtools_response:
+					self.exit()
+					return ({
+						'success': False,
+						'result': 'Unable to get devtools response.'
+					})
+
+				if self.debug: print(loop_elapsed,json.dumps(devtools_response)[:250])
 
 				# NAV HISTORY/FINAL_URL
 				if cmd == 'page_nav':
@@ -1155,6 +1315,16 @@ class ChromeDriver:
 
 				# RESPONSE BODIES
 				elif cmd == 'response_body':
+					# keep the window full
+					if len(body_request_ids) > 0:
+						request_id = body_request_ids.pop(0)
+						response = self.send_ws_command('Network.getResponseBody',f'"requestId":"{request_id}"')
+						if response['success'] == False:
+							self.exit()
+							return response
+						future_to_req_id[response['result']] = request_id
+						pending_future_to_cmd[response['result']] = 'response_body'
+
 					if 'result' not in devtools_response: 
 						if self.debug: print('response body error: %s' % devtools_response)
 						continue
@@ -1163,10 +1333,21 @@ class ChromeDriver:
 					#	just have to check the reponse is either not base64 or we 
 					#	do want to return base64
 					if devtools_response['result']['base64Encoded'] == False or self.return_bodies_base64:
-						response_bodies[ws_id_to_req_id[ws_id]] = {
-								'body': 	 devtools_response['result']['body'],
-								'is_base64': devtools_response['result']['base64Encoded']
-						}
+						if self.body_spool_dir:
+							spool_result = self.spool_body(devtools_response['result']['body'])
+							if spool_result['success'] == False:
+								if self.debug: print(spool_result['result'])
+								continue
+							response_bodies[future_to_req_id[future]] = {
+								'md5':			spool_result['result']['md5'],
+								'spool_path':	spool_result['result']['spool_path'],
+								'is_base64': 	devtools_response['result']['base64Encoded']
+							}
+						else:
+							response_bodies[future_to_req_id[future]] = {
+									'body': 	 devtools_response['result']['body'],
+									'is_base64': devtools_response['result']['base64Encoded']
+							}
 
 				# SCREENSHOT
 				elif cmd == 'screen_shot':
@@ -1187,9 +1368,11 @@ class ChromeDriver:
 				# LINKS
 				elif cmd == 'links':
 					try:
-						js_links = devtools_response['result']['result']['value']
+						js_links 			= devtools_response['result']['result']['value']['links']
+						host_link_counts 	= devtools_response['result']['result']['value']['host_link_counts']
 					except:
-						js_links = []
+						js_links 			= []
+						host_link_counts 	= {}
 
 				# META_DESC
 				elif cmd == 'meta_desc':
@@ -1218,8 +1401,8 @@ class ChromeDriver:
 					# make sure we only do things once
 					security_origins = set()
 
-					# keep track of what ws_id goes to which origin for indexeddb
-					pending_ws_id_to_idx_db_sec_origin = {}
+					# keep track of what future goes to which origin for indexeddb
+					pending_future_to_idx_db_sec_origin = {}
 
 					# traverse the frame tree
 					security_origins.add(devtools_response['result']['frameTree']['frame']['securityOrigin'])
@@ -1237,10 +1420,10 @@ class ChromeDriver:
 							self.exit()
 							return response
 						else: 
-							sub_ws_id = response['result']
+							sub_future = response['result']
 						
-						pending_ws_id_to_cmd[sub_ws_id] = 'idx_db_list'
-						pending_ws_id_to_idx_db_sec_origin[sub_ws_id] = security_origin
+						pending_future_to_cmd[sub_future] = 'idx_db_list'
+						pending_future_to_idx_db_sec_origin[sub_future] = security_origin
 
 						# now get the CacheStorage
 						response = self.send_ws_command('CacheStorage.requestCacheNames',f'"securityOrigin":"{security_origin}"')
@@ -1248,9 +1431,9 @@ class ChromeDriver:
 							self.exit()
 							return response
 						else: 
-							sub_ws_id = response['result']
+							sub_future = response['result']
 						
-						pending_ws_id_to_cmd[sub_ws_id] = 'cache_name_list'
+						pending_future_to_cmd[sub_future] = 'cache_name_list'
 					
 
 				# we have the result of our indexeddb database names 
@@ -1261,7 +1444,7 @@ class ChromeDriver:
 						if len(devtools_response['result']['databaseNames']) != 0:
 							for db_name in devtools_response['result']['databaseNames']:
 								misc_storage.append({
-									'security_origin'	: pending_ws_id_to_idx_db_sec_origin[ws_id],
+									'security_origin'	: pending_future_to_idx_db_sec_origin[future],
 									'key'				: db_name,
 									'type'				: 'indexeddb',
 									'value'				: None
@@ -1289,12 +1472,10 @@ class ChromeDriver:
 						#	print warning if in debug, but otherwise ignore
 						if self.debug: print('Unable to get cacheName via Devtools',devtools_response)
 
-			# we've gotten all the reponses we need, break
-			if len(pending_ws_id_to_cmd) == 0: 
-				if self.debug: print('Got all ws responses!')
-				break
 		# end ws loop
 
+		if self.debug: print('Got all ws responses!')
+
 		# catch redirect to illegal url
 		if not self.is_url_valid(final_url):
 			self.exit()
@@ -1303,41 +1484,34 @@ class ChromeDriver:
 				'result': 'Redirected to illegal url: '+final_url
 			})
 
-		# process links and mark if internal
-		all_links = []
+		# the links come back from the browser filtered, normalized, and
+		#	deduplicated, so all we have to do is mark them internal or
+		#	external.  that only depends on the host, so we parse each
+		#	host once rather than each link.
+		origin_domain_info = self.url_parser.get_parsed_domain_info(final_url)
+		host_is_internal = {}
+		def is_host_internal(host):
+			if host not in host_is_internal:
+				if origin_domain_info['success']:
+					link_domain_info = self.url_parser.get_parsed_domain_info(f'http://{host}')
+					host_is_internal[host] = link_domain_info['success'] and link_domain_info['result']['domain'] == origin_domain_info['result']['domain']
+				else:
+					host_is_internal[host] = False
+			return host_is_internal[host]
+
+		# internal_link_count counts every internal link on the page, not
+		#	just the unique ones we keep, as it always has
 		internal_link_count = 0
+		for host, link_count in host_link_counts.items():
+			if is_host_internal(host): internal_link_count += link_count
+
+		all_links = []
 		for link in js_links:
-			# filtering steps
-			if 'href' not in link: continue
-			if len(link['href']) == 0: continue
-			if link['protocol'][:4] != 'http': continue
-
-			# get rid of trailing # and /
-			if link['href'].strip()[-1:] == '#': link['href'] = link['href'].strip()[:-1]
-			if link['href'].strip()[-1:] == '/': link['href'] = link['href'].strip()[:-1]
-
-			# sometimes the text will be a dict (very rarely)
-			# 	so we convert to string
-			link_text = str(link['text']).strip()
-
-			# set up the dict
-			if self.is_url_internal(final_url,link['href']):
-				internal_link_count += 1
-				link = {
-					'text'		: link_text,
-					'href'		: link['href'].strip(),
-					'internal'	: True
-				}
-			else:
-				link = {
-					'text'		: link_text,
-					'href'		: link['href'].strip(),
-					'internal'	: False
-				}
-			
-			# only add unique links
-			if link not in all_links:
-				all_links.append(link)
+			all_links.append({
+				'text'		: link['text'],
+				'href'		: link['href'],
+				'internal'	: is_host_internal(link['host'])
+			})
 
 		# fail if we don't have enough internal links
 		if self.min_internal_links:
@@ -1380,30 +1554,14 @@ class ChromeDriver:
 					'result': 'first_timestamp was None'
 				})
 
-			# Page load time is the delta between the origin_walltime and the final_walltime
-			#	we initialize final_walltime to None as if it does not get updated nothing
-			#	was loaded and we failed.
+			# Page load time is the delta between the origin_walltime and the final_walltime,
+			#	which is the latest load_finish_event, timestamps were fixed as they
+			#	came in.  If there are no load_finish_events nothing was loaded and
+			#	we failed.
 			final_walltime = None
-
-			# As we update the load_finish_event timestamps we also update the final_walltime.
 			for load_finish_event in load_finish_events:
-				fixed_timestamp = self.fixed_timestamp(origin_walltime, first_timestamp, load_finish_event['timestamp'])
-				load_finish_event['timestamp'] = fixed_timestamp
-				if final_walltime == None or fixed_timestamp > final_walltime:
-					final_walltime = fixed_timestamp
-
-			# These timestamp fixes are straightforward
-			for request in requests:
-				request['timestamp'] = self.fixed_timestamp(origin_walltime, first_timestamp, request['timestamp'])
-
-			for response in responses:
-				response['timestamp'] = self.fixed_timestamp(origin_walltime, first_timestamp, response['timestamp'])
-
-			for websocket_event in websocket_events:
-				websocket_event['timestamp'] = self.fixed_timestamp(origin_walltime, first_timestamp, websocket_event['timestamp'])			
-
-			for event_source_msg in event_source_msgs:
-				event_source_msg['timestamp'] = self.fixed_timestamp(origin_walltime, first_timestamp, event_source_msg['timestamp'])	
+				if final_walltime == None or load_finish_event['timestamp'] > final_walltime:
+					final_walltime = load_finish_event['timestamp']
 
 			# Session cookies have expires of -1 so we sent to None
 			for cookie in cookies:
@@ -1570,6 +1728,88 @@ class ChromeDriver:
 		return cleaned_request
 	# clean_request
 
+	def get_body_request_ids(self, url, responses, load_finish_events):
+		"""
+		Returns the request ids of the bodies we want, which are those
+			that finished loading and pass our filters on size, mime
+			type, and, if body_3p_only is set, party.
+		"""
+		# mime type and url of each response
+		request_id_to_response = {}
+		for response in responses:
+			request_id_to_response[response['request_id']] = response
+
+		# used to determine party
+		page_domain_info = self.url_parser.get_parsed_domain_info(url)
+		if page_domain_info['success']:
+			page_domain = page_domain_info['result']['domain']
+		else:
+			page_domain = None
+
+		body_request_ids = []
+		for event in load_finish_events:
+			# we wrote these bodies ourselves
+			if event['request_id'] in self.stubbed_request_ids: continue
+
+			if self.body_max_bytes and event['encoded_data_length'] > self.body_max_bytes: continue
+
+			response = request_id_to_response.get(event['request_id'])
+
+			if self.body_mime_types:
+				if response == None: continue
+				if not any(response['mime_type'].startswith(mime_type) for mime_type in self.body_mime_types): continue
+
+			if self.body_3p_only:
+				if response == None: continue
+				domain_info = self.url_parser.get_parsed_domain_info(response['url'])
+				if domain_info['success'] == False: continue
+				if domain_info['result']['domain'] == page_domain: continue
+
+			body_request_ids.append(event['request_id'])
+
+		return body_request_ids
+	# get_body_request_ids
+
+	def spool_body(self, body):
+		"""
+		Writes the body to the spool dir, named by the md5 of the body so
+			identical files from different pages are only written once.
+			The md5 matches what OutputStore.store_file uses.
+		"""
+		try:
+			body_bytes = body.encode()
+			body_md5 = hashlib.md5(body_bytes).hexdigest()
+			spool_path = os.path.abspath(os.path.join(self.body_spool_dir, body_md5[:2], body_md5))
+
+			if os.path.exists(spool_path):
+				# old spool files are swept up by the Collector, so let
+				#	it know somebody still wants this one
+				os.utime(spool_path)
+			else:
+				os.makedirs(os.path.dirname(spool_path), exist_ok=True)
+
+				# write under a name only we use and move into place, so
+				#	nobody reads a partly written file, we write bytes so
+				#	line endings are not changed and the md5 still matches
+				tmp_path = f'{spool_path}.{os.getpid()}.{threading.get_ident()}'
+				with open(tmp_path, 'wb') as spool_file:
+					spool_file.write(body_bytes)
+				os.replace(tmp_path, spool_path)
+		except Exception as e:
+			return ({
+				'success': False,
+				'result': f'Unable to spool body: {e}'
+			})
+
+		return ({
+			'success': True,
+			'result': {
+				'md5'			: body_md5,
+				'spool_path'	: spool_path
+			}
+		})
+	# spool_body
+
 	def clean_response(self, response_params):
 		"""
 		Many of the response fields are optional so we make sure
@@ -1654,6 +1894,19 @@ class ChromeDriver:
 		return cleaned_response
 	# clean_response
 
+	def fix_event_timestamp(self, event, origin_walltime, first_timestamp, unfixed_events):
+		"""
+		Fixes the timestamp on a network event we've just recorded.  If
+			we don't have the first request yet we can't fix the timestamp,
+			so the event goes in unfixed_events until we do.
+		"""
+		if 'timestamp' in event:
+			if first_timestamp == None:
+				unfixed_events.append(event)
+				return
+			event['timestamp'] = self.fixed_timestamp(origin_walltime, first_timestamp, event['timestamp'])
+	# fix_event_timestamp
+
 	def fixed_timestamp(self,origin_walltime,first_timestamp,timestamp):
 		"""
 		See notes above for details.
@@ -1755,9 +2008,136 @@ class ChromeDriver:
 	def do_scroll(self):
 		"""
 		Performs a random scroll action on Y axis, can be called at regular
-			intervals to surface content on pages.
+			intervals to surface content on pages.  Returns how far
+			we scrolled.
 		"""
-		self.send_ws_command('Input.dispatchMouseEvent','"x":0,"y":0,"type":"mouseWheel","deltaX":0,"deltaY":%s' % random.randrange(10,100))
+		delta_y = random.randrange(10,100)
+		self.send_ws_command('Input.dispatchMouseEvent','"x":0,"y":0,"type":"mouseWheel","deltaX":0,"deltaY":%s' % delta_y)
+		return delta_y
 	# do_scroll
 
+	def enable_lean_mode(self):
+		"""
+		Has chrome pause requests for lean_resource_types once the
+			response headers arrive, which handle_paused_request then
+			answers with the real status and headers but a minimal body.
+			The request and response are recorded as usual, and cookies
+			come from the real headers, but we don't download the body.
+		"""
+		self.devtools_client.add_event_handler('Fetch.requestPaused', self.handle_paused_request)
+
+		patterns = json.dumps([{'resourceType': resource_type, 'requestStage': 'Response'} for resource_type in self.lean_resource_types])
+		response = self.get_single_ws_response('Fetch.enable',f'"patterns":{patterns}')
+		if response['success'] == False: return response
+		if 'result' not in response['result']:
+			return ({
+				'success'	: False,
+				'result'	: 'No result for ws command'
+			})
+
+		return ({
+			'success'	: True,
+			'result'	: None
+		})
+	# enable_lean_mode
+
+	def handle_paused_request(self, event):
+		"""
+		Answers a request paused by enable_lean_mode.  This runs in the
+			devtools reader thread, so we send our command without
+			waiting on the response.
+		"""
+		params = event['params']
+
+		# let errors and redirects carry on as normal
+		status = params.get('responseStatusCode')
+		if status == None or 'responseErrorReason' in params or 300 <= status < 400:
+			self.send_ws_command('Fetch.continueRequest','"requestId":"%s"' % params['requestId'])
+			return
+
+		# the body is not the one the headers describe anymore
+		headers = [
+			header for header in params.get('responseHeaders',[])
+			if header['name'].lower() not in ('content-length','content-encoding','transfer-encoding')
+		]
+
+		# a blank 1x1 gif keeps image layout sane, anything else gets
+		#	an empty body
+		if params['resourceType'] == 'Image':
+			body = 'R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7'
+		else:
+			body = ''
+
+		if 'networkId' in params: self.stubbed_request_ids.add(params['networkId'])
+
+		self.send_ws_command('Fetch.fulfillRequest','"requestId":"%s","responseCode":%s,"responseHeaders":%s,"body":"%s"' % (
+			params['requestId'],
+			status,
+			json.dumps(headers),
+			body
+		))
+	# handle_paused_request
+
+	def get_scroll_limit(self, config, key):
+		"""
+		Returns the scroll limit for key as a number, a null value
+			means there is no limit so we use infinity, which still
+			compares normally and json encodes to Infinity for the
+			scroll script.  Anything else we can't use is treated
+			the same way after a warning.
+		"""
+		limit = config[key]
+		if limit == None: return float('inf')
+		try:
+			limit = float(limit)
+		except:
+			print(f'{key} is not a number ({limit}), scrolling without a limit')
+			return float('inf')
+		if limit < 0:
+			print(f'{key} is negative ({limit}), scrolling without a limit')
+			return float('inf')
+		return limit
+	# get_scroll_limit
+
+	def load_script(self, path):
+		"""
+		Returns the contents of the js file at path, which is only read
+			from disk the first time.  Raises if the file can't be read,
+			callers handle that.
+		"""
+		if path not in ChromeDriver.script_cache:
+			with open(path, 'r', encoding='utf-8') as js_file:
+				ChromeDriver.script_cache[path] = js_file.read()
+		return ChromeDriver.script_cache[path]
+	# load_script
+
+	def add_scroll_script(self):
+		"""
+		Has chrome run wbxr_scroll.js in each new document, which
+			scrolls the page itself within our depth and time budget.
+			Returns the identifier needed to remove the script.
+		"""
+		try:
+			js = self.load_script('./resources/injections/wbxr_scroll.js')
+		except:
+			return ({
+				'success'	: False,
+				'result'	: 'Unable to inject wbxr_scroll.js, does the file exist?'
+			})
+
+		js = json.dumps(js + f'\nwbxr_start_scroll({json.dumps(self.scroll_max_depth)}, {json.dumps(self.scroll_max_seconds)});')
+		response = self.get_single_ws_response('Page.addScriptToEvaluateOnNewDocument',f'"source":{js}')
+		if response['success'] == False: return response
+		if 'result' not in response['result']:
+			return ({
+				'success'	: False,
+				'result'	: 'No result for ws command'
+			})
+
+		return ({
+			'success'	: True,
+			'result'	: response['result']['result']['identifier']
+		})
+	# add_scroll_script
+
 # ChromeDriver
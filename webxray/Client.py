@@ -9,21 +9,26 @@ import os
 import re
 import socket
 import sys
+import threading
 import time
 import urllib.parse
 import urllib.request
 
 
+from webxray.ChromeBrowserPool import ChromeBrowserPool
 from webxray.ChromeDriver import ChromeDriver
 
 class Client:
-	def __init__(self, server_url, pool_size=None):
+	def __init__(self, server_url, pool_size=None, targets_per_browser=1):
 		"""
 		Init allows us to set a custom pool_size, otherwise
-			we base on CPU count.
+			we base on CPU count.  targets_per_browser sets
+			how many scans each process runs at once in its
+			browser.
 		"""
 
-		self.server_url = server_url
+		self.server_url 			= server_url
+		self.targets_per_browser	= targets_per_browser
 
 		if pool_size:
 			self.pool_size = pool_size
@@ -32,6 +37,38 @@ class Client:
 	# __init__
 
 	def get_and_process_client_tasks(self,proc_num):
+		"""
+		Sets up a warm browser for this process and starts
+			targets_per_browser threads which run the main loop,
+			each thread drives its own target in the shared browser.
+		"""
+
+		# we keep a warm browser between tasks, each task gets
+		#	a fresh browser context from ChromeDriver
+		browser_pool = ChromeBrowserPool()
+
+		# if anything goes wrong we still need to close the browser,
+		#	otherwise it is orphaned when this process exits
+		try:
+			if self.targets_per_browser == 1:
+				self.process_client_tasks(proc_num, browser_pool)
+			else:
+				threads = []
+				for thread_num in range(0,self.targets_per_browser):
+					thread = threading.Thread(
+						target=self.process_client_tasks,
+						args=(f'{proc_num}.{thread_num}', browser_pool)
+					)
+					thread.start()
+					threads.append(thread)
+				for thread in threads:
+					thread.join()
+		finally:
+			browser_pool.close()
+		return
+	# get_and_process_client_tasks
+
+	def process_client_tasks(self,proc_num,browser_pool):
 		"""
 		This is the main loop that should run indefintely. Purpose is to
 			send server "ready" message to get tasks which are either wait,
@@ -87,6 +124,11 @@ class Client:
 			elif task == 'get_scan' or task == 'get_policy' or task == 'get_crawl' or task == 'get_random_crawl':
 				target 			= command_params['target']
 				client_config 	= command_params['client_config']
+				lease_token 	= command_params.get('lease_token')
+
+				# the server can't read our disk, so bodies have to
+				#	travel in the result rather than being spooled
+				client_config['client_body_spool_dir'] = None
 			else:
 				print(f'[{proc_num}]\t🥴 CANNOT READ COMMAND SET, EXITING')
 				return
@@ -94,7 +136,8 @@ class Client:
 			if debug: print('[%s]\t🚗 setting up driver' % proc_num)
 			
 			if client_config['client_browser_type'] == 'chrome':
-				browser_driver 	= ChromeDriver(client_config, port_offset=proc_num)
+				browser 		= browser_pool.get_browser(client_config)
+				browser_driver 	= ChromeDriver(client_config, browser=browser)
 			else:
 				print('[%s]\t🥴 INVALID BROWSER TYPE, HARD EXIT!' % proc_num)
 				exit()
@@ -110,6 +153,10 @@ class Client:
 			elif task == 'get_random_crawl':
 				task_result = browser_driver.get_random_crawl(target)
 
+			# close our target, the browser stays up for the next task
+			browser_driver.exit()
+			browser_pool.release(browser)
+
 			# unpack result
 			success 	= task_result['success']
 			task_result	= task_result['result']
@@ -128,7 +175,8 @@ class Client:
 				'success'		: json.dumps(success),
 				'target'		: json.dumps(target),
 				'task'			: task,
-				'task_result' 	: task_result
+				'task_result' 	: task_result,
+				'lease_token'	: lease_token
 			})
 
 			data = data.encode('utf-8')
@@ -153,7 +201,7 @@ class Client:
 				time.sleep(5)
 
 		return
-	# get_and_process_client_tasks
+	# process_client_tasks
 
 	def run_client(self):
 		if sys.platform == 'darwin' and multiprocessing.get_start_method(allow_none=True) != 'forkserver':
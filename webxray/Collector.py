@@ -8,13 +8,17 @@ import time
 import base64
 import random
 import hashlib
+import math
+import threading
 import multiprocessing
 from datetime import datetime
 from datetime import timedelta
 
 # custom webxray classes
+from webxray.ChromeBrowserPool 	import ChromeBrowserPool
 from webxray.ChromeDriver 		import ChromeDriver
 from webxray.OutputStore		import OutputStore
+from webxray.ParseURL			import ParseURL
 from webxray.Utilities 			import Utilities
 
 class Collector:
@@ -42,6 +46,16 @@ class Collector:
 		self.debug				= True
 		self.utilities			= Utilities()
 
+		# set by run(), how many scans each process runs at
+		#	once in its browser
+		self.targets_per_browser = 1
+
+		# when we last returned expired leases to the queue
+		self.last_lease_reclaim = 0
+
+		# when we last removed spooled bodies left by failed scans
+		self.last_spool_sweep 	= 0
+
 		# get global config for this db
 		if db_name:
 			# set up database connection
@@ -55,6 +69,9 @@ class Collector:
 				print('INVALID DB ENGINE FOR %s, QUITTING!' % db_engine)
 				quit()
 
+			# dbs made by older versions may be missing columns
+			sql_driver.upgrade_wbxr_db()
+
 			self.config = sql_driver.get_config()
 			self.browser_config = {}
 
@@ -63,19 +80,74 @@ class Collector:
 					self.browser_config[item] = self.config[item]
 
 			sql_driver.close()
+
+			# used to find the domain of a task for timing profiles
+			self.url_parser = ParseURL()
+
+			# domain -> (timing profile, unix time it expires), built from
+			#	page history and rebuilt every domain_timing_profile_ttl
+			#	seconds so new load times are taken into account
+			self.domain_timing_profiles 	= {}
+			self.domain_timing_profile_ttl 	= 300
 	# __init__
 
 	def process_tasks_from_queue(self,process_num):
+		"""
+		Sets up a warm browser for this process and starts
+			targets_per_browser threads which pull tasks from
+			the queue, each thread drives its own target in the
+			shared browser.  Returns once all threads are done.
+		"""
+
+		print('\t[p.%s]\t🏃‍♂️ Starting process' % process_num)
+
+		# each worker keeps a warm browser which is re-used across tasks, note
+		#	each task still gets a fresh profile as ChromeDriver creates a
+		#	new browser context for every target
+		browser_pool = ChromeBrowserPool(self.browser_config)
+
+		# if anything goes wrong we still need to close the browser,
+		#	otherwise it is orphaned when this process exits
+		try:
+			if self.targets_per_browser == 1:
+				self.process_tasks_with_browser(process_num, browser_pool)
+			else:
+				threads = []
+				for thread_num in range(0,self.targets_per_browser):
+					thread = threading.Thread(
+						target=self.process_tasks_with_browser,
+						args=(f'{process_num}.{thread_num}', browser_pool)
+					)
+					thread.start()
+					threads.append(thread)
+				for thread in threads:
+					thread.join()
+		finally:
+			# tidy up
+			browser_pool.close()
+
+		if self.debug:
+			cache_stats = self.utilities.url_parser.get_cache_stats()
+			print(f"\t[p.{process_num}]\t📊 Domain parse cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, {cache_stats['evictions']} evictions, {cache_stats['size']} cached")
+
+		print('\t[p.%s]\t✋ Completed process' % process_num)
+		return
+	# process_tasks_from_queue
+
+	def process_tasks_with_browser(self,process_num,browser_pool):
 		"""
 		Selects the next page from the task_queue and passes to 
 			process_url.  If load is unsucessful places page
 			back into queue and updates attempts.  Returns once 
 			when there are no pages in the queue under max_attempts.
-		"""
 
-		print('\t[p.%s]\t🏃‍♂️ Starting process' % process_num)
+		process_num is only used to label output, the browser
+			comes from browser_pool which may be shared with
+			other threads.
+		"""
 
-		# need a local connection for each queue manager
+		# need a local connection for each queue manager, db
+		#	connections cannot be shared between threads
 		if self.db_engine == 'sqlite':
 			from webxray.SQLiteDriver import SQLiteDriver
 			sql_driver = SQLiteDriver(self.db_name)
@@ -86,58 +158,111 @@ class Collector:
 			print('INVALID DB ENGINE FOR %s, QUITTING!' % db_engine)
 			quit()
 
+		# we lease tasks in batches to cut down on round trips to the
+		#	db, they wait here until we get to them
+		task_buffer 		= []
+		buffer_expires 		= 0
+
+		# results are stored by this thread
+		output_store 		= OutputStore(self.db_name, self.db_engine)
+
 		# keep getting tasks from queue until none are left at max attempt level
-		while sql_driver.get_task_queue_length(max_attempts=self.config['max_attempts'], unlocked_only=True) != 0:
-			# it is possible for two processes to both pass the above conditional
-			#	and then try to get a task from the queue at the same time.
-			#	however, the second process that attempts to get a task will
-			#	get an empty result (and crash), so we have a try/except block here
-			#	to handle that condition gracefully
-			try:
-				target, task = sql_driver.get_task_from_queue(max_attempts=self.config['max_attempts'],client_id=self.client_id)
-			except:
-				break
+		while True:
+			# if we held on to the batch past its lease somebody else may
+			#	be given these tasks, so hand back any which are still
+			#	ours and start over
+			if len(task_buffer) != 0 and time.time() > buffer_expires:
+				for target, task, lease_token in task_buffer:
+					sql_driver.release_task_lease(target, task, self.client_id, lease_token)
+				task_buffer = []
+
+			if len(task_buffer) == 0:
+				# return tasks orphaned by crashed workers to the queue,
+				#	no need to do this more than once a minute
+				if time.time() - self.last_lease_reclaim > 60:
+					self.last_lease_reclaim = time.time()
+					reclaimed = sql_driver.reclaim_expired_leases()
+					if reclaimed: print(f'\t[p.{process_num}]\t♻️  Reclaimed {reclaimed} tasks with expired leases')
+
+				# failed scans leave their spooled bodies behind, anything
+				#	untouched for an hour is no longer wanted
+				if self.browser_config['client_body_spool_dir'] and time.time() - self.last_spool_sweep > 600:
+					self.last_spool_sweep = time.time()
+					removed = output_store.remove_stale_spooled_files(self.browser_config['client_body_spool_dir'], 3600)
+					if removed and self.debug: print(f'\t[p.{process_num}]\t🧹 Removed {removed} stale spooled bodies')
+
+				buffer_expires = time.time() + self.config['task_lease_seconds']
+				task_buffer = sql_driver.lease_tasks(
+					self.config['task_lease_batch_size'],
+					client_id 			= self.client_id,
+					lease_seconds 		= self.config['task_lease_seconds'],
+					max_attempts 		= self.config['max_attempts'],
+					max_domain_leases 	= self.config['max_domain_leases']
+				)
+
+				if len(task_buffer) == 0:
+					# failed tasks may be waiting out their retry delay, or
+					#	their domain may be at max_domain_leases, if so wait
+					#	a bit, otherwise there is nothing left for us to do
+					retry_wait = sql_driver.get_seconds_until_next_task(self.config['max_attempts'])
+					if retry_wait == None: break
+					if self.debug: print(f'\t[p.{process_num}]\t⏳ Waiting {round(retry_wait)}s for tasks to become available')
+					time.sleep(min(max(retry_wait, 5), 60))
+					continue
+
+			target, task, lease_token = task_buffer.pop(0)
+
+			# the task may have been waiting in our buffer, restart the clock,
+			#	if the lease was reclaimed in the meantime it is not ours to run
+			lease_token = sql_driver.renew_task_lease(target, task, self.config['task_lease_seconds'], self.client_id, lease_token)
+			if lease_token == None:
+				if self.debug: print(f'\t[p.{process_num}]\t🤷 Lost lease on {target[:50]}, skipping')
+				continue
 
 			print('\t[p.%s]\t👉 Initializing: %s for target %s' % (process_num,task,target[:50]))
 
 			# import and set up specified browser driver
-			# 	note we set up a new browser each time to 
-			#	get a fresh profile
+			# 	note we only launch a new browser if we don't have one
+			#	or the one we have is no longer usable
 			if self.browser_config['client_browser_type'] == 'chrome':
-				browser_driver 	= ChromeDriver(self.browser_config, port_offset=process_num)
+				task_config		= self.get_task_browser_config(target, task, sql_driver)
+				browser 		= browser_pool.get_browser()
+				browser_driver 	= ChromeDriver(task_config, browser=browser)
 			else:
 				print(f"🥴 INVALID BROWSER TYPE for {self.browser_config['client_browser_type']}!")
 				return
 
+			# crawls can run long, so they renew the lease after each page
+			def renew_lease():
+				nonlocal lease_token
+				lease_token = sql_driver.renew_task_lease(target, task, self.config['task_lease_seconds'], self.client_id, lease_token)
+
 			# does the webxray scan or policy capture
 			if task == 'get_scan':
 				task_result = browser_driver.get_scan(target)
 			elif task == 'get_crawl':
-				task_result = browser_driver.get_crawl(json.loads(target))
+				task_result = browser_driver.get_crawl(json.loads(target), progress_callback=renew_lease)
 			elif task == 'get_policy':
 				task_result = browser_driver.get_scan(target, get_text_only=True)
 			elif task == 'get_random_crawl':
-				task_result = browser_driver.get_random_crawl(target)
+				task_result = browser_driver.get_random_crawl(target, progress_callback=renew_lease)
 			
-			# kill browser
+			# close our target, the browser stays up for the next task
+			browser_driver.exit()
 			del browser_driver
+			browser_pool.release(browser)
 
 			# browser has failed to get result, unlock and continue
 			if task_result['success'] == False:
 				print('\t[p.%s]\t👎 Error: %s %s' % (process_num, target[:50],task_result['result']))
 
-				# for times we don't want to retry, such as a rejected 
-				#	redirect or network resolution failure, this could be expanded
-				fail_cases = [
-					'reached fail limit',
-					'rejecting redirect',
-					'did not find enough internal links'
-				]
-				
-				if task_result['result'] in fail_cases or 'ERR_NAME_NOT_RESOLVED' in task_result['result']:
-					sql_driver.set_task_as_failed(target, task)
+				# errors which won't go away fail the task, otherwise
+				#	it is retried after a delay which grows each attempt
+				retry_delay = self.utilities.get_retry_delay(task_result['result'])
+				if retry_delay == None:
+					sql_driver.set_task_as_failed(target, task, self.client_id, lease_token)
 				else:
-					sql_driver.unlock_task_in_queue(target, task)
+					sql_driver.reschedule_task(target, task, retry_delay, self.client_id, lease_token)
 
 				# keep track of error regardless of fail/unlock
 				sql_driver.log_error({
@@ -156,7 +281,9 @@ class Collector:
 					'target'		: target,
 					'task'			: task,
 					'task_result'	: task_result['result'],
-					'client_id'		: self.client_id
+					'client_id'		: self.client_id,
+					'lease_token'	: lease_token,
+					'output_store'	: output_store
 				})
 
 			if store_result['success'] == True:
@@ -165,12 +292,76 @@ class Collector:
 				print(f'\t[p.{process_num}]\t👎 Error: {target[:50]} {store_result["result"]}')
 
 		# tidy up
+		output_store.close()
 		sql_driver.close()
 		del sql_driver
-
-		print('\t[p.%s]\t✋ Completed process' % process_num)
 		return
-	# process_tasks_from_queue
+	# process_tasks_with_browser
+
+	def get_task_browser_config(self, target, task, sql_driver):
+		"""
+		Returns the browser_config to use for this task.  When adaptive_waits_enabled
+			is set we use the timing profile for the domain of the target to set
+			no_event_wait and max_wait, otherwise the global values are used.
+		"""
+		if not self.config['adaptive_waits_enabled']: return self.browser_config
+
+		# crawls cover several pages, so we stick with the global values
+		if task == 'get_crawl': return self.browser_config
+
+		parsed_domain = self.url_parser.get_parsed_domain_info(target)
+		if parsed_domain['success'] == False: return self.browser_config
+		domain = parsed_domain['result']['domain']
+
+		if domain not in self.domain_timing_profiles or time.time() > self.domain_timing_profiles[domain][1]:
+			self.domain_timing_profiles[domain] = (
+				self.get_domain_timing_profile(domain, sql_driver),
+				time.time() + self.domain_timing_profile_ttl
+			)
+
+		timing_profile = self.domain_timing_profiles[domain][0]
+		if timing_profile == None: return self.browser_config
+
+		if self.debug: print(f'\t\t⏱  Timing profile for {domain}: {timing_profile}')
+
+		task_config = self.browser_config.copy()
+		task_config['client_no_event_wait'] = timing_profile['no_event_wait']
+		task_config['client_max_wait'] 		= timing_profile['max_wait']
+		return task_config
+	# get_task_browser_config
+
+	def get_domain_timing_profile(self, domain, sql_driver):
+		"""
+		Builds no_event_wait and max_wait values for a domain based on
+			how long its pages took to load in past scans, bounded by
+			the floors and ceilings in the config.  Returns None if we
+			don't have enough history to go on.
+		"""
+		history = sql_driver.get_domain_load_times(domain)
+		if len(history) < 3: return None
+
+		# we size the waits to the slow end of what we have seen
+		#	so the occasional slow load isn't cut short
+		load_times = sorted([float(load_time) for load_time,no_event_wait,max_wait in history])
+		slow_load_time = load_times[int(0.9*(len(load_times)-1))]
+
+		no_event_wait 	= math.ceil(slow_load_time/4)
+		max_wait 		= math.ceil(slow_load_time*2 + self.config['client_prewait'])
+
+		# if most recent scans ran into max_wait the load_time we have is
+		#	not the real one, so give the page as long as we are allowed
+		hit_max_wait = 0
+		for load_time,no_event_wait_used,max_wait_used in history:
+			if max_wait_used and float(load_time) >= 0.9*float(max_wait_used):
+				hit_max_wait += 1
+		if hit_max_wait > len(history)/2:
+			max_wait = self.config['adaptive_max_wait_max']
+
+		return ({
+			'no_event_wait' : min(max(no_event_wait, self.config['adaptive_no_event_wait_min']), self.config['adaptive_no_event_wait_max']),
+			'max_wait' 		: min(max(max_wait, self.config['adaptive_max_wait_min']), self.config['adaptive_max_wait_max'])
+		})
+	# get_domain_timing_profile
 
 	def store_result(self, params):
 		"""
@@ -190,6 +381,20 @@ class Collector:
 		else:
 			client_ip = None
 
+		# results which came through the server's result_queue don't
+		#	carry a lease, if we can't store them the task is left
+		#	locked until its lease runs out and it is reclaimed
+		if 'lease_token' in params:
+			lease_token = params['lease_token']
+		else:
+			lease_token = None
+
+		# the caller may have an output_store it keeps between results
+		if 'output_store' in params:
+			output_store = params['output_store']
+		else:
+			output_store = None
+
 		# if db_name is specified we are running in server mode and we
 		#	connect to the db which corresponds to the result being
 		#	processed.  otherwise, we use the global db_name as we are
@@ -204,7 +409,7 @@ class Collector:
 			else:
 				print('INVALID DB ENGINE FOR %s, QUITTING!' % db_engine)
 				quit()
-			output_store 	= OutputStore(params['db_name'], self.db_engine)
+			if not output_store: output_store = OutputStore(params['db_name'], self.db_engine)
 		else:
 			if self.db_engine == 'sqlite':
 				from webxray.SQLiteDriver import SQLiteDriver
@@ -216,7 +421,7 @@ class Collector:
 				print('INVALID DB ENGINE FOR %s, QUITTING!' % db_engine)
 				quit()
 
-			output_store 	= OutputStore(self.db_name, self.db_engine)
+			if not output_store: output_store = OutputStore(self.db_name, self.db_engine)
 
 		if task == 'get_policy':
 			store_result = output_store.store_policy(task_result, client_id, client_ip=client_ip)
@@ -275,6 +480,11 @@ class Collector:
 				if store_result['success'] != True:
 					all_crawls_ok = False
 				else:
+					# bodies we spooled to disk are in the db now, if we failed
+					#	another scan may still want them so they are left for
+					#	the stale file sweep
+					output_store.remove_spooled_files(result['response_bodies'])
+
 					# we are successful, create entries in page_lookup table
 					page_lookup_table = self.build_lookup_table('page', store_result['page_id'], {
 						'requests'		: store_result['page_3p_request_domains'],
@@ -313,7 +523,8 @@ class Collector:
 					sql_driver.add_crawl_id_domain_lookup_item(crawl_lookup_table[lookup_item])
 
 			else:
-				sql_driver.unlock_task_in_queue(target, task)
+				if lease_token != None:
+					sql_driver.unlock_task_in_queue(target, task, client_id, lease_token)
 				# log error
 				sql_driver.log_error({
 					'client_id'	: client_id,
@@ -323,8 +534,8 @@ class Collector:
 				})
 				result = {'success': False, 'result': 'unable to store all crawl loads'}
 
-		# tidy up
-		output_store.close()
+		# tidy up, unless the output_store belongs to the caller
+		if 'output_store' not in params: output_store.close()
 		sql_driver.close()
 		
 		# done
@@ -371,6 +582,19 @@ class Collector:
 		return domain_lookup_table
 	# build_lookup_table
 
+	def get_task_domain(self, target, task):
+		"""
+		Returns the domain a task will load, used to keep too many
+			tasks for the same site from running at once.  For crawls
+			we use the first page in the list.  Returns None if the
+			domain can't be determined.
+		"""
+		if task == 'get_crawl': target = json.loads(target)[0]
+		parsed_domain = self.url_parser.get_parsed_domain_info(target)
+		if parsed_domain['success'] == False: return None
+		return parsed_domain['result']['domain']
+	# get_task_domain
+
 	def build_crawl_task_queue(self, params):
 		"""
 		Enter crawl tasks to the database after performing checks to 
@@ -404,6 +628,9 @@ class Collector:
 		if flush_crawl_task_queue: 
 			sql_driver.flush_task_queue(task='get_crawl')
 
+		# number of tasks queued per domain, lets us interleave sites
+		domain_counts = {}
+
 		for count,url_list in enumerate(crawl_list):
 			# first make sure the urls are valid, if we 
 			#	encounterd a non-valid url we trash the
@@ -439,7 +666,11 @@ class Collector:
 					continue
 
 			# we have a valid list, queue it up!
-			if url_list_valid: sql_driver.add_task_to_queue(json.dumps(idna_url_list),'get_crawl')
+			if url_list_valid: 
+				target = json.dumps(idna_url_list)
+				domain = self.get_task_domain(target, 'get_crawl')
+				domain_counts[domain] = domain_counts.get(domain, 0) + 1
+				sql_driver.add_task_to_queue(target, 'get_crawl', domain=domain, domain_rank=domain_counts[domain])
 			print(f'\t{count} | {str(idna_url_list)[:30]}... Adding to queue.')
 			
 		# done
@@ -494,6 +725,9 @@ class Collector:
 
 		# simple counter used solely for updates to CLI
 		count = 0
+
+		# number of tasks queued per domain, lets us interleave sites
+		domain_counts = {}
 		
 		print('\t---------------------')
 		print('\t Building Page Queue ')
@@ -526,7 +760,9 @@ class Collector:
 
 			# add to the queue, duplicates will be
 			#	ignored
-			sql_driver.add_task_to_queue(url, task)
+			domain = self.get_task_domain(url, task)
+			domain_counts[domain] = domain_counts.get(domain, 0) + 1
+			sql_driver.add_task_to_queue(url, task, domain=domain, domain_rank=domain_counts[domain])
 			print(f'\t\t{count} | {url[:30]}... Adding to queue.')
 		
 		# close the db connection
@@ -560,6 +796,9 @@ class Collector:
 		for policy_url, in sql_driver.get_scanned_policy_urls():
 			scanned_policies.append(policy_url)
 
+		# number of tasks queued per domain, lets us interleave sites
+		domain_counts = {}
+
 		# run the query and add to list
 		for policy_url, in sql_driver.get_policies_to_collect():
 			# if page has an anchor, we drop everything after
@@ -574,7 +813,9 @@ class Collector:
 			# already did it, skip
 			if policy_url in scanned_policies: continue
 			
-			sql_driver.add_task_to_queue(policy_url,'get_policy')
+			domain = self.get_task_domain(policy_url, 'get_policy')
+			domain_counts[domain] = domain_counts.get(domain, 0) + 1
+			sql_driver.add_task_to_queue(policy_url, 'get_policy', domain=domain, domain_rank=domain_counts[domain])
 
 		# fyi
 		print('\t%s pages in task_queue for get_policy' % sql_driver.get_task_queue_length(task='get_policy'))
@@ -641,7 +882,7 @@ class Collector:
 		return
 	# store_results_from_queue
 
-	def run(self, task='process_tasks_from_queue', pool_size=None):
+	def run(self, task='process_tasks_from_queue', pool_size=None, targets_per_browser=1):
 		"""
 		this function manages the parallel processing of the url list using the python Pool class
 
@@ -650,11 +891,14 @@ class Collector:
 
 		then the page list is mapped to the process_url function  and executed in parallell
 
-		pool_size is defined in the run_webxray.py file, see details there
+		pool_size and targets_per_browser are defined in the run_webxray.py file, see details there
 
 		when running in slave mode the list is skipping and we got straight to scanning
 		"""
 
+		# each process runs this many scans at once in its browser
+		self.targets_per_browser = targets_per_browser
+
 		if task == 'process_tasks_from_queue':
 			# set up sql connection to get queue_length	
 			if self.db_engine == 'sqlite':
@@ -0,0 +1,148 @@
+import socket
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+
+class DNSResolver:
+	"""
+	Resolves host names to ip addresses with a pool of threads so
+		many lookups can be waiting on dns at once, and keeps the
+		answers, including failed lookups, for a while so we don't
+		ask about the same host over and over.
+
+	socket.gethostbyname doesn't tell us the ttl of the record, so
+		answers are kept for ttl seconds and failures for negative_ttl
+		seconds.  We keep at most max_size answers, dropping the least
+		recently used, and expired answers are swept out every
+		sweep_interval seconds.
+
+	By default we use the system resolver, but lookup can be any
+		function which takes a host and returns its ip address, or
+		raises if it can't, eg a stub which answers from a dict so
+		tests don't touch the network.
+	"""
+
+	def __init__(self, lookup=None, max_workers=16, ttl=300, negative_ttl=60, max_size=10000, sweep_interval=60):
+		if lookup:
+			self.lookup = lookup
+		else:
+			self.lookup = socket.gethostbyname
+
+		self.ttl 			= ttl
+		self.negative_ttl 	= negative_ttl
+
+		# host -> (ip_addr or None, time.monotonic() it expires), least
+		#	recently used first
+		self.cache 			= OrderedDict()
+		self.max_size 		= max_size
+		self.sweep_interval = sweep_interval
+		self.last_sweep 	= time.monotonic()
+
+		# host -> Future, so a host being looked up is only asked
+		#	about once however many callers want it
+		self.pending 		= {}
+
+		self.lock 			= threading.Lock()
+		self.executor 		= ThreadPoolExecutor(max_workers=max_workers)
+	# __init__
+
+	def resolve(self, host):
+		"""
+		Returns the ip address of host, or None if it can't be
+			resolved.
+		"""
+		return self.get_future(host).result()
+	# resolve
+
+	def resolve_many(self, hosts):
+		"""
+		Looks up all the hosts at once, returns a dict of host to
+			ip address, which is None for hosts that can't be resolved.
+		"""
+		host_to_future = {}
+		for host in hosts:
+			if host not in host_to_future:
+				host_to_future[host] = self.get_future(host)
+
+		host_to_ip_addr = {}
+		for host, future in host_to_future.items():
+			host_to_ip_addr[host] = future.result()
+		return host_to_ip_addr
+	# resolve_many
+
+	def prefetch(self, hosts):
+		"""
+		Starts looking up the hosts without waiting for the answers,
+			so they are likely cached by the time we need them.
+		"""
+		for host in hosts:
+			self.get_future(host)
+	# prefetch
+
+	def get_future(self, host):
+		"""
+		Returns a Future holding the ip address of host, which is
+			already done if we have a current answer.
+		"""
+		with self.lock:
+			if host in self.cache:
+				ip_addr, expires = self.cache[host]
+				if expires > time.monotonic():
+					self.cache.move_to_end(host)
+					future = Future()
+					future.set_result(ip_addr)
+					return future
+				del self.cache[host]
+
+			if host not in self.pending:
+				self.pending[host] = self.executor.submit(self.do_lookup, host)
+			return self.pending[host]
+	# get_future
+
+	def do_lookup(self, host):
+		"""
+		Runs in the thread pool, does the actual lookup and caches
+			the answer.
+		"""
+		try:
+			ip_addr = self.lookup(host)
+		except:
+			ip_addr = None
+
+		if ip_addr:
+			expires = time.monotonic() + self.ttl
+		else:
+			expires = time.monotonic() + self.negative_ttl
+
+		with self.lock:
+			self.cache[host] = (ip_addr, expires)
+			self.cache.move_to_end(host)
+			self.pending.pop(host, None)
+
+			if time.monotonic() - self.last_sweep > self.sweep_interval:
+				self.remove_expired()
+			while len(self.cache) > self.max_size:
+				self.cache.popitem(last=False)
+		return ip_addr
+	# do_lookup
+
+	def remove_expired(self):
+		"""
+		Drops answers which have expired, the caller must hold the lock.
+		"""
+		now = time.monotonic()
+		for host in [host for host, (ip_addr, expires) in self.cache.items() if expires <= now]:
+			del self.cache[host]
+		self.last_sweep = now
+	# remove_expired
+
+	def close(self):
+		"""
+		Tidy things up before exiting.
+		"""
+		self.executor.shutdown(wait=False)
+	# close
+
+# DNSResolver
@@ -0,0 +1,258 @@
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+# orjson decodes considerably faster than the standard library, we use
+#	it when installed but don't require it
+# pip3 install orjson
+try:
+	import orjson
+	json_loads = orjson.loads
+except ImportError:
+	json_loads = json.loads
+
+# websocket-client library is needed to talk to chrome devtools
+# 	the github repo for library is here:
+#		https://github.com/websocket-client/websocket-client
+# pip3 install websocket-client
+from websocket import create_connection
+
+class DevToolsClient:
+	"""
+	Transport for a single DevTools websocket connection.
+
+	A reader thread owns the socket and does nothing but receive
+		messages.  Command responses are routed by id to the Future
+		which was handed out when the command was sent, and events are
+		either passed to a handler registered for that method or placed
+		on the event queue.  This way callers block until there is
+		actually something for them rather than polling the socket with
+		a timeout and sleeping when nothing shows up.
+
+	Decoding every frame is most of the work the reader does, and on
+		a busy page most events are ones nobody reads (eg thousands of
+		Network.dataReceived).  Chrome always sends the method name first
+		in an event, so we read it off the raw frame and only decode
+		events which pass the event filter, see set_event_filter().
+
+	All of webxray runs in worker processes and plain threads, and
+		websocket-client is a blocking library, so we use a thread and
+		concurrent.futures here rather than an asyncio loop which every
+		caller would then have to drive.
+	"""
+
+	def __init__(self, ws_addr):
+		# ids must be unique per connection, several threads may
+		#	send over the same connection so we guard the counter
+		self.current_ws_command_id 	= 0
+		self.send_lock 				= threading.Lock()
+
+		# ws_id -> Future
+		self.pending_futures 		= {}
+
+		# method -> function, called from the reader thread
+		self.event_handlers 		= {}
+
+		# events without a handler go here in the order received
+		self.event_queue 			= queue.Queue()
+
+		# methods and whole domains we decode events for, None means
+		#	everything, set with set_event_filter()
+		self.event_filter 			= None
+
+		# domain -> time.time() of the last event from that domain,
+		#	including events dropped by the filter
+		self.last_event_times 		= {}
+
+		# will raise if we can't connect, caller handles that
+		self.connection = create_connection(ws_addr)
+		self.connected	= True
+
+		# set False by the reader thread when it exits, under send_lock,
+		#	once it is False no new command may be sent
+		self.reading 	= True
+
+		self.reader_thread = threading.Thread(target=self.read_messages, daemon=True)
+		self.reader_thread.start()
+	# __init__
+
+	def read_messages(self):
+		"""
+		Runs in the reader thread until the connection goes away.
+		"""
+		while self.connected:
+			try:
+				raw_message = self.connection.recv()
+			except:
+				break
+
+			# skip events nobody wants without decoding them
+			method = self.get_raw_event_method(raw_message)
+			if method:
+				self.last_event_times[method.split('.',1)[0]] = time.time()
+				if not self.wants_event(method): continue
+
+			try:
+				message = json_loads(raw_message)
+			except:
+				continue
+
+			if 'id' in message:
+				future = self.pending_futures.pop(message['id'], None)
+				if future: future.set_result(message)
+			elif 'method' in message:
+				if not method:
+					self.last_event_times[message['method'].split('.',1)[0]] = time.time()
+					if not self.wants_event(message['method']): continue
+
+				if message['method'] in self.event_handlers:
+					try:
+						self.event_handlers[message['method']](message)
+					except:
+						pass
+				else:
+					self.event_queue.put(message)
+
+		# nothing more is coming, release anybody who is waiting, holding
+		#	send_lock means no command can register a future after this
+		with self.send_lock:
+			self.connected 	= False
+			self.reading 	= False
+			pending_futures = list(self.pending_futures.values())
+			self.pending_futures.clear()
+		for future in pending_futures: future.set_result(None)
+		self.event_queue.put(None)
+	# read_messages
+
+	def send_command(self, method, params=''):
+		"""
+		Sends the command and returns a Future which will hold the
+			raw response, or None if the connection dies first.  The
+			ws_id is available as future.ws_id.  Raises if the connection
+			is closed or the reader has stopped, as nobody would ever
+			resolve the Future.
+		"""
+		future = Future()
+		with self.send_lock:
+			if not self.connected or not self.reading: raise ConnectionError('DevTools connection is closed.')
+			self.current_ws_command_id += 1
+			ws_id = self.current_ws_command_id
+			future.ws_id = ws_id
+			self.pending_futures[ws_id] = future
+			try:
+				self.connection.send('{"id":%s,"method":"%s","params":{%s}}' % (ws_id,method,params))
+			except:
+				self.pending_futures.pop(ws_id, None)
+				raise
+		return future
+	# send_command
+
+	def get_response(self, method, params='', timeout=None):
+		"""
+		Sends the command and waits for the response, returns None
+			on timeout or if the connection dies.
+		"""
+		future = self.send_command(method, params)
+		try:
+			return future.result(timeout=timeout)
+		except:
+			self.pending_futures.pop(future.ws_id, None)
+			return None
+	# get_response
+
+	def get_next_event(self, timeout=None):
+		"""
+		Returns the next queued event, or None on timeout or if
+			the connection has died.  The None the reader queues when
+			it stops is put back, so every later call returns at once.
+		"""
+		try:
+			event = self.event_queue.get(timeout=timeout)
+		except queue.Empty:
+			return None
+		if event == None: self.event_queue.put(None)
+		return event
+	# get_next_event
+
+	def get_raw_event_method(self, raw_message):
+		"""
+		Returns the method of an event without decoding it, or None
+			if this is a command response or isn't laid out as we
+			expect, in which case the caller decodes it to find out.
+		"""
+		if type(raw_message) != str or not raw_message.startswith('{"method":"'): return None
+		method_end = raw_message.find('"', 11)
+		if method_end == -1: return None
+		return raw_message[11:method_end]
+	# get_raw_event_method
+
+	def wants_event(self, method):
+		"""
+		Events are kept if there is no filter, there is a handler for
+			them, or the filter has either the method (eg
+			'Network.responseReceived') or its domain (eg 'Network').
+		"""
+		if self.event_filter == None: return True
+		if method in self.event_handlers: return True
+		if method in self.event_filter: return True
+		return method.split('.',1)[0] in self.event_filter
+	# wants_event
+
+	def set_event_filter(self, methods=None):
+		"""
+		Only events for the given methods and domains are decoded and
+			passed on, others are dropped as they arrive.  Passing None
+			turns the filter off.
+		"""
+		if methods == None:
+			self.event_filter = None
+		else:
+			self.event_filter = frozenset(methods)
+	# set_event_filter
+
+	def get_last_event_time(self, domain):
+		"""
+		Returns when we last got an event from domain, as time.time(),
+			whether or not the filter let it through, or None if we
+			have never had one.
+		"""
+		return self.last_event_times.get(domain)
+	# get_last_event_time
+
+	def clear_events(self):
+		"""
+		Throws away any events which are waiting on the queue, if the
+			reader has stopped we keep its None so get_next_event
+			doesn't wait for events which will never come.
+		"""
+		while True:
+			try:
+				self.event_queue.get_nowait()
+			except queue.Empty:
+				break
+		if not self.reading: self.event_queue.put(None)
+	# clear_events
+
+	def add_event_handler(self, method, handler):
+		"""
+		Events for method will be passed to handler instead of the
+			event queue.  Handlers run in the reader thread so must
+			be quick.
+		"""
+		self.event_handlers[method] = handler
+	# add_event_handler
+
+	def close(self):
+		"""
+		Tidy things up before exiting.
+		"""
+		self.connected = False
+		try:
+			self.connection.close()
+		except:
+			pass
+	# close
+
+# DevToolsClient
@@ -3,6 +3,7 @@ import os
 import re
 import html
 import json
+import time
 import random
 import hashlib
 import lxml.html
@@ -189,6 +190,10 @@ class OutputStore:
 			# 	be for a policy, we check if it actually is policy in PolicyCollector.py
 			policy_link_terms = self.utilities.get_policy_link_terms()
 
+			# pages often have thousands of links to a handful of hosts,
+			#	so we only look up the domain id once per host
+			netloc_to_domain_id = {}
+
 			# process links, duplicates get ignored by db
 			for link in browser_output['all_links']:
 				# skip if href not valid
@@ -224,19 +229,25 @@ class OutputStore:
 				link_is_policy = False
 
 				# determine if a policy term appears in the link
+				link_text_lower = link_text.lower()
 				for policy_term in policy_link_terms:
-					if policy_term in link_text.lower():
+					if policy_term in link_text_lower:
 						link_is_policy = True
 						break
 
-				link_domain_info = self.url_parser.get_parsed_domain_info(link_url)
-				if link_domain_info['success'] == False:
-					# don't bother with storing errors
-					link_domain_id = None
+				link_netloc = urlsplit(link_url).netloc
+				if link_netloc in netloc_to_domain_id:
+					link_domain_id = netloc_to_domain_id[link_netloc]
 				else:
-					# self.sql_driver.add_domain both stores the new domain and returns its db row id
-					# 	if it is already in db just return the existing id
-					link_domain_id = self.sql_driver.add_domain(link_domain_info['result'])
+					link_domain_info = self.url_parser.get_parsed_domain_info(link_url)
+					if link_domain_info['success'] == False:
+						# don't bother with storing errors
+						link_domain_id = None
+					else:
+						# self.sql_driver.add_domain both stores the new domain and returns its db row id
+						# 	if it is already in db just return the existing id
+						link_domain_id = self.sql_driver.add_domain(link_domain_info['result'])
+					netloc_to_domain_id[link_netloc] = link_domain_id
 
 				links.append({
 					'url'			: link_url, 
@@ -403,6 +414,15 @@ class OutputStore:
 			if self.config['store_response_xtra_headers']:
 				self.sql_driver.add_response_extra_header(response_extra_header)
 
+		# the urls of responses, requests, websockets, and cookies are parsed in
+		#	one go, pages have thousands of these but only a few dozen hosts
+		page_domains = self.get_page_domains(
+			[response['url'] for response in browser_output['responses']] +
+			[request['url'] for request in browser_output['requests']] +
+			[websocket['url'] for websocket in browser_output['websockets']] +
+			['http://'+cookie['domain'] for cookie in browser_output['cookies']]
+		)
+
 		# PROCESS RESPONSES
 		response_received_req_ids = []
 		
@@ -437,7 +457,7 @@ class OutputStore:
 				response['domain_id'] = None
 			else:
 				# parse, store, and get id of domain; if fails skip
-				domain_info = self.url_parser.get_parsed_domain_info(response['url'])
+				domain_info = self.get_page_domain_info(page_domains, response['url'])
 				if domain_info['success'] == False:
 					err_msg = 'unable to parse domain info for %s with error %s' % (response['url'], domain_info['result'])
 					if self.debug: print(err_msg)
@@ -450,7 +470,7 @@ class OutputStore:
 					continue
 				else:
 					response_domain = domain_info['result']['domain']
-					response['domain_id'] = self.sql_driver.add_domain(domain_info['result'])
+					response['domain_id'] = domain_info['result']['domain_id']
 
 				# now add ip
 				if response['remote_ip_address']:
@@ -512,11 +532,17 @@ class OutputStore:
 					# make sure we're following our configuration
 					is_base64 = browser_output['response_bodies'][response['request_id']]['is_base64']
 					if self.config['store_files'] and (self.config['store_base64'] or is_base64 == False):
-						response['file_md5'] = self.store_file(
-							browser_output['response_bodies'][response['request_id']]['body'],
-							is_base64,
-							response['type']
-						)
+						if 'spool_path' in browser_output['response_bodies'][response['request_id']]:
+							response['file_md5'] = self.store_spooled_file(
+								browser_output['response_bodies'][response['request_id']],
+								response['type']
+							)
+						else:
+							response['file_md5'] = self.store_file(
+								browser_output['response_bodies'][response['request_id']]['body'],
+								is_base64,
+								response['type']
+							)
 					else:
 						response['file_md5'] = None
 
@@ -613,7 +639,7 @@ class OutputStore:
 					request['domain_id'] = None
 				else:
 					# parse, store, and get id of domain; if fails skip
-					domain_info = self.url_parser.get_parsed_domain_info(request['url'])
+					domain_info = self.get_page_domain_info(page_domains, request['url'])
 					if domain_info['success'] == False:
 						err_msg = 'unable to parse domain info for %s with error %s' % (request['url'], domain_info['result'])
 						if self.debug: print(err_msg)
@@ -626,7 +652,7 @@ class OutputStore:
 						continue
 					else:
 						request_domain = domain_info['result']['domain']
-						request['domain_id'] = self.sql_driver.add_domain(domain_info['result'])
+						request['domain_id'] = domain_info['result']['domain_id']
 
 					# mark third-party requests based on final_url domain
 					if request_domain != final_url_domain:
@@ -713,7 +739,7 @@ class OutputStore:
 			if self.debug: print('going to process websocket data %s' % browser_output['start_url'])
 			ws_id_map = {}
 			for websocket in browser_output['websockets']:
-				domain_info = self.url_parser.get_parsed_domain_info(websocket['url'])
+				domain_info = self.get_page_domain_info(page_domains, websocket['url'])
 				if domain_info['success'] == False:
 					err_msg = 'unable to parse domain info for %s with error %s' % (websocket['url'], domain_info['result'])
 					if self.debug: print(err_msg)
@@ -725,9 +751,7 @@ class OutputStore:
 					})
 					continue
 				else:
-					# self.sql_driver.add_domain both stores the new domain and returns its db row id
-					# if it is already in db just return the existing id
-					websocket['domain_id'] = self.sql_driver.add_domain(domain_info['result'])
+					websocket['domain_id'] = domain_info['result']['domain_id']
 
 				# mark if third-party connection
 				if final_url_domain != domain_info['result']['domain']:
@@ -782,7 +806,7 @@ class OutputStore:
 				#	url_parser fails on non-http, we should fix this, right now a lame hack is to prepend http://
 
 				# parse domain from the security_origin, which is equivalent to a url
-				domain_info = self.url_parser.get_parsed_domain_info('http://'+cookie['domain'])
+				domain_info = self.get_page_domain_info(page_domains, 'http://'+cookie['domain'])
 
 				if domain_info['success'] == False:
 					err_msg = 'unable to parse domain info for %s with error %s' % (cookie['domain'], domain_info['result'])
@@ -795,9 +819,7 @@ class OutputStore:
 					})
 					continue
 				else:
-					# self.sql_driver.add_domain both stores the new domain and returns its db row id
-					# if it is already in db just return the existing id
-					cookie['domain_id'] = self.sql_driver.add_domain(domain_info['result'])
+					cookie['domain_id'] = domain_info['result']['domain_id']
 
 				# mark if third-party cookie
 				if final_url_domain != domain_info['result']['domain']:
@@ -862,6 +884,56 @@ class OutputStore:
 		}
 	# store_scan
 
+	def get_page_domains(self, urls):
+		"""
+		Parses the urls with ParseURL.parse_many, get_page_domain_info
+			then looks up the domain of each url from the result, and
+			stores the domain of each host the first time it is needed.
+		"""
+		return ({
+			'url_index'		: {url: index for index, url in enumerate(urls)},
+			'parsed_urls'	: self.url_parser.parse_many(urls)['result'],
+			'host_results'	: {}
+		})
+	# get_page_domains
+
+	def get_page_domain_info(self, page_domains, url):
+		"""
+		Returns the parsed domain info of a url given to get_page_domains, as
+			get_parsed_domain_info would, with the db id of the domain added.
+			Urls with the same host share the same result, don't change it.
+		"""
+		parsed_urls = page_domains['parsed_urls']
+		url_index 	= page_domains['url_index'][url]
+		host_index 	= parsed_urls['host_index'][url_index]
+
+		if host_index == None:
+			return ({
+				'success'	: False,
+				'result'	: parsed_urls['error'][url_index]
+			})
+
+		if host_index not in page_domains['host_results']:
+			host_result = {
+				'ip_addr'			: None,
+				'fqdn'				: parsed_urls['fqdn'][host_index],
+				'domain'			: parsed_urls['domain'][host_index],
+				'pubsuffix'			: parsed_urls['pubsuffix'][host_index],
+				'tld'				: parsed_urls['tld'][host_index],
+				'domain_owner_id'	: parsed_urls['domain_owner_id'][host_index]
+			}
+
+			# self.sql_driver.add_domain both stores the new domain and returns its db row id
+			# 	if it is already in db just return the existing id
+			host_result['domain_id'] = self.sql_driver.add_domain(host_result)
+			page_domains['host_results'][host_index] = host_result
+
+		return ({
+			'success'	: True,
+			'result'	: page_domains['host_results'][host_index]
+		})
+	# get_page_domain_info
+
 	def store_file(self,body,is_base64,type):
 		"""
 		Hashes and stores file, returns file_md5.
@@ -887,6 +959,66 @@ class OutputStore:
 		return file_md5
 	# store_file
 
+	def store_spooled_file(self,body_info,type):
+		"""
+		The browser may write bodies to a spool dir rather than returning
+			them, in which case we load the body from there and store it
+			as usual.  Spool files are named by md5, so if the file is
+			gone it was most likely removed after being stored for another
+			page, in which case we can use the md5 if the file is in the db.
+		"""
+		try:
+			with open(body_info['spool_path'], 'rb') as spool_file:
+				body = spool_file.read().decode('utf-8')
+		except FileNotFoundError:
+			if self.sql_driver.file_exists(body_info['md5']):
+				return body_info['md5']
+			else:
+				print(f"Spooled body {body_info['md5']} is missing and not in db")
+				return None
+		except Exception as e:
+			print(f"Unable to load spooled body {body_info['md5']}: {e}")
+			return None
+
+		return self.store_file(body,body_info['is_base64'],type)
+	# store_spooled_file
+
+	def remove_spooled_files(self,response_bodies):
+		"""
+		Once a page is stored we don't need its spooled bodies.
+		"""
+		if not response_bodies: return
+		for body_info in response_bodies.values():
+			if body_info and 'spool_path' in body_info:
+				try:
+					os.remove(body_info['spool_path'])
+				except:
+					pass
+	# remove_spooled_files
+
+	def remove_stale_spooled_files(self,spool_dir,max_age):
+		"""
+		Spooled bodies are only removed once their page is stored,
+			so scans which fail, or pages we fail to store, leave
+			them behind.  We can't remove them straight away as
+			another scan may have spooled the same body, so instead
+			we remove files nobody has touched in max_age seconds,
+			returns how many were removed.
+		"""
+		removed = 0
+		cutoff 	= time.time() - max_age
+		for dir_path, dir_names, file_names in os.walk(spool_dir):
+			for file_name in file_names:
+				file_path = os.path.join(dir_path, file_name)
+				try:
+					if os.path.getmtime(file_path) < cutoff:
+						os.remove(file_path)
+						removed += 1
+				except FileNotFoundError:
+					pass
+		return removed
+	# remove_stale_spooled_files
+
 	def store_policy(self, browser_output, client_id, client_ip=None):
 		"""
 		We attempt to figure out if the text provided is a policy, if so
@@ -2,9 +2,15 @@
 import os
 import re
 import json
+import marshal
 import socket
+import threading
+from collections import OrderedDict
 from urllib.parse import urlsplit
 
+# custom webxray libraries
+from webxray.DNSResolver import DNSResolver
+
 class ParseURL:
 	"""
 		Given a url string, this class will return the ip address, fully-qualified domain name,
@@ -18,56 +24,202 @@ class ParseURL:
 
 		Note: the mozilla public suffix list is used for identifying pub suffixes, see https://publicsuffix.org
 
+		The same few hosts come up over and over, so results of get_parsed_domain_info
+			are kept in an LRU cache keyed by netloc which is shared by every ParseURL
+			in the process, see get_cache_stats() for how well it is doing.
+
+		Building the pubsuffix rules and domain owners from their source files is slow,
+			so we do it once per process and keep a marshalled copy on disk which is
+			rebuilt when the sources change, see get_parse_data().  Worker processes
+			forked after the parent has made a ParseURL share its copy.
 	"""
 
+	# source files for the parse data, and where we keep the compiled copy
+	pubsuffix_path 		= './resources/pubsuffix/public_suffix_list.dat'
+	domain_owners_path 	= './resources/domain_owners/domain_owners.json'
+	parse_data_path		= './resources/parse_url_data.marshal'
+
+	# bump this when the layout of the parse data changes
+	parse_data_version 	= 1
+
+	# urls we know how to parse
+	parseable_url_re 	= re.compile('^(https?|wss?)://.+')
+
+	# shared DNSResolver for ip lookups, made the first time we need
+	#	it, this can be set to a resolver with a stub lookup for tests
+	resolver 			= None
+
+	# loaded once per process by get_parse_data()
+	parse_data 			= None
+	parse_data_lock		= threading.Lock()
+
+	# netloc -> result of get_parsed_domain_info, most recently used last
+	domain_info_cache 			= OrderedDict()
+	domain_info_cache_max_size 	= 100000
+	domain_info_cache_lock 		= threading.Lock()
+	domain_info_cache_stats		= {
+		'hits'		: 0,
+		'misses'	: 0,
+		'evictions'	: 0
+	}
+
 	def __init__(self):
-		# load up the tld list now as only hit it once this way
-		self.pubsuffix_list = self.get_pubsuffix_list()
+		# these are shared by every ParseURL in the process, nothing
+		#	may change them
+		parse_data = self.get_parse_data()
+		self.pubsuffix_rules 	= parse_data['pubsuffix_rules']
+		self.domain_owners 		= parse_data['domain_owners']
+	# end __init__
+
+	def get_parse_data(self):
+		"""
+			Returns the pubsuffix rules and domain owners, which the first call in
+				a process loads from our compiled copy if it is current, otherwise
+				it builds them from the sources and writes a new copy.
+		"""
+		with ParseURL.parse_data_lock:
+			if ParseURL.parse_data: return ParseURL.parse_data
 
-		# get domain owner data
-		self.domain_owners = {}
+			# the copy is current if it was made from files with the same
+			#	size and modification time as we have now
+			source_stamp = [ParseURL.parse_data_version]
+			for path in (ParseURL.pubsuffix_path, ParseURL.domain_owners_path):
+				source_stat = os.stat(path)
+				source_stamp.append((source_stat.st_size, source_stat.st_mtime_ns))
+			source_stamp = tuple(source_stamp)
 
-		with open('./resources/domain_owners/domain_owners.json', 'r', encoding='utf-8') as json_file:
+			try:
+				with open(ParseURL.parse_data_path, 'rb') as parse_data_file:
+					parse_data = marshal.load(parse_data_file)
+				if parse_data['source_stamp'] != source_stamp: parse_data = None
+			except:
+				parse_data = None
+
+			if not parse_data:
+				parse_data = {
+					'source_stamp'		: source_stamp,
+					'pubsuffix_rules'	: self.get_pubsuffix_rules(),
+					'domain_owners'		: self.get_domain_owners()
+				}
+
+				# write to a temp file and rename so nobody reads a partly
+				#	written copy, if we can't write it we just build it
+				#	again next time
+				tmp_path = f'{ParseURL.parse_data_path}.{os.getpid()}.tmp'
+				try:
+					with open(tmp_path, 'wb') as parse_data_file:
+						marshal.dump(parse_data, parse_data_file)
+					os.replace(tmp_path, ParseURL.parse_data_path)
+				except:
+					try:
+						os.remove(tmp_path)
+					except:
+						pass
+
+			ParseURL.parse_data = parse_data
+			return parse_data
+	# get_parse_data
+
+	def get_resolver(self):
+		"""
+			Returns the DNSResolver shared by every ParseURL in the process.
+		"""
+		with ParseURL.parse_data_lock:
+			if not ParseURL.resolver: ParseURL.resolver = DNSResolver()
+			return ParseURL.resolver
+	# get_resolver
+
+	def get_domain_owners(self):
+		"""
+			Returns a dict of domain -> domain owner id.
+		"""
+		domain_owners = {}
+
+		with open(ParseURL.domain_owners_path, 'r', encoding='utf-8') as json_file:
 			domain_owner_data = json.load(json_file)
 		
 		for item in domain_owner_data:
 			# skipping for now, but perhaps find a way to enter this in db?
 			if 'revision_date' in item: continue
 			for domain in item['domains']:
-				self.domain_owners[domain] = item['id']
-	# end __init__
+				domain_owners[domain] = item['id']
+
+		return domain_owners
+	# get_domain_owners
 
-	def get_pubsuffix_list(self):
+	def get_pubsuffix_rules(self):
 		"""
-			this builds a shared list of tuples based on the pubsuffix list; tuples allow for
-			quick comparisons of smaller strings
+			this builds sets of tuples based on the pubsuffix list, one set each for
+			normal, wildcard ('*.ck' is stored as ('ck',)), and exception ('!www.ck'
+			is stored as ('www','ck')) rules.  sets of tuples let us check a suffix
+			with a single hash lookup.
 		"""
 
-		# path is relative from root webxray directory
-		pubsuffix_raw_list = open('./resources/pubsuffix/public_suffix_list.dat', mode='r', encoding='utf8')
-		pubsuffix_list = []
+		pubsuffix_rules = {
+			'rules'				: set(),
+			'wildcard_rules'	: set(),
+			'exception_rules'	: set()
+		}
 
-		for line in pubsuffix_raw_list:
+		# path is relative from root webxray directory
+		with open(ParseURL.pubsuffix_path, mode='r', encoding='utf8') as pubsuffix_raw_list:
+			for line in pubsuffix_raw_list:
 				# the last part of the list is random stuff we don't care about, so stop reading
-				if re.match("^// ===BEGIN PRIVATE DOMAINS===", line):break
-
-				# skip lines that are comments or blank, add others to list
-				if not re.match("^//.+$|^$", line):
-					# remove leading ., !, and * as it screws up regex later
-					pubsuffix_string = re.sub('^[\!\*]\.?', '', line.strip())
-					
-					# convert to idna/ascii/utf-8 for enhanced compatability
-					pubsuffix_string = pubsuffix_string.encode('idna').decode('utf-8')
-
-					# convert to a tuple so we can do faster comparisons
-					pubsuffix_list.append(tuple(pubsuffix_string.split('.')))
-		
+				if line.startswith('// ===BEGIN PRIVATE DOMAINS==='): break
+
+				# skip lines that are comments or blank
+				line = line.strip()
+				if line == '' or line.startswith('//'): continue
+
+				if line.startswith('!'):
+					rule_type 	= 'exception_rules'
+					line 		= line[1:]
+				elif line.startswith('*.'):
+					rule_type 	= 'wildcard_rules'
+					line 		= line[2:]
+				else:
+					rule_type 	= 'rules'
+
+				# convert to idna/ascii/utf-8 for enhanced compatability
+				pubsuffix_string = line.encode('idna').decode('utf-8')
+
+				# convert to a tuple so we can do faster comparisons
+				pubsuffix_rules[rule_type].add(tuple(pubsuffix_string.split('.')))
+
 		# add the pubsuffix for tor addresses
-		pubsuffix_list.append(('onion',))
+		pubsuffix_rules['rules'].add(('onion',))
 
 		# done
-		return pubsuffix_list
-	# get_pubsuffix_list
+		return pubsuffix_rules
+	# get_pubsuffix_rules
+
+	def get_domain_and_pubsuffix(self, domain_tuple):
+		"""
+			Given the labels of an fqdn as a tuple, returns a tuple of the labels of the
+				domain and pubsuffix, or None if there is no pubsuffix or nothing to
+				the left of it.  We look at each suffix of the fqdn from longest to
+				shortest, so we match on "ac.uk" *before* "uk", and exception rules
+				win over the wildcard rules they carve out of.
+		"""
+		rules 			= self.pubsuffix_rules['rules']
+		wildcard_rules 	= self.pubsuffix_rules['wildcard_rules']
+		exception_rules	= self.pubsuffix_rules['exception_rules']
+
+		for slice_point in range(0, len(domain_tuple)):
+			candidate = domain_tuple[slice_point:]
+
+			# the exception is itself the domain, one label short is the pubsuffix
+			if candidate in exception_rules:
+				return (candidate, candidate[1:])
+
+			# the pubsuffix needs a label to its left to make a domain
+			if slice_point == 0: continue
+
+			if candidate in rules or candidate[1:] in wildcard_rules:
+				return (domain_tuple[slice_point-1:], candidate)
+
+		return None
+	# get_domain_and_pubsuffix
 
 	def get_parsed_domain_info(self,url,get_ip_adrr=False):
 		"""
@@ -83,13 +235,7 @@ class ParseURL:
 			})
 
 		try:
-			# try to pull out the fully-qualified domain name (fqdn) from the netloc 
-			#	with some regex, handles cases where the port is included (eg 'example.com:1234')
-			#	drops leading/trailing '.', etc.
-			fqdn = re.search('^(\.+)?(.+?)(:.+)?(\.+)?$', urlsplit(url).netloc).group(2)
-
-			# convert to idna/ascii/utf-8 for enhanced compatability
-			fqdn = fqdn.encode('idna').decode('utf-8')
+			netloc = urlsplit(url).netloc
 		except:
 			return({
 				'success': False,
@@ -100,8 +246,9 @@ class ParseURL:
 			# to see if the fqdn is simply an ip_addr try to load it as such
 			# return the IP for all fields even though not strictly 
 			# accurate as to field values
+			fqdn = self.get_fqdn(netloc)
 			try:
-				ip_addr = socket.inet_aton(fqdn)
+				socket.inet_aton(fqdn)
 				return({
 					'success': True,
 					'result': {
@@ -113,65 +260,194 @@ class ParseURL:
 						'domain_owner_id'	: None
 					}
 				})
-			except socket.error:
+			except (socket.error, TypeError):
 				pass
 
-			# if the fqdn is not an ip_addr we use socket to get the ip_addr
-			# this will fail if the host doesn't respond to ping
-			# which often happens with cookie domains
+		domain_info = self.get_cached_netloc_domain_info(netloc)
+		if domain_info['success'] == False: return dict(domain_info)
+
+		# callers may change what we give them, so they get their own copy
+		result = dict(domain_info['result'])
+
+		# ip addresses come from dns so they aren't cached with the rest,
+		#	this will fail if the host doesn't respond to ping which
+		#	often happens with cookie domains
+		if get_ip_adrr: result['ip_addr'] = self.get_resolver().resolve(result['fqdn'])
+
+		return ({
+			'success'	: True,
+			'result'	: result
+		})
+	# get_parsed_domain_info
+
+	def parse_many(self,urls,get_ip_adrr=False):
+		"""
+			Parses a list of urls in one go, each host is only looked at once however
+				many urls share it.  The result is columnar: host_index and error have
+				an entry for each url, host_index is the position of the url's host in
+				the fqdn, domain, pubsuffix, tld, and domain_owner_id lists, or None if
+				the url could not be parsed, in which case error says why.
+
+			If get_ip_adrr is set there is also an ip_addr list, the hosts are all
+				looked up at once.
+		"""
+		result = {
+			'host_index'		: [],
+			'error'				: [],
+			'fqdn'				: [],
+			'domain'			: [],
+			'pubsuffix'			: [],
+			'tld'				: [],
+			'domain_owner_id'	: []
+		}
+
+		# netloc -> position in the host lists, or the error for that netloc
+		netloc_to_host_index = {}
+		netloc_to_error		 = {}
+
+		for url in urls:
+			if not self.parseable_url_re.match(url):
+				result['host_index'].append(None)
+				result['error'].append('Does not appear to be an http or wss address')
+				continue
+
 			try:
-				ip_addr = socket.gethostbyname(fqdn)
+				netloc = urlsplit(url).netloc
 			except:
-				ip_addr = None
-		else:
-			ip_addr = None
-
-		# convert what we have to a tuple and match against our list
-		domain_tuple = tuple(fqdn.split('.'))
-		num_tokens = len(domain_tuple)
-		slice_point = 0
-
-		# we keep dropping off the left-most token until we find a match
-		# this way we match on "ac.uk" *before* "uk"
-		while slice_point < num_tokens-1:
-			slice_point += 1
-			pubsuffix = domain_tuple[slice_point:]
-			if pubsuffix in self.pubsuffix_list:
-				# we found the pubsuffix, 1 back is the domain
-				domain = domain_tuple[slice_point-1:]
-				
-				# tld is always the final token
-				tld = domain_tuple[num_tokens-1]
-
-				# glue back together domain/pubsuffix
-				domain = '.'.join(domain)
-				pubsuffix = '.'.join(pubsuffix)
-
-				# found match, see if we have an owner for domain
-				if domain in self.domain_owners:
-					domain_owner_id = self.domain_owners[domain]
+				result['host_index'].append(None)
+				result['error'].append('Could not extract fqdn')
+				continue
+
+			if netloc not in netloc_to_host_index and netloc not in netloc_to_error:
+				domain_info = self.get_cached_netloc_domain_info(netloc)
+				if domain_info['success']:
+					netloc_to_host_index[netloc] = len(result['domain'])
+					for field in ('fqdn','domain','pubsuffix','tld','domain_owner_id'):
+						result[field].append(domain_info['result'][field])
 				else:
-					domain_owner_id = None
+					netloc_to_error[netloc] = domain_info['result']
 
-				# return as strings joined on '.'
-				return({
-					'success': True,
-					'result': {
-						'ip_addr'			: ip_addr,
-						'fqdn'				: fqdn,
-						'domain'			: domain,
-						'pubsuffix'			: pubsuffix,
-						'tld'				: tld,
-						'domain_owner_id'	: domain_owner_id
-					}
-				})
+			if netloc in netloc_to_host_index:
+				result['host_index'].append(netloc_to_host_index[netloc])
+				result['error'].append(None)
+			else:
+				result['host_index'].append(None)
+				result['error'].append(netloc_to_error[netloc])
+
+		if get_ip_adrr:
+			fqdn_to_ip_addr = self.get_resolver().resolve_many(result['fqdn'])
+			result['ip_addr'] = [fqdn_to_ip_addr[fqdn] for fqdn in result['fqdn']]
 
-		# if we get to this point nothing else has worked
 		return ({
-			'success': False,
-			'result': 'Unknown error'
+			'success'	: True,
+			'result'	: result
 		})
-	# get_parsed_domain_info
+	# parse_many
+
+	def get_cached_netloc_domain_info(self,netloc):
+		"""
+			Returns get_netloc_domain_info for the netloc from the shared cache,
+				parsing it if it isn't there.  The result is shared, callers
+				must not change it.
+		"""
+		cache = ParseURL.domain_info_cache
+		stats = ParseURL.domain_info_cache_stats
+		with ParseURL.domain_info_cache_lock:
+			if netloc in cache:
+				cache.move_to_end(netloc)
+				stats['hits'] += 1
+				return cache[netloc]
+
+		domain_info = self.get_netloc_domain_info(netloc)
+		with ParseURL.domain_info_cache_lock:
+			stats['misses'] += 1
+			cache[netloc] = domain_info
+			if len(cache) > ParseURL.domain_info_cache_max_size:
+				cache.popitem(last=False)
+				stats['evictions'] += 1
+		return domain_info
+	# get_cached_netloc_domain_info
+
+	def get_netloc_domain_info(self,netloc):
+		"""
+			Does the work for get_parsed_domain_info once we have the netloc,
+				apart from looking up the ip address.
+		"""
+		fqdn = self.get_fqdn(netloc)
+		if fqdn == None:
+			return({
+				'success': False,
+				'result': 'Could not extract fqdn'
+			})
+
+		# convert what we have to a tuple and match against our rules
+		domain_tuple = tuple(fqdn.split('.'))
+		match = self.get_domain_and_pubsuffix(domain_tuple)
+
+		# if we get to this point nothing else has worked
+		if not match:
+			return ({
+				'success': False,
+				'result': 'Unknown error'
+			})
+
+		# glue back together domain/pubsuffix
+		domain 		= '.'.join(match[0])
+		pubsuffix 	= '.'.join(match[1])
+
+		# tld is always the final token
+		tld = domain_tuple[-1]
+
+		# found match, see if we have an owner for domain
+		if domain in self.domain_owners:
+			domain_owner_id = self.domain_owners[domain]
+		else:
+			domain_owner_id = None
+
+		# return as strings joined on '.'
+		return({
+			'success': True,
+			'result': {
+				'ip_addr'			: None,
+				'fqdn'				: fqdn,
+				'domain'			: domain,
+				'pubsuffix'			: pubsuffix,
+				'tld'				: tld,
+				'domain_owner_id'	: domain_owner_id
+			}
+		})
+	# get_netloc_domain_info
+
+	def get_fqdn(self,netloc):
+		"""
+			Returns the fully-qualified domain name of the netloc, or None
+				if we can't make one out.
+		"""
+		try:
+			# try to pull out the fully-qualified domain name (fqdn) from the netloc 
+			#	with some regex, handles cases where the port is included (eg 'example.com:1234')
+			#	drops leading/trailing '.', etc.
+			fqdn = re.search('^(\.+)?(.+?)(:.+)?(\.+)?$', netloc).group(2)
+
+			# convert to idna/ascii/utf-8 for enhanced compatability
+			return fqdn.encode('idna').decode('utf-8')
+		except:
+			return None
+	# get_fqdn
+
+	def get_cache_stats(self):
+		"""
+			Returns how the shared domain info cache is doing.
+		"""
+		with ParseURL.domain_info_cache_lock:
+			stats = dict(ParseURL.domain_info_cache_stats)
+			stats['size'] 		= len(ParseURL.domain_info_cache)
+			stats['max_size'] 	= ParseURL.domain_info_cache_max_size
+
+		lookups = stats['hits'] + stats['misses']
+		stats['hit_rate'] = stats['hits']/lookups if lookups else None
+		return stats
+	# get_cache_stats
 
 	def get_ip_fqdn_domain_pubsuffix_tld(self,url,get_ip_adrr=True):
 		"""
@@ -184,15 +460,10 @@ class ParseURL:
 			return None
 
 		try:
-			# try to pull out the fully-qualified domain name (fqdn) from the netloc 
-			#	with some regex, handles cases where the port is included (eg 'example.com:1234')
-			#	drops leading/trailing '.', etc.
-			fqdn = re.search('^(\.+)?(.+?)(:.+)?(\.+)?$', urlsplit(url).netloc).group(2)
-
-			# convert to idna/ascii/utf-8 for enhanced compatability
-			fqdn = fqdn.encode('idna').decode('utf-8')
+			fqdn = self.get_fqdn(urlsplit(url).netloc)
 		except:
 			return None
+		if fqdn == None: return None
 
 		if get_ip_adrr:
 			# to see if the fqdn is simply an ip_addr try to load it as such
@@ -204,35 +475,22 @@ class ParseURL:
 			except socket.error:
 				pass
 
-			# if the fqdn is not an ip_addr we use socket to get the ip_addr
+			# if the fqdn is not an ip_addr we look up the ip_addr
 			# this will fail if the host doesn't respond to ping
 			# which often happens with cookie domains
-			try:
-				ip_addr = socket.gethostbyname(fqdn)
-			except:
-				ip_addr = None
+			ip_addr = self.get_resolver().resolve(fqdn)
 		else:
 			ip_addr = None
 
-		# convert what we have to a tuple and match against our list
+		# convert what we have to a tuple and match against our rules
 		domain_tuple = tuple(fqdn.split('.'))
-		num_tokens = len(domain_tuple)
-		slice_point = 0
-
-		# we keep dropping off the left-most token until we find a match
-		# this way we match on "ac.uk" *before* "uk"
-		while slice_point < num_tokens-1:
-			slice_point += 1
-			pubsuffix = domain_tuple[slice_point:]
-			if pubsuffix in self.pubsuffix_list:
-				# we found the pubsuffix, 1 back is the domain
-				domain = domain_tuple[slice_point-1:]
-				# tld is always the final token
-				tld = domain_tuple[num_tokens-1]
-				# found match, return as single strings joined on '.'
-				return (ip_addr, fqdn, '.'.join(domain), '.'.join(pubsuffix), tld)
+		match = self.get_domain_and_pubsuffix(domain_tuple)
 
 		# if we get to this point nothing else has worked
-		return None
+		if not match: return None
+
+		# found match, return as single strings joined on '.', tld is
+		#	always the final token
+		return (ip_addr, fqdn, '.'.join(match[0]), '.'.join(match[1]), domain_tuple[-1])
 	# get_domain_pubsuffix_tld
 #end ParseURL
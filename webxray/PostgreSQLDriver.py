@@ -2,6 +2,7 @@
 import os
 import json
 import datetime
+import re
 
 # check if non-standard packages are installed
 try:
@@ -206,6 +207,55 @@ class PostgreSQLDriver:
 
 	# create_wbxr_db
 
+	def upgrade_wbxr_db(self):
+		"""
+		Databases made before columns were added to task_queue and config
+			are missing them, here we add any columns in our schema file
+			the db doesn't have yet, and indexes added since.  Config
+			columns we add are filled in from the default config so the
+			existing config keeps working.  Safe to run on an up to date db.
+		"""
+
+		# these are stored as json, see set_config
+		json_config_columns = ['client_injections','client_body_mime_types','client_lean_resource_types']
+
+		# indexes which older dbs may not have, creating them on a big
+		#	db takes a while but only happens once
+		upgrade_indexes = ['index_task_queue','index_domain_domain_md5','index_page_start_url_domain_id']
+		default_config = json.load(open('./resources/configurations/default.json', 'r', encoding='utf-8'))
+
+		db_init_file = open('./resources/db/postgresql/wbxr_db_init.sql', 'r', encoding='utf-8')
+		for query in db_init_file:
+			query = query.strip()
+
+			if query.startswith(tuple(f'CREATE INDEX {index}' for index in upgrade_indexes)):
+				self.db.execute(query.replace('CREATE INDEX','CREATE INDEX IF NOT EXISTS'))
+				self.db_conn.commit()
+				continue
+
+			for table in ['config','task_queue']:
+				if not query.startswith(f'CREATE TABLE {table}('): continue
+
+				self.db.execute('SELECT column_name FROM information_schema.columns WHERE table_name = %s', (table,))
+				existing_columns = [row[0] for row in self.db.fetchall()]
+
+				for column in query[len(f'CREATE TABLE {table}('):-2].split(','):
+					# skips constraints, eg UNIQUE (target_md5, task)
+					if not re.match('^[a-z_0-9]+ [A-Z]', column): continue
+					column_name = column.split(' ')[0]
+					if column_name in existing_columns: continue
+
+					print(f'Adding column {column_name} to {table} in {self.db_name}')
+					self.db.execute(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column}')
+					if table == 'config' and column_name in default_config:
+						if column_name in json_config_columns:
+							value = json.dumps(default_config[column_name])
+						else:
+							value = default_config[column_name]
+						self.db.execute(f'UPDATE config SET {column_name} = %s', (value,))
+					self.db_conn.commit()
+	# upgrade_wbxr_db
+
 	def db_exists(self, db_name):
 		"""
 		Gets a count of dbs with a given name, as count 
@@ -260,7 +310,28 @@ class PostgreSQLDriver:
 				store_cookies,
 				store_security_details,
 				timeseries_enabled,
-				timeseries_interval
+				timeseries_interval,
+				client_network_idle_wait,
+				adaptive_waits_enabled,
+				adaptive_no_event_wait_min,
+				adaptive_no_event_wait_max,
+				adaptive_max_wait_min,
+				adaptive_max_wait_max,
+				task_lease_batch_size,
+				task_lease_seconds,
+				max_domain_leases,
+				client_body_window,
+				client_body_max_bytes,
+				client_body_mime_types,
+				client_body_3p_only,
+				client_body_spool_dir,
+				client_max_links,
+				client_scroll_strategy,
+				client_scroll_max_depth,
+				client_scroll_max_seconds,
+				client_crawl_tabs,
+				client_lean_mode,
+				client_lean_resource_types
 			) VALUES (
 				%s,
 				%s,
@@ -297,6 +368,27 @@ class PostgreSQLDriver:
 				%s,
 				%s,
 				%s,
+				%s,
+				%s,
+				%s,
+				%s,
+				%s,
+				%s,
+				%s,
+				%s,
+				%s,
+				%s,
+				%s,
+				%s,
+				%s,
+				%s,
+				%s,
+				%s,
+				%s,
+				%s,
+				%s,
+				%s,
+				%s,
 				%s
 			)
 		""", (
@@ -335,7 +427,28 @@ class PostgreSQLDriver:
 			config['store_cookies'],
 			config['store_security_details'],
 			config['timeseries_enabled'],
-			config['timeseries_interval']
+			config['timeseries_interval'],
+			config['client_network_idle_wait'],
+			config['adaptive_waits_enabled'],
+			config['adaptive_no_event_wait_min'],
+			config['adaptive_no_event_wait_max'],
+			config['adaptive_max_wait_min'],
+			config['adaptive_max_wait_max'],
+			config['task_lease_batch_size'],
+			config['task_lease_seconds'],
+			config['max_domain_leases'],
+			config['client_body_window'],
+			config['client_body_max_bytes'],
+			json.dumps(config['client_body_mime_types']),
+			config['client_body_3p_only'],
+			config['client_body_spool_dir'],
+			config['client_max_links'],
+			config['client_scroll_strategy'],
+			config['client_scroll_max_depth'],
+			config['client_scroll_max_seconds'],
+			config['client_crawl_tabs'],
+			config['client_lean_mode'],
+			json.dumps(config['client_lean_resource_types'])
 			)
 		)
 		self.db_conn.commit()
@@ -384,7 +497,28 @@ class PostgreSQLDriver:
 				store_cookies,
 				store_security_details,
 				timeseries_enabled,
-				timeseries_interval
+				timeseries_interval,
+				client_network_idle_wait,
+				adaptive_waits_enabled,
+				adaptive_no_event_wait_min,
+				adaptive_no_event_wait_max,
+				adaptive_max_wait_min,
+				adaptive_max_wait_max,
+				task_lease_batch_size,
+				task_lease_seconds,
+				max_domain_leases,
+				client_body_window,
+				client_body_max_bytes,
+				client_body_mime_types,
+				client_body_3p_only,
+				client_body_spool_dir,
+				client_max_links,
+				client_scroll_strategy,
+				client_scroll_max_depth,
+				client_scroll_max_seconds,
+				client_crawl_tabs,
+				client_lean_mode,
+				client_lean_resource_types
 			FROM 
 				config
 			ORDER BY
@@ -431,7 +565,28 @@ class PostgreSQLDriver:
 			'store_cookies'					: result[32],
 			'store_security_details'		: result[33],
 			'timeseries_enabled'			: result[34],
-			'timeseries_interval'			: result[35]
+			'timeseries_interval'			: result[35],
+			'client_network_idle_wait'		: result[36],
+			'adaptive_waits_enabled'		: result[37],
+			'adaptive_no_event_wait_min'	: result[38],
+			'adaptive_no_event_wait_max'	: result[39],
+			'adaptive_max_wait_min'			: result[40],
+			'adaptive_max_wait_max'			: result[41],
+			'task_lease_batch_size'			: result[42],
+			'task_lease_seconds'			: result[43],
+			'max_domain_leases'				: result[44],
+			'client_body_window'			: result[45],
+			'client_body_max_bytes'			: result[46],
+			'client_body_mime_types'		: json.loads(result[47]),
+			'client_body_3p_only'			: result[48],
+			'client_body_spool_dir'			: result[49],
+			'client_max_links'				: result[50],
+			'client_scroll_strategy'		: result[51],
+			'client_scroll_max_depth'		: result[52],
+			'client_scroll_max_seconds'		: result[53],
+			'client_crawl_tabs'				: result[54],
+			'client_lean_mode'				: result[55],
+			'client_lean_resource_types'	: json.loads(result[56])
 		}
 	# get_config
 
@@ -621,26 +776,37 @@ class PostgreSQLDriver:
 		return self.db.fetchall()
 	# get_client_list
 	
-	def add_task_to_queue(self,target,task):
+	def add_task_to_queue(self,target,task,domain=None,domain_rank=0):
 		"""
 		We have a queue of tasks which are defined by a url, the task type ('get_scan',
 			or 'get_policy'), browser_type ('chrome' or 'basic'), and browser wait (int).
+
+		domain is used to limit how many tasks for the same site are leased at
+			once, and domain_rank is the number of tasks for the same domain
+			queued before this one, tasks are handed out in domain_rank order
+			so sites are interleaved.
 		"""
 		self.db.execute("""
 				INSERT INTO task_queue (
 					target, 
 					target_md5,
-					task
+					task,
+					domain,
+					domain_rank
 				) VALUES (
 					%s,
 					MD5(%s), 
+					%s,
+					%s,
 					%s
 				) 
 				ON CONFLICT DO NOTHING
 			""", (
 					target,
 					target,
-					task
+					task,
+					domain,
+					domain_rank
 				)
 		)
 		self.db_conn.commit()
@@ -650,99 +816,187 @@ class PostgreSQLDriver:
 		"""
 		Return the next task, while updating the attempt count and marking
 			which machine has taken the task.  Can filter on attempt number.
+
+		This is a lease of a single task, see lease_tasks.
 		"""
-		if max_attempts and client_id:
-			self.db.execute("""
-				UPDATE task_queue 
-				SET 
-					locked = TRUE,
-					client_id = %s,
-					modified = NOW(),
-					attempts = attempts + 1
-				WHERE id = (
-					SELECT id
-					FROM task_queue
-					WHERE locked IS NOT TRUE
-					AND failed IS NOT TRUE
-					AND attempts < %s
-					ORDER BY attempts
-					FOR UPDATE SKIP LOCKED
-					LIMIT 1
-				)
-				RETURNING 
-					target, 
-					task
-			""", (client_id,max_attempts,))
-		elif max_attempts:
-			self.db.execute("""
-				UPDATE task_queue 
-				SET 
-					locked = TRUE,
-					modified = NOW(),
-					attempts = attempts + 1
-				WHERE id = (
-					SELECT id
-					FROM task_queue
-					WHERE locked IS NOT TRUE
-					AND failed IS NOT TRUE
-					AND attempts < %s
-					ORDER BY attempts
-					FOR UPDATE SKIP LOCKED
-					LIMIT 1
-				)
-				RETURNING 
-					target, 
-					task
-			""", (max_attempts,))
-		elif client_id:
-			self.db.execute("""
-				UPDATE task_queue 
-				SET 
-					locked = TRUE,
-					client_id = %s,
-					modified = NOW(),
-					attempts = attempts + 1
-				WHERE id = (
-					SELECT id
-					FROM task_queue
-					WHERE locked IS NOT TRUE
-					AND failed IS NOT TRUE
-					ORDER BY attempts
-					FOR UPDATE SKIP LOCKED
-					LIMIT 1
-				)
-				RETURNING 
-					target, 
-					task
-			""", (client_id,))
-		else:
-			self.db.execute("""
-				UPDATE task_queue 
-				SET 
-					locked = TRUE,
-					modified = NOW(),
-					attempts = attempts + 1
-				WHERE id = (
-					SELECT id
-					FROM task_queue
-					WHERE locked IS NOT TRUE
-					AND failed IS NOT TRUE
-					ORDER BY attempts
-					FOR UPDATE SKIP LOCKED
-					LIMIT 1
-				)
-				RETURNING 
-					target, 
-					task
-			""")
-		
-		# return result or None
-		try:
-			return self.db.fetchone()
-		except:
-			return None	
+		result = self.lease_tasks(1, client_id=client_id, max_attempts=max_attempts)
+		if len(result) == 0: return None
+		target, task, lease_token = result[0]
+		return target, task
 	# get_task_from_queue
+
+	def lease_tasks(self, n, client_id=None, lease_seconds=600, max_attempts=None, max_domain_leases=None):
+		"""
+		Claims up to n tasks in a single round trip, they are locked to
+			client_id until lease_expires.  SKIP LOCKED means concurrent
+			callers each get their own batch rather than waiting on each
+			other.  Returns a list of (target, task, lease_token), which
+			is empty when there is nothing left to claim.  Each lease gets
+			a random lease_token, which is needed to renew or release the
+			lease, so we don't touch a task which has since been reclaimed
+			and leased to somebody else.
+
+		Tasks are taken in domain_rank order so sites are interleaved, and
+			if max_domain_leases is set we don't lease more than that many
+			tasks for the same domain at once.  Callers running at the same
+			moment don't see each others leases, so under heavy load the
+			cap may be briefly exceeded.  Only the first n*20 claimable
+			tasks are considered, which keeps this cheap on large queues.
+		"""
+		self.db.execute("""
+			WITH candidates AS (
+				SELECT id, domain, attempts, domain_rank
+				FROM task_queue
+				WHERE locked IS NOT TRUE
+				AND failed IS NOT TRUE
+				AND (not_before IS NULL OR not_before <= NOW())
+				AND attempts < COALESCE(%s, attempts + 1)
+				ORDER BY attempts, domain_rank
+				LIMIT %s
+				FOR UPDATE SKIP LOCKED
+			),
+			leased AS (
+				SELECT domain, COUNT(*) AS leases
+				FROM task_queue
+				WHERE locked IS TRUE
+				AND domain IN (SELECT domain FROM candidates)
+				GROUP BY domain
+			),
+			ranked AS (
+				SELECT
+					candidates.id,
+					candidates.attempts,
+					candidates.domain_rank,
+					COALESCE(leased.leases, 0) + ROW_NUMBER() OVER (
+						PARTITION BY COALESCE(candidates.domain, CAST(candidates.id AS TEXT))
+						ORDER BY candidates.attempts, candidates.domain_rank
+					) AS slot
+				FROM candidates
+				LEFT JOIN leased ON leased.domain = candidates.domain
+			)
+			UPDATE task_queue 
+			SET 
+				locked = TRUE,
+				client_id = %s,
+				modified = NOW(),
+				lease_expires = NOW() + (%s * INTERVAL '1 second'),
+				lease_token = MD5(RANDOM()::TEXT || CLOCK_TIMESTAMP()::TEXT),
+				attempts = attempts + 1
+			WHERE id IN (
+				SELECT id
+				FROM ranked
+				WHERE slot <= COALESCE(%s, slot)
+				ORDER BY attempts, domain_rank
+				LIMIT %s
+			)
+			RETURNING 
+				target, 
+				task,
+				lease_token,
+				domain_rank,
+				id
+		""", (max_attempts, n*20, client_id, lease_seconds, max_domain_leases, n))
+
+		# RETURNING order isn't defined, put the batch back in domain_rank
+		#	order so the caller doesn't hit the same domain back to back
+		result = sorted(self.db.fetchall(), key=lambda row: (row[3] or 0, row[4]))
+		return [(target, task, lease_token) for target, task, lease_token, domain_rank, task_id in result]
+	# lease_tasks
+
+	def renew_task_lease(self, target, task, lease_seconds, client_id, lease_token):
+		"""
+		Pushes back lease_expires on a task we are still working on, so
+			long crawls don't have their task reclaimed from under them.
+			Returns lease_token, or None if the lease is no longer ours.
+		"""
+		self.db.execute("""
+			UPDATE task_queue 
+			SET 
+				lease_expires = NOW() + (%s * INTERVAL '1 second'),
+				modified = NOW()
+			WHERE target_md5 = MD5(%s) 
+			AND task = %s
+			AND locked = TRUE
+			AND client_id IS NOT DISTINCT FROM %s
+			AND lease_token = %s
+			RETURNING
+				lease_token
+		""", (lease_seconds,target,task,client_id,lease_token))
+		result = self.db.fetchone()
+		self.db_conn.commit()
+		if result == None: return None
+		return result[0]
+	# renew_task_lease
+
+	def reclaim_expired_leases(self):
+		"""
+		Returns tasks whose lease has run out to the queue, this happens
+			when a worker crashes or is killed while holding tasks.  The
+			attempt was counted when the task was leased, so a task which
+			keeps taking down workers reaches max_attempts and is no longer
+			handed out.  Returns the number of tasks reclaimed.
+		"""
+		self.db.execute("""
+			UPDATE task_queue 
+			SET 
+				locked = FALSE,
+				lease_expires = NULL,
+				lease_token = NULL,
+				modified = NOW()
+			WHERE locked = TRUE
+			AND lease_expires < NOW()
+		""")
+		reclaimed = self.db.rowcount
+		self.db_conn.commit()
+		return reclaimed
+	# reclaim_expired_leases
 	
+	def reschedule_task(self, target, task, base_delay, client_id, lease_token, max_delay=3600):
+		"""
+		Unlocks a task which failed with an error worth retrying, but
+			it may not be claimed again until not_before.  The delay
+			doubles with each attempt already made, starting from
+			base_delay and capped at max_delay seconds.  Nothing happens
+			if the lease is no longer ours.
+		"""
+		self.db.execute("""
+			UPDATE task_queue 
+			SET 
+				locked = FALSE,
+				lease_expires = NULL,
+				lease_token = NULL,
+				modified = NOW(),
+				not_before = NOW() + (LEAST(%s * POWER(2, GREATEST(attempts - 1, 0)), %s) * INTERVAL '1 second')
+			WHERE target_md5 = MD5(%s) 
+			AND task = %s
+			AND locked = TRUE
+			AND client_id IS NOT DISTINCT FROM %s
+			AND lease_token = %s
+		""", (base_delay,max_delay,target,task,client_id,lease_token))
+		self.db_conn.commit()
+	# reschedule_task
+
+	def get_seconds_until_next_task(self, max_attempts=None):
+		"""
+		When there is nothing to claim, tasks may still be waiting
+			out a retry delay, or held back because their domain has
+			max_domain_leases tasks out already.  Returns the number of
+			seconds until the first of them may be claimed, 0 if they
+			are only held back, or None if there are no such tasks and
+			the queue is done.
+		"""
+		self.db.execute("""
+			SELECT EXTRACT(EPOCH FROM (MIN(COALESCE(not_before, NOW())) - NOW()))
+			FROM task_queue
+			WHERE locked IS NOT TRUE
+			AND failed IS NOT TRUE
+			AND attempts < COALESCE(%s, attempts + 1)
+		""", (max_attempts,))
+		seconds = self.db.fetchone()[0]
+		if seconds == None: return None
+		return max(float(seconds), 0)
+	# get_seconds_until_next_task
+
 	def remove_task_from_queue(self,target,task):
 		"""
 		If a task is successfull we remove it from the queue.
@@ -751,14 +1005,51 @@ class PostgreSQLDriver:
 		self.db_conn.commit()
 	# remove_task_from_queue
 
-	def unlock_task_in_queue(self,target,task):
+	def unlock_task_in_queue(self, target, task, client_id, lease_token):
 		"""
-		If a task is not successfull we unlock it so it may be attempted again.
+		If a task is not successfull we unlock it so it may be attempted again,
+			as long as the lease is still ours.
 		"""
-		self.db.execute('UPDATE task_queue SET locked = FALSE WHERE target_md5 = MD5(%s) AND task = %s', (target,task))
+		self.db.execute("""
+			UPDATE task_queue 
+			SET 
+				locked = FALSE,
+				lease_expires = NULL,
+				lease_token = NULL,
+				modified = NOW()
+			WHERE target_md5 = MD5(%s) 
+			AND task = %s
+			AND locked = TRUE
+			AND client_id IS NOT DISTINCT FROM %s
+			AND lease_token = %s
+		""", (target,task,client_id,lease_token))
 		self.db_conn.commit()
 	# unlock_task_in_queue
 
+	def release_task_lease(self, target, task, client_id, lease_token):
+		"""
+		Hands back a leased task we never got around to running, the
+			attempt counted when it was leased is taken back.  Nothing
+			happens if the lease has expired and the task been given
+			to somebody else.
+		"""
+		self.db.execute("""
+			UPDATE task_queue 
+			SET 
+				locked = FALSE,
+				lease_expires = NULL,
+				lease_token = NULL,
+				modified = NOW(),
+				attempts = GREATEST(attempts - 1, 0)
+			WHERE target_md5 = MD5(%s) 
+			AND task = %s
+			AND locked = TRUE
+			AND client_id IS NOT DISTINCT FROM %s
+			AND lease_token = %s
+		""", (target,task,client_id,lease_token))
+		self.db_conn.commit()
+	# release_task_lease
+
 	def unlock_all_tasks_in_queue(self):
 		"""
 		Removes all locks in queue, used when restarting server.
@@ -770,11 +1061,21 @@ class PostgreSQLDriver:
 		""")
 	# unlock_all_tasks_in_queue
 
-	def set_task_as_failed(self,target,task):
+	def set_task_as_failed(self, target, task, client_id, lease_token):
 		"""
-		Task will no longer be attempted.
+		Task will no longer be attempted, as long as the lease is still ours.
 		"""
-		self.db.execute('UPDATE task_queue SET failed = true WHERE target_md5 = MD5(%s) AND task = %s', (target,task))
+		self.db.execute("""
+			UPDATE task_queue 
+			SET 
+				failed = TRUE,
+				modified = NOW()
+			WHERE target_md5 = MD5(%s) 
+			AND task = %s
+			AND locked = TRUE
+			AND client_id IS NOT DISTINCT FROM %s
+			AND lease_token = %s
+		""", (target,task,client_id,lease_token))
 		self.db_conn.commit()
 	# set_task_as_failed
 
@@ -1004,6 +1305,32 @@ class PostgreSQLDriver:
 		return self.db.fetchone()[0]
 	# crawl_exists
 
+	def get_domain_load_times(self, domain, limit=20):
+		"""
+		returns the load_time and waits used for the most recent
+			scans of pages on the given domain, used to build
+			timing profiles
+		"""
+		self.db.execute("""
+			SELECT
+				page.load_time,
+				page.browser_no_event_wait,
+				page.browser_max_wait
+			FROM
+				page
+			JOIN
+				domain ON page.start_url_domain_id = domain.id
+			WHERE
+				domain.domain_md5 = MD5(%s)
+			AND
+				page.load_time IS NOT NULL
+			ORDER BY
+				page.accessed DESC
+			LIMIT %s
+		""", (domain,limit))
+		return self.db.fetchall()
+	# get_domain_load_times
+
 	def add_domain(self, domain):
 		"""
 		add a new domain record to db, ignores duplicates
@@ -1359,6 +1686,23 @@ class PostgreSQLDriver:
 		self.db_conn.commit()
 	# add_file
 
+	def file_exists(self, md5):
+		"""
+		checks if we have stored a file with this md5
+		"""
+		self.db.execute("""
+			SELECT EXISTS(
+				SELECT 
+					md5 
+				FROM 
+					file 
+				WHERE 
+					md5 = %s
+			)
+		""", (md5,))
+		return self.db.fetchone()[0]
+	# file_exists
+
 	def add_security_details(self, security_details):
 		"""
 		add a new security_detail record to db
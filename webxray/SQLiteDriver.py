@@ -1,11 +1,10 @@
 # standard python packages
-import time 
-import random
 import os
 import hashlib
 import sqlite3
 import datetime
 import json
+import re
 
 class SQLiteDriver:
 	"""
@@ -25,14 +24,26 @@ class SQLiteDriver:
 		
 		if db_name != '':
 			self.db_name = self.db_prefix+db_name+'.db'
-			self.db_conn = sqlite3.connect(self.db_root_path+self.db_name,detect_types=sqlite3.PARSE_DECLTYPES)
-			self.db = self.db_conn.cursor()
+			self.connect(self.db_root_path+self.db_name)
 	# __init__
 
 	#-----------------#
 	# GENERAL PURPOSE #
 	#-----------------#
 
+	def connect(self, db_path):
+		"""
+		open the connection and cursor, we use WAL so readers are not
+			blocked while another process holds the write lock, and
+			give writers a generous busy timeout so they wait their
+			turn rather than failing when several processes share
+			the same db
+		"""
+		self.db_conn = sqlite3.connect(db_path,detect_types=sqlite3.PARSE_DECLTYPES,timeout=60)
+		self.db = self.db_conn.cursor()
+		self.db.execute('PRAGMA journal_mode=WAL')
+	# connect
+
 	def md5_text(self,text):
 		"""
 		this class is unique to the sqlite driver as md5 is not built in
@@ -53,8 +64,7 @@ class SQLiteDriver:
 
 		# open the new connection
 		self.db_name = self.db_prefix+db_name
-		self.db_conn = sqlite3.connect(self.db_root_path+self.db_name+'.db',detect_types=sqlite3.PARSE_DECLTYPES)
-		self.db = self.db_conn.cursor()
+		self.connect(self.db_root_path+self.db_name+'.db')
 		return True
 	# db_switch
 
@@ -131,7 +141,28 @@ class SQLiteDriver:
 				store_cookies,
 				store_security_details,
 				timeseries_enabled,
-				timeseries_interval
+				timeseries_interval,
+				client_network_idle_wait,
+				adaptive_waits_enabled,
+				adaptive_no_event_wait_min,
+				adaptive_no_event_wait_max,
+				adaptive_max_wait_min,
+				adaptive_max_wait_max,
+				task_lease_batch_size,
+				task_lease_seconds,
+				max_domain_leases,
+				client_body_window,
+				client_body_max_bytes,
+				client_body_mime_types,
+				client_body_3p_only,
+				client_body_spool_dir,
+				client_max_links,
+				client_scroll_strategy,
+				client_scroll_max_depth,
+				client_scroll_max_seconds,
+				client_crawl_tabs,
+				client_lean_mode,
+				client_lean_resource_types
 			) VALUES (
 				?,
 				?,
@@ -168,6 +199,27 @@ class SQLiteDriver:
 				?,
 				?,
 				?,
+				?,
+				?,
+				?,
+				?,
+				?,
+				?,
+				?,
+				?,
+				?,
+				?,
+				?,
+				?,
+				?,
+				?,
+				?,
+				?,
+				?,
+				?,
+				?,
+				?,
+				?,
 				?
 			)
 		""", (
@@ -206,7 +258,28 @@ class SQLiteDriver:
 			config['store_cookies'],
 			config['store_security_details'],
 			config['timeseries_enabled'],
-			config['timeseries_interval']
+			config['timeseries_interval'],
+			config['client_network_idle_wait'],
+			config['adaptive_waits_enabled'],
+			config['adaptive_no_event_wait_min'],
+			config['adaptive_no_event_wait_max'],
+			config['adaptive_max_wait_min'],
+			config['adaptive_max_wait_max'],
+			config['task_lease_batch_size'],
+			config['task_lease_seconds'],
+			config['max_domain_leases'],
+			config['client_body_window'],
+			config['client_body_max_bytes'],
+			json.dumps(config['client_body_mime_types']),
+			config['client_body_3p_only'],
+			config['client_body_spool_dir'],
+			config['client_max_links'],
+			config['client_scroll_strategy'],
+			config['client_scroll_max_depth'],
+			config['client_scroll_max_seconds'],
+			config['client_crawl_tabs'],
+			config['client_lean_mode'],
+			json.dumps(config['client_lean_resource_types'])
 			)
 		)
 		self.db_conn.commit()
@@ -255,7 +328,28 @@ class SQLiteDriver:
 				store_cookies,
 				store_security_details,
 				timeseries_enabled,
-				timeseries_interval
+				timeseries_interval,
+				client_network_idle_wait,
+				adaptive_waits_enabled,
+				adaptive_no_event_wait_min,
+				adaptive_no_event_wait_max,
+				adaptive_max_wait_min,
+				adaptive_max_wait_max,
+				task_lease_batch_size,
+				task_lease_seconds,
+				max_domain_leases,
+				client_body_window,
+				client_body_max_bytes,
+				client_body_mime_types,
+				client_body_3p_only,
+				client_body_spool_dir,
+				client_max_links,
+				client_scroll_strategy,
+				client_scroll_max_depth,
+				client_scroll_max_seconds,
+				client_crawl_tabs,
+				client_lean_mode,
+				client_lean_resource_types
 			FROM 
 				config
 			ORDER BY
@@ -302,7 +396,28 @@ class SQLiteDriver:
 			'store_cookies'					: result[32],
 			'store_security_details'		: result[33],
 			'timeseries_enabled'			: result[34],
-			'timeseries_interval'			: result[35]
+			'timeseries_interval'			: result[35],
+			'client_network_idle_wait'		: result[36],
+			'adaptive_waits_enabled'		: result[37],
+			'adaptive_no_event_wait_min'	: result[38],
+			'adaptive_no_event_wait_max'	: result[39],
+			'adaptive_max_wait_min'			: result[40],
+			'adaptive_max_wait_max'			: result[41],
+			'task_lease_batch_size'			: result[42],
+			'task_lease_seconds'			: result[43],
+			'max_domain_leases'				: result[44],
+			'client_body_window'			: result[45],
+			'client_body_max_bytes'			: result[46],
+			'client_body_mime_types'		: json.loads(result[47]),
+			'client_body_3p_only'			: result[48],
+			'client_body_spool_dir'			: result[49],
+			'client_max_links'				: result[50],
+			'client_scroll_strategy'		: result[51],
+			'client_scroll_max_depth'		: result[52],
+			'client_scroll_max_seconds'		: result[53],
+			'client_crawl_tabs'				: result[54],
+			'client_lean_mode'				: result[55],
+			'client_lean_resource_types'	: json.loads(result[56])
 		}
 	# get_config
 
@@ -366,8 +481,7 @@ class SQLiteDriver:
 			exit()
 		else:
 			# create new db here, if it does not exist yet it gets created on the connect
-			self.db_conn = sqlite3.connect(self.db_root_path+self.db_name+'.db',detect_types=sqlite3.PARSE_DECLTYPES)
-			self.db = self.db_conn.cursor()
+			self.connect(self.db_root_path+self.db_name+'.db')
 
 			# initialize webxray formatted database
 			db_init_file = open(self.db_root_path+'sqlite_db_init.schema', 'r', encoding='utf-8')
@@ -395,6 +509,55 @@ class SQLiteDriver:
 			self.add_domain_owner(domain_owner)
 	# create_wbxr_db
 
+	def upgrade_wbxr_db(self):
+		"""
+		Databases made before columns were added to task_queue and config
+			are missing them, here we add any columns in our schema file
+			the db doesn't have yet, and indexes added since.  Config
+			columns we add are filled in from the default config so the
+			existing config keeps working.  Safe to run on an up to date db.
+		"""
+
+		# these are stored as json, see set_config
+		json_config_columns = ['client_injections','client_body_mime_types','client_lean_resource_types']
+
+		# indexes which older dbs may not have, creating them on a big
+		#	db takes a while but only happens once
+		upgrade_indexes = ['index_task_queue','index_domain_domain_md5','index_page_start_url_domain_id']
+		default_config = json.load(open('./resources/configurations/default.json', 'r', encoding='utf-8'))
+
+		db_init_file = open(self.db_root_path+'sqlite_db_init.schema', 'r', encoding='utf-8')
+		for query in db_init_file:
+			query = query.strip()
+
+			if query.startswith(tuple(f'CREATE INDEX {index}' for index in upgrade_indexes)):
+				self.db.execute(query.replace('CREATE INDEX','CREATE INDEX IF NOT EXISTS'))
+				self.db_conn.commit()
+				continue
+
+			for table in ['config','task_queue']:
+				if not query.startswith(f'CREATE TABLE {table}('): continue
+
+				self.db.execute(f'PRAGMA table_info({table})')
+				existing_columns = [row[1] for row in self.db.fetchall()]
+
+				for column in query[len(f'CREATE TABLE {table}('):-2].split(','):
+					# skips constraints, eg UNIQUE (target_md5, task)
+					if not re.match('^[a-z_0-9]+ [A-Z]', column): continue
+					column_name = column.split(' ')[0]
+					if column_name in existing_columns: continue
+
+					print(f'Adding column {column_name} to {table} in {self.db_name}')
+					self.db.execute(f'ALTER TABLE {table} ADD COLUMN {column}')
+					if table == 'config' and column_name in default_config:
+						if column_name in json_config_columns:
+							value = json.dumps(default_config[column_name])
+						else:
+							value = default_config[column_name]
+						self.db.execute(f'UPDATE config SET {column_name} = ?', (value,))
+					self.db_conn.commit()
+	# upgrade_wbxr_db
+
 	#-----------------------#
 	# INGESTION AND STORING #
 	#-----------------------#	
@@ -498,26 +661,37 @@ class SQLiteDriver:
 		return self.db.fetchall()
 	# get_all_pages_exist
 
-	def add_task_to_queue(self,target,task):
+	def add_task_to_queue(self,target,task,domain=None,domain_rank=0):
 		"""
 		We have a queue of tasks which are defined by a url, the task type ('get_scan',
 			or 'get_policy'), browser_type ('chrome' or 'basic'), and browser wait (int).
+
+		domain is used to limit how many tasks for the same site are leased at
+			once, and domain_rank is the number of tasks for the same domain
+			queued before this one, tasks are handed out in domain_rank order
+			so sites are interleaved.
 		"""
 		self.db.execute("""
 				INSERT INTO task_queue (
 					target, 
 					target_md5,
-					task
+					task,
+					domain,
+					domain_rank
 				) VALUES (
 					?,
 					?, 
+					?,
+					?,
 					?
 				) 
 				ON CONFLICT DO NOTHING
 			""", (
 					target,
 					self.md5_text(target),
-					task
+					task,
+					domain,
+					domain_rank
 				)
 		)
 		self.db_conn.commit()
@@ -560,51 +734,194 @@ class SQLiteDriver:
 		"""
 		Return the next task, while updating the attempt count and marking
 			which machine has taken the task.  Can filter on attempt number.
+
+		This is a lease of a single task, see lease_tasks.
 		"""
+		result = self.lease_tasks(1, client_id=client_id, max_attempts=max_attempts)
+		if len(result) == 0: return None
+		target, task, lease_token = result[0]
+		return target, task
+	# get_task_from_queue
 
-		# kludge to make sure two processes don't try to do the same page
-		#	note this is handled better with postgres
-		time.sleep(random.randint(50, 100)/100)
-		
-		if max_attempts:
+	def lease_tasks(self, n, client_id=None, lease_seconds=600, max_attempts=None, max_domain_leases=None):
+		"""
+		Claims up to n tasks in a single round trip, they are locked to
+			client_id until lease_expires.  SQLite has no SKIP LOCKED,
+			instead BEGIN IMMEDIATE makes concurrent callers take turns.
+			Returns a list of (target, task, lease_token), which is empty
+			when there is nothing left to claim.  Each lease gets a random
+			lease_token, which is needed to renew or release the lease, so
+			we don't touch a task which has since been reclaimed and leased
+			to somebody else.
+
+		Tasks are taken in domain_rank order so sites are interleaved, and
+			if max_domain_leases is set we never have more than that many
+			tasks for the same domain leased at once.  Only the first
+			n*20 claimable tasks are considered, which keeps this cheap
+			on large queues.
+		"""
+
+		# BEGIN will fail if we are still in a transaction
+		if self.db_conn.in_transaction: self.db_conn.commit()
+
+		try:
+			self.db.execute('BEGIN IMMEDIATE')
 			self.db.execute("""
-				SELECT id, target, task, attempts
+				WITH candidates AS (
+					SELECT id, domain, attempts, domain_rank
 					FROM task_queue
 					WHERE locked IS NOT TRUE
 					AND failed IS NOT TRUE
-					AND attempts < ?
-					ORDER BY attempts
-					LIMIT 1
-			""", (max_attempts,))
-		else:
-			self.db.execute("""
-				SELECT id, target, task, attempts
+					AND (not_before IS NULL OR not_before <= DATETIME('now'))
+					AND attempts < COALESCE(?, attempts + 1)
+					ORDER BY attempts, domain_rank
+					LIMIT ?
+				),
+				leased AS (
+					SELECT domain, COUNT(*) AS leases
 					FROM task_queue
-					WHERE locked IS NOT TRUE
-					AND failed IS NOT TRUE
-					ORDER BY attempts
-					LIMIT 1
-			""")
-		
-		# return result or None
-		try:
-			task_id, target, task, attempts = self.db.fetchone()
-			self.lock_task(task_id)
-			self.increment_task_attempts(task_id, attempts)
-			return target, task
+					WHERE locked IS TRUE
+					AND domain IN (SELECT domain FROM candidates)
+					GROUP BY domain
+				),
+				ranked AS (
+					SELECT
+						candidates.id,
+						candidates.attempts,
+						candidates.domain_rank,
+						COALESCE(leased.leases, 0) + ROW_NUMBER() OVER (
+							PARTITION BY COALESCE(candidates.domain, CAST(candidates.id AS TEXT))
+							ORDER BY candidates.attempts, candidates.domain_rank
+						) AS slot
+					FROM candidates
+					LEFT JOIN leased ON leased.domain = candidates.domain
+				)
+				UPDATE task_queue 
+				SET 
+					locked = TRUE,
+					client_id = ?,
+					lease_expires = DATETIME('now', ? || ' seconds'),
+					lease_token = LOWER(HEX(RANDOMBLOB(16))),
+					attempts = attempts + 1
+				WHERE id IN (
+					SELECT id
+					FROM ranked
+					WHERE slot <= COALESCE(?, slot)
+					ORDER BY attempts, domain_rank
+					LIMIT ?
+				)
+				RETURNING 
+					target, 
+					task,
+					lease_token,
+					domain_rank,
+					id
+			""", (max_attempts, n*20, client_id, lease_seconds, max_domain_leases, n))
+			result = self.db.fetchall()
+			self.db_conn.commit()
 		except:
-			return None	
-	# get_task_from_queue
+			self.db_conn.rollback()
+			return []
+
+		# RETURNING order isn't defined, put the batch back in domain_rank
+		#	order so the caller doesn't hit the same domain back to back
+		result.sort(key=lambda row: (row[3] or 0, row[4]))
+		return [(target, task, lease_token) for target, task, lease_token, domain_rank, task_id in result]
+	# lease_tasks
+
+	def renew_task_lease(self, target, task, lease_seconds, client_id, lease_token):
+		"""
+		Pushes back lease_expires on a task we are still working on, so
+			long crawls don't have their task reclaimed from under them.
+			Returns lease_token, or None if the lease is no longer ours.
+		"""
+		self.db.execute("""
+			UPDATE task_queue 
+			SET 
+				lease_expires = DATETIME('now', ? || ' seconds'),
+				modified = CURRENT_TIMESTAMP
+			WHERE target_md5 = ? 
+			AND task = ?
+			AND locked = TRUE
+			AND client_id IS ?
+			AND lease_token = ?
+			RETURNING
+				lease_token
+		""", (lease_seconds,self.md5_text(target),task,client_id,lease_token))
+		result = self.db.fetchone()
+		self.db_conn.commit()
+		if result == None: return None
+		return result[0]
+	# renew_task_lease
 
-	def lock_task(self, task_id):
-		self.db.execute("UPDATE task_queue SET locked = TRUE where id = ?", (task_id,))
+	def reclaim_expired_leases(self):
+		"""
+		Returns tasks whose lease has run out to the queue, this happens
+			when a worker crashes or is killed while holding tasks.  The
+			attempt was counted when the task was leased, so a task which
+			keeps taking down workers reaches max_attempts and is no longer
+			handed out.  Returns the number of tasks reclaimed.
+		"""
+		self.db.execute("""
+			UPDATE task_queue 
+			SET 
+				locked = FALSE,
+				lease_expires = NULL,
+				lease_token = NULL,
+				modified = CURRENT_TIMESTAMP
+			WHERE locked = TRUE
+			AND lease_expires < DATETIME('now')
+		""")
+		reclaimed = self.db.rowcount
 		self.db_conn.commit()
-	# lock_task
+		return reclaimed
+	# reclaim_expired_leases
 
-	def increment_task_attempts(self, task_id, attempts):
-		self.db.execute("UPDATE task_queue SET attempts = ? where id = ?", (attempts+1, task_id))
+	def reschedule_task(self, target, task, base_delay, client_id, lease_token, max_delay=3600):
+		"""
+		Unlocks a task which failed with an error worth retrying, but
+			it may not be claimed again until not_before.  The delay
+			doubles with each attempt already made, starting from
+			base_delay and capped at max_delay seconds.  Nothing happens
+			if the lease is no longer ours.
+		"""
+		self.db.execute("""
+			UPDATE task_queue 
+			SET 
+				locked = FALSE,
+				lease_expires = NULL,
+				lease_token = NULL,
+				modified = CURRENT_TIMESTAMP,
+				not_before = DATETIME('now', MIN(? * (1 << MAX(attempts - 1, 0)), ?) || ' seconds')
+			WHERE target_md5 = ? 
+			AND task = ?
+			AND locked = TRUE
+			AND client_id IS ?
+			AND lease_token = ?
+		""", (base_delay,max_delay,self.md5_text(target),task,client_id,lease_token))
 		self.db_conn.commit()
-	# increment_task_attempts
+	# reschedule_task
+
+	def get_seconds_until_next_task(self, max_attempts=None):
+		"""
+		When there is nothing to claim, tasks may still be waiting
+			out a retry delay, or held back because their domain has
+			max_domain_leases tasks out already.  Returns the number of
+			seconds until the first of them may be claimed, 0 if they
+			are only held back, or None if there are no such tasks and
+			the queue is done.
+		"""
+		self.db.execute("""
+			SELECT (JULIANDAY(MIN(COALESCE(not_before, DATETIME('now')))) - JULIANDAY('now')) * 86400
+			FROM task_queue
+			WHERE locked IS NOT TRUE
+			AND failed IS NOT TRUE
+			AND attempts < COALESCE(?, attempts + 1)
+		""", (max_attempts,))
+		seconds = self.db.fetchone()[0]
+		if seconds == None: return None
+		return max(seconds, 0)
+	# get_seconds_until_next_task
 
 	def remove_task_from_queue(self,target,task):
 		"""
@@ -614,14 +931,51 @@ class SQLiteDriver:
 		self.db_conn.commit()
 	# remove_task_from_queue
 
-	def unlock_task_in_queue(self,target,task):
+	def unlock_task_in_queue(self, target, task, client_id, lease_token):
 		"""
-		If a task is not successfull we unlock it so it may be attempted again.
+		If a task is not successfull we unlock it so it may be attempted again,
+			as long as the lease is still ours.
 		"""
-		self.db.execute('UPDATE task_queue SET locked = FALSE WHERE target_md5 = ? AND task = ?', (self.md5_text(target),task))
+		self.db.execute("""
+			UPDATE task_queue 
+			SET 
+				locked = FALSE,
+				lease_expires = NULL,
+				lease_token = NULL,
+				modified = CURRENT_TIMESTAMP
+			WHERE target_md5 = ? 
+			AND task = ?
+			AND locked = TRUE
+			AND client_id IS ?
+			AND lease_token = ?
+		""", (self.md5_text(target),task,client_id,lease_token))
 		self.db_conn.commit()
 	# unlock_task_in_queue
 
+	def release_task_lease(self, target, task, client_id, lease_token):
+		"""
+		Hands back a leased task we never got around to running, the
+			attempt counted when it was leased is taken back.  Nothing
+			happens if the lease has expired and the task been given
+			to somebody else.
+		"""
+		self.db.execute("""
+			UPDATE task_queue 
+			SET 
+				locked = FALSE,
+				lease_expires = NULL,
+				lease_token = NULL,
+				modified = CURRENT_TIMESTAMP,
+				attempts = MAX(attempts - 1, 0)
+			WHERE target_md5 = ? 
+			AND task = ?
+			AND locked = TRUE
+			AND client_id IS ?
+			AND lease_token = ?
+		""", (self.md5_text(target),task,client_id,lease_token))
+		self.db_conn.commit()
+	# release_task_lease
+
 	def unlock_all_tasks_in_queue(self):
 		"""
 		Removes all locks in queue, used when restarting server.
@@ -633,11 +987,21 @@ class SQLiteDriver:
 		""")
 	# unlock_all_tasks_in_queue
 
-	def set_task_as_failed(self,target,task):
+	def set_task_as_failed(self, target, task, client_id, lease_token):
 		"""
-		Task will no longer be attempted.
+		Task will no longer be attempted, as long as the lease is still ours.
 		"""
-		self.db.execute('UPDATE task_queue SET failed = true WHERE target_md5 = ? AND task = ?', (self.md5_text(target),task))
+		self.db.execute("""
+			UPDATE task_queue 
+			SET 
+				failed = TRUE,
+				modified = CURRENT_TIMESTAMP
+			WHERE target_md5 = ? 
+			AND task = ?
+			AND locked = TRUE
+			AND client_id IS ?
+			AND lease_token = ?
+		""", (self.md5_text(target),task,client_id,lease_token))
 		self.db_conn.commit()
 	# set_task_as_failed
 
@@ -798,6 +1162,32 @@ class SQLiteDriver:
 		return self.db.fetchone()[0]
 	# crawl_exists
 
+	def get_domain_load_times(self, domain, limit=20):
+		"""
+		returns the load_time and waits used for the most recent
+			scans of pages on the given domain, used to build
+			timing profiles
+		"""
+		self.db.execute("""
+			SELECT
+				page.load_time,
+				page.browser_no_event_wait,
+				page.browser_max_wait
+			FROM
+				page
+			JOIN
+				domain ON page.start_url_domain_id = domain.id
+			WHERE
+				domain.domain_md5 = ?
+			AND
+				page.load_time IS NOT NULL
+			ORDER BY
+				page.accessed DESC
+			LIMIT ?
+		""", (self.md5_text(domain),limit))
+		return self.db.fetchall()
+	# get_domain_load_times
+
 	def add_domain(self, domain):
 		"""
 		add a new domain record to db, ignores duplicates
@@ -1147,6 +1537,23 @@ class SQLiteDriver:
 		self.db_conn.commit()
 	# add_file
 
+	def file_exists(self, md5):
+		"""
+		checks if we have stored a file with this md5
+		"""
+		self.db.execute("""
+			SELECT EXISTS(
+				SELECT 
+					md5 
+				FROM 
+					file 
+				WHERE 
+					md5 = ?
+			)
+		""", (md5,))
+		return self.db.fetchone()[0]
+	# file_exists
+
 	def add_security_details(self, security_details):
 		"""
 		add a new security_detail record to db
@@ -3,10 +3,13 @@ import bz2
 import json
 import base64
 import hashlib
+import threading
+import time
 
 # custom classes
 from webxray.OutputStore		import OutputStore
 from webxray.PostgreSQLDriver	import PostgreSQLDriver
+from webxray.Utilities			import Utilities
 
 class Server:
 	"""
@@ -20,11 +23,28 @@ class Server:
 		- responding to requests for scanning tasks from remote scan nodes
 		- either immediately processing and storing, or queuing, results from scans
 
+	Tasks are leased from the db in batches and kept in task_buffers until
+		they are handed out.  A new Server is created for every request so
+		the buffers live on the class, and are shared by all requests
+		handled by the same worker process.  Each gunicorn worker has its
+		own buffers, which is safe as leases are checked against the db
+		before a task is handed out.
+
 	TODO Items:
 		- currently we rely on ip whitelisting, but we could move to an authentication scheme
 			for clients with unstable ip addrs
 	"""
 
+	# (db_name, client_id) -> {'expires': unix time, 'tasks': [(target, task, lease_token),...]}
+	task_buffers 		= {}
+	task_buffers_lock 	= threading.Lock()
+
+	# db_name -> unix time we last returned expired leases to the queue
+	last_lease_reclaim 	= {}
+
+	# client dbs we have already brought up to date, see upgrade_wbxr_db
+	upgraded_dbs 		= set()
+
 	def __init__(self):
 		"""
 		Set up our server configuration here.
@@ -50,6 +70,13 @@ class Server:
 				if self.server_sql_driver.check_db_exist(client['mapped_db']):
 					self.whitelisted_ips.append(client['client_ip'])
 					self.client_id_to_db[client['client_id']] = client['mapped_db']
+
+					# dbs made by older versions may be missing columns
+					if client['mapped_db'] not in Server.upgraded_dbs:
+						sql_driver = PostgreSQLDriver(client['mapped_db'])
+						sql_driver.upgrade_wbxr_db()
+						sql_driver.close()
+						Server.upgraded_dbs.add(client['mapped_db'])
 				else:
 					print(f"Database {client['mapped_db']} for client {client['client_id']} does not exist")
 	# __init__
@@ -83,53 +110,131 @@ class Server:
 
 		# if we have items in task_queue we send them back, otherwise
 		#	we sent a wait command
-		if sql_driver.get_task_queue_length(max_attempts=config['max_attempts'], unlocked_only=True) != 0:
-			# if this fails we wait
-			try:
-				target, task = sql_driver.get_task_from_queue(max_attempts=config['max_attempts'],client_id=client_id)
-			except:
-				print('✋ Returning command to wait.')
-				return {
-					'task':'wait'
-				}
+		next_task = self.get_next_buffered_task(sql_driver, config, self.client_id_to_db[client_id], client_id)
+		sql_driver.close()
+		del sql_driver
 
+		if next_task:
+			# the client sends lease_token back with its result, it
+			#	is how we know the task is still theirs
+			target, task, lease_token = next_task
 			if task == 'get_scan':
 				print(f'👉 Returning command to scan {target}')
 				return {
 					'task'						: 'get_scan',
 					'target'					: target,
-					'client_config'				: client_config
+					'client_config'				: client_config,
+					'lease_token'				: lease_token
 				}
 			elif task == 'get_crawl':
 				print(f'👉 Returning command to crawl {target[:30]}...')
 				return {
 					'task'						: 'get_crawl',
 					'target'					: json.loads(target),
-					'client_config'				: client_config
+					'client_config'				: client_config,
+					'lease_token'				: lease_token
 				}
 			elif task == 'get_policy':
 				print(f'👉 Returning command to get_policy {target}')
 				return {
 					'task'						: 'get_policy',
 					'target'					: target,
-					'client_config'				: client_config
+					'client_config'				: client_config,
+					'lease_token'				: lease_token
 				}
 			elif task == 'get_random_crawl':
 				print(f'👉 Returning command to get_random_crawl {target}')
 				return {
 					'task'						: 'get_random_crawl',
 					'target'					: target,
-					'client_config'				: client_config
+					'client_config'				: client_config,
+					'lease_token'				: lease_token
 				}
 		else:
 			print('✋ Returning command to wait.')
 			return {
 				'task':'wait'
 			}
-		sql_driver.close()
-		del sql_driver
 	# get_client_task
 
+	def get_next_buffered_task(self, sql_driver, config, db_name, client_id):
+		"""
+		Returns the next (target, task, lease_token) for this client from
+			our buffer, leasing a new batch from the db when the buffer is
+			empty.  Returns None if there is nothing to do.
+
+		The lock only guards the buffers, we never hold it while talking
+			to the db.  Every task carries its lease_token, so if the
+			lease was reclaimed while the task sat in a buffer, in this
+			process or another worker's, we find out when we renew it
+			and move on to the next one.
+		"""
+		buffer_key = (db_name, client_id)
+
+		while True:
+			expired_tasks 	= []
+			next_task 		= None
+			reclaim_leases 	= False
+
+			with Server.task_buffers_lock:
+				task_buffer = Server.task_buffers.get(buffer_key)
+
+				# if we held on to the batch past its lease somebody else may
+				#	be given these tasks, so hand back any which are still
+				#	ours and start over
+				if task_buffer and time.time() > task_buffer['expires']:
+					expired_tasks = task_buffer['tasks']
+					del Server.task_buffers[buffer_key]
+					task_buffer = None
+
+				if task_buffer and len(task_buffer['tasks']) != 0:
+					next_task = task_buffer['tasks'].pop(0)
+				elif time.time() - Server.last_lease_reclaim.get(db_name, 0) > 60:
+					# no need to reclaim more than once a minute per db
+					Server.last_lease_reclaim[db_name] = time.time()
+					reclaim_leases = True
+
+			for target, task, lease_token in expired_tasks:
+				sql_driver.release_task_lease(target, task, client_id, lease_token)
+
+			if not next_task:
+				# return tasks orphaned by clients which died to the queue
+				if reclaim_leases:
+					reclaimed = sql_driver.reclaim_expired_leases()
+					if reclaimed: print(f'♻️  Reclaimed {reclaimed} tasks with expired leases from {db_name}')
+
+				expires = time.time() + config['task_lease_seconds']
+				tasks 	= sql_driver.lease_tasks(
+					config['task_lease_batch_size'],
+					client_id 			= client_id,
+					lease_seconds 		= config['task_lease_seconds'],
+					max_attempts 		= config['max_attempts'],
+					max_domain_leases 	= config['max_domain_leases']
+				)
+				if len(tasks) == 0: return None
+
+				# another request for this client may have filled the
+				#	buffer while we were leasing, if so we add to it
+				next_task = tasks.pop(0)
+				with Server.task_buffers_lock:
+					task_buffer = Server.task_buffers.get(buffer_key)
+					if task_buffer:
+						task_buffer['tasks'].extend(tasks)
+						task_buffer['expires'] = min(task_buffer['expires'], expires)
+					else:
+						Server.task_buffers[buffer_key] = {
+							'expires'	: expires,
+							'tasks'		: tasks
+						}
+
+			# the task may have been waiting in our buffer, restart the clock,
+			#	if the lease was reclaimed in the meantime it is not ours to give
+			target, task, lease_token = next_task
+			lease_token = sql_driver.renew_task_lease(target, task, config['task_lease_seconds'], client_id, lease_token)
+			if lease_token:
+				return target, task, lease_token
+	# get_next_buffered_task
+
 	def store_result(self, data):
 		"""
 		We've gotten data from a client, attempt to store it.
@@ -141,6 +246,7 @@ class Server:
 		success			= data['success']
 		task			= data['task']
 		task_result		= data['task_result']
+		lease_token	= data['lease_token']
 
 		# we only load the json string if it is 
 		#	not a crawl
@@ -169,18 +275,13 @@ class Server:
 		if success == False:
 			print(f'👎 Error for {target}: %s' % {task_result})
 
-			# for times we don't want to retry, such as a rejected 
-			#	redirect or network resolution failure, this could be expanded
-			fail_cases = [
-				'reached fail limit',
-				'rejecting redirect',
-				'did not find enough internal links'
-			]
-			
-			if task_result in fail_cases or 'ERR_NAME_NOT_RESOLVED' in task_result:
-				sql_driver.set_task_as_failed(target, task)
+			# errors which won't go away fail the task, otherwise
+			#	it is retried after a delay which grows each attempt
+			retry_delay = Utilities().get_retry_delay(task_result)
+			if retry_delay == None:
+				sql_driver.set_task_as_failed(target, task, client_id, lease_token)
 			else:
-				sql_driver.unlock_task_in_queue(target, task)
+				sql_driver.reschedule_task(target, task, retry_delay, client_id, lease_token)
 
 			sql_driver.log_error({
 				'client_id'	: client_id, 
@@ -252,7 +353,8 @@ class Server:
 				'success'		: json.loads(form['success']),
 				'target'		: form['target'],
 				'task'			: form['task'],
-				'task_result'	: form['task_result']
+				'task_result'	: form['task_result'],
+				'lease_token'	: form.get('lease_token')
 			})
 
 			# tell the cient what happened
@@ -2,6 +2,7 @@
 import os
 import re
 import json
+from urllib.parse import urlsplit
 
 # custom webxray classes
 from webxray.ParseURL import ParseURL
@@ -63,6 +64,15 @@ class SingleScan:
 			print('INVALID BROWSER TYPE FOR %s, QUITTING!' % config['client_browser_type'])
 			exit()
 
+		# start looking up the ip of the site now, by the time
+		#	the page is loaded we should have it, the fqdn is the
+		#	same key get_parsed_domain_info looks it up by
+		try:
+			fqdn = self.url_parser.get_fqdn(urlsplit(url).netloc)
+			if fqdn: self.url_parser.get_resolver().prefetch([fqdn])
+		except:
+			pass
+
 		# attempt to get the page
 		browser_output = browser_driver.get_scan(url)
 
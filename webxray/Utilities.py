@@ -316,6 +316,49 @@ class Utilities:
 		print('-'*40)
 	# print_runtime
 
+	def get_retry_delay(self, error):
+		"""
+		Given the error a scan failed with, return the base number of
+			seconds to wait before the task is attempted again, the
+			queue doubles this with each attempt.  Returns None if the
+			error means the task will never succeed and should be
+			marked as failed.
+		"""
+		# these will not change no matter how often we try
+		fail_cases = [
+			'reached fail limit',
+			'rejecting redirect',
+			'did not find enough internal links'
+		]
+		if error in fail_cases or 'ERR_NAME_NOT_RESOLVED' in error:
+			return None
+
+		# our own browser broke, a fresh one may well work right away
+		browser_errors = [
+			'Crashed on',
+			'Unable to launch Chrome',
+			'Unable to get devtools response',
+			'No result for ws command',
+			'via Devtools'
+		]
+		for browser_error in browser_errors:
+			if browser_error in error: return 5
+
+		# the site is slow or down, give it time to recover
+		site_errors = [
+			'ERR_',
+			'No responses for page',
+			'No load_finish_events for page',
+			'Timeout when processing devtools responses',
+			'unable to crawl specified number of pages'
+		]
+		for site_error in site_errors:
+			if site_error in error: return 60
+
+		# anything else
+		return 30
+	# get_retry_delay
+
 	def get_absolute_url_from_page_link(self,page_url,link_url):
 		"""
 		Given a page_url and a link_url from that page we determine